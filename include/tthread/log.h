@@ -17,6 +17,7 @@ class _PUBLIC_ log {
 private:
 
   void openLog(int logFd);
+  void decodeLog(int logFd);
 
   const off_t _logOffset;
   size_t _logSize;
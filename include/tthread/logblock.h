@@ -0,0 +1,91 @@
+#pragma once
+
+/*
+ * @file   tthread/logblock.h
+ * @brief  compact encoding of events used by log version 2
+ *
+ * A version 2 log is a sequence of blocks after the header. Each block holds
+ * consecutive events of a single thread:
+ *
+ *   logblockheader
+ *   record...
+ *
+ * record:
+ *   tag (1 byte): event type (bit 0-2) | RETURN_ADDRESS_CACHED (bit 3)
+ *   return address: if RETURN_ADDRESS_CACHED is set, the slot (1 byte) of the
+ *                   return address cache, otherwise a varint
+ *   payload: WRITE/READ: zigzag varint of the difference to the address of
+ *                        the previous memory event in this block
+ *            THUNK: zigzag varint of the thunk id
+ *            FINISH: none
+ *
+ * Varints are unsigned LEB128. The return address cache is a direct-mapped
+ * table indexed by returnAddressSlot(), which is updated with each return
+ * address written as varint. The cache and the previous address are reset at
+ * the beginning of every block, so blocks can be decoded independently.
+ */
+
+#include <stdint.h>
+
+namespace tthread {
+#pragma pack(push, 1)
+typedef struct {
+  // size of the block in bytes including this header,
+  // 0 as long as the block has not been written completely
+  uint32_t size;
+
+  // process id of the thread, which issued the events
+  int32_t threadId;
+
+  // number of records in this block, LOG_BLOCK_CONTINUED is set if the
+  // thunk continues in the next block of the thread (the block was full or
+  // flushed within the thunk)
+  uint32_t eventCount;
+} logblockheader;
+#pragma pack(pop)
+
+enum {
+  LOG_BLOCK_SIZE = 4096,
+  RETURN_ADDRESS_CACHED = 0x08,
+  RETURN_ADDRESS_SLOTS = 64,
+
+  // tag + return address + payload
+  MAX_RECORD_SIZE = 1 + 10 + 10
+};
+
+const uint32_t LOG_BLOCK_CONTINUED = 0x80000000;
+
+inline unsigned int returnAddressSlot(uint64_t returnAddress) {
+  return (unsigned int)((returnAddress * 0x9E3779B97F4A7C15ULL) >> 58);
+}
+
+inline uint64_t zigzagEncode(int64_t value) {
+  return ((uint64_t)value << 1) ^ (uint64_t)(value >> 63);
+}
+
+inline int64_t zigzagDecode(uint64_t value) {
+  return (int64_t)(value >> 1) ^ -(int64_t)(value & 1);
+}
+
+inline char *writeVarint(char *p, uint64_t value) {
+  while (value >= 0x80) {
+    *p++ = (char)(value | 0x80);
+    value >>= 7;
+  }
+  *p++ = (char)value;
+  return p;
+}
+
+inline const char *readVarint(const char *p, uint64_t *value) {
+  const unsigned char *q = (const unsigned char *)p;
+  uint64_t result = 0;
+  unsigned int shift = 0;
+
+  while (*q & 0x80) {
+    result |= (uint64_t)(*q++ & 0x7F) << shift;
+    shift += 7;
+  }
+  *value = result | ((uint64_t)*q++ << shift);
+  return (const char *)q;
+}
+}
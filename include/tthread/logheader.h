@@ -25,7 +25,11 @@ public:
   enum {
     FILE_MAGIC = 0xC3D2C3D2,
     HEADER_SIZE = 4096,
-    VERSION = 1
+    VERSION = 1,
+
+    // events are written as blocks of variable-sized records,
+    // see tthread/logblock.h
+    COMPACT_VERSION = 2
   };
 
 private:
@@ -45,6 +49,10 @@ private:
 
   memorylayout_t _memoryLayout;
 
+  // Number of bytes reserved for blocks after the header (version 2 only),
+  // blocks at the end might not be written completely yet.
+  volatile uint64_t _dataSize;
+
 public:
 
   // Set a new file header on a buffer
@@ -52,12 +60,13 @@ public:
   // void *buf = mmap(...);
   // new(buf)tthread::logheader(globalStart, globalEnd, heapStart, heapEnd)
   // assert(((unsigned long*) buf)[0] == tthread::logheader::FILE_MAGIC)
-  logheader(memorylayout_t memoryLayout) :
+  logheader(memorylayout_t memoryLayout, uint32_t version = VERSION) :
     _fileMagic(FILE_MAGIC),
-    _version(VERSION),
+    _version(version),
     _headerSize(HEADER_SIZE),
     _eventCount(0),
-    _memoryLayout(memoryLayout)
+    _memoryLayout(memoryLayout),
+    _dataSize(0)
   {}
 
   inline bool validFileMagick() {
@@ -72,6 +81,10 @@ public:
     return &_eventCount;
   }
 
+  inline volatile uint64_t *getDataSize() {
+    return &_dataSize;
+  }
+
   inline uint32_t getVersion() {
     return _version;
   }
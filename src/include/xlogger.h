@@ -15,6 +15,7 @@
 
 #include "debug.h"
 #include "real.h"
+#include "tthread/logblock.h"
 #include "tthread/logevent.h"
 #include "tthread/logheader.h"
 #include "xatomic.h"
@@ -22,6 +23,9 @@
 #include "xthread.h"
 
 #define LOG_FD_ENV "TTHREAD_LOG_FD"
+#define MAPS_FD_ENV "TTHREAD_MAPS_FD"
+#define LOG_VERSION_ENV "TTHREAD_LOG_VERSION"
+#define LOG_SIZE_ENV "TTHREAD_LOG_SIZE"
 
 class xlogger {
 private:
@@ -31,6 +35,9 @@ private:
   // next free place in log
   volatile unsigned long *_next;
 
+  // next free byte after the header in version 2 logs
+  volatile unsigned long *_dataSize;
+
   // allocated file size
   volatile off_t *_fileSize;
 
@@ -46,15 +53,43 @@ private:
 
   int _logFd;
 
+  // receives a copy of /proc/self/maps on exit, -1 if not requested
+  int _mapsFd;
+
   // begin of mmap
   tthread::logevent *_log;
 
+  // mapped range of the log, relative to the end of the header
   off_t _mmapOffset;
+  size_t _mmapSize;
+
+  // tthread::logheader::VERSION or tthread::logheader::COMPACT_VERSION
+  uint32_t _version;
+
+  /*** version 2: events of the current thread, which were not written yet ***/
+
+  // logblockheader + records
+  char _block[tthread::LOG_BLOCK_SIZE];
+
+  size_t _blockUsed;
+
+  unsigned int _blockEvents;
+
+  int _blockThreadId;
+
+  // address of the previous memory event in the block
+  uintptr_t _lastAddress;
+
+  // cache of return addresses written in the block
+  uintptr_t _returnAddresses[tthread::RETURN_ADDRESS_SLOTS];
 
 public:
 
   enum {
     REQUEST_SIZE = 4096 * 16,
+
+    // the log grows by its current size, but at most by MAX_GROW_SIZE
+    MAX_GROW_SIZE = 256 * 1024 * 1024,
     HEADER_SIZE = PAGE_ALIGN_UP(sizeof(tthread::logheader)),
     EVENT_SIZE = sizeof(tthread::logevent)
   };
@@ -65,12 +100,16 @@ public:
     _fileSize(&data.fileSize),
     _truncateMutex(&data.truncateMutex),
     _thread(NULL),
-    _mmapOffset(-REQUEST_SIZE)
+    _log(NULL),
+    _mmapOffset(0),
+    _mmapSize(0)
   {
     assert(_fileSize);
     *_fileSize = 0;
 
     _logFd = openLog();
+    _mapsFd = openMaps();
+    _version = logVersion();
 
     if (WRAP(pthread_mutexattr_init)(&_truncateMutexattr) != 0) {
       fprintf(stderr, "tthread::log: failed initialize mutexattr: %s\n",
@@ -89,7 +128,16 @@ public:
     tthread::logheader *header = allocateHeader(memoryLayout);
     _next = header->getEventCount();
     *_next = 0;
-    growLog();
+    _dataSize = header->getDataSize();
+    *_dataSize = 0;
+
+    preallocate(logSizeHint());
+
+    if (_version == tthread::logheader::COMPACT_VERSION) {
+      resetBlock();
+    } else {
+      growLog(0);
+    }
   }
 
   int openLog() {
@@ -124,6 +172,101 @@ public:
     return fd;
   }
 
+  static uint32_t logVersion() {
+    const char *versionStr = getenv(LOG_VERSION_ENV);
+
+    if (versionStr == NULL) {
+      return tthread::logheader::VERSION;
+    }
+    unsetenv(LOG_VERSION_ENV);
+
+    if (atoi(versionStr) == tthread::logheader::COMPACT_VERSION) {
+      return tthread::logheader::COMPACT_VERSION;
+    }
+    return tthread::logheader::VERSION;
+  }
+
+  // expected size of the log in bytes, 0 if unknown
+  static off_t logSizeHint() {
+    const char *sizeStr = getenv(LOG_SIZE_ENV);
+
+    if (sizeStr == NULL) {
+      return 0;
+    }
+    unsetenv(LOG_SIZE_ENV);
+    return (off_t)atoll(sizeStr);
+  }
+
+  // Reserve disk space for the expected log size, so the log does not need
+  // to be extended while events are written.
+  void preallocate(off_t size) {
+    if (size <= 0) {
+      return;
+    }
+    size = PAGE_ALIGN_UP(size);
+
+    int res = fallocate(_logFd, 0, HEADER_SIZE, size);
+
+    if (res != 0) {
+      DEBUGF("failed to preallocate log: %s", strerror(errno));
+      return;
+    }
+
+    if (_version != tthread::logheader::COMPACT_VERSION) {
+      *_fileSize = size;
+    }
+  }
+
+  int openMaps() {
+    const char *fdStr = getenv(MAPS_FD_ENV);
+
+    if (fdStr == NULL) {
+      return -1;
+    }
+    unsetenv(MAPS_FD_ENV);
+    int fd = (int)atol(fdStr);
+
+    if (fcntl(fd, F_GETFD) < 0) {
+      DEBUGF("not a valid file descriptor was passed via %s: %s: %s",
+             MAPS_FD_ENV,
+             fdStr,
+             strerror(errno));
+      return -1;
+    }
+    return fd;
+  }
+
+  // Copy the memory mappings of this process to the maps file descriptor,
+  // so return addresses can be resolved to symbols after the process exited.
+  void saveMemoryMaps() {
+    if (_mapsFd < 0) {
+      return;
+    }
+
+    int fd = open("/proc/self/maps", O_RDONLY);
+
+    if (fd < 0) {
+      DEBUGF("failed to open /proc/self/maps: %s", strerror(errno));
+      return;
+    }
+
+    if (ftruncate(_mapsFd, 0) != 0) {
+      DEBUGF("failed to truncate maps file: %s", strerror(errno));
+    }
+    off_t offset = 0;
+    char buf[4096];
+    ssize_t n;
+
+    while ((n = WRAP(read)(fd, buf, sizeof(buf))) > 0) {
+      if (pwrite(_mapsFd, buf, n, offset) != n) {
+        DEBUGF("failed to write memory maps: %s", strerror(errno));
+        break;
+      }
+      offset += n;
+    }
+    close(fd);
+  }
+
   static xlogger *allocate(xlogger_shared_data   & data,
                            tthread::memorylayout_t layout) {
     void *buf = WRAP(mmap)(NULL, sizeof(xlogger), PROT_READ | PROT_WRITE,
@@ -143,8 +286,24 @@ public:
 
   void add(tthread::logevent e);
 
+  // Write buffered events of this thread to the log (version 2 only).
+  // Must be called before a thread exits. `continued` marks the block as
+  // part of a thunk, which is not finished yet.
+  void flush(bool continued = true);
+
+  // Drop buffered events inherited from the parent thread,
+  // new threads should call this.
+  void resetBlock() {
+    _blockUsed = sizeof(tthread::logblockheader);
+    _blockEvents = 0;
+    _lastAddress = 0;
+    memset(_returnAddresses, 0, sizeof(_returnAddresses));
+  }
+
 private:
 
+  void addCompact(tthread::logevent& e);
+
   tthread::logheader *allocateHeader(tthread::memorylayout_t layout) {
     if (ftruncate(_logFd, HEADER_SIZE) != 0) {
       fprintf(stderr,
@@ -166,19 +325,34 @@ private:
       fprintf(stderr, "tthread::log: mmap error with %s\n", strerror(errno));
       ::abort();
     }
-    return new(buf)tthread::logheader(layout);
+    return new(buf)tthread::logheader(layout, _version);
   }
 
-  void growLog() {
-    off_t currentSize = *_fileSize;
+  // Makes sure the log is large enough for an event at `offset` (relative
+  // to the end of the header) and maps the log from there to its end.
+  // The log is extended geometrically, so large logs need few remaps.
+  void growLog(off_t offset) {
+    off_t requiredSize = offset + EVENT_SIZE;
 
-    // check if someone else has resized the log -> then just mmap to new size
-    if ((_mmapOffset + REQUEST_SIZE) >= currentSize) {
+    if (*_fileSize < requiredSize) {
       WRAP(pthread_mutex_lock)(_truncateMutex);
 
       // test if someone else has truncated the log, while we try to get lock
-      if (currentSize == *_fileSize) {
-        off_t newSize = currentSize + REQUEST_SIZE;
+      off_t currentSize = *_fileSize;
+
+      if (currentSize < requiredSize) {
+        off_t step = currentSize;
+
+        if (step < REQUEST_SIZE) {
+          step = REQUEST_SIZE;
+        } else if (step > MAX_GROW_SIZE) {
+          step = MAX_GROW_SIZE;
+        }
+        off_t newSize = currentSize + step;
+
+        if (newSize < requiredSize) {
+          newSize = PAGE_ALIGN_UP(requiredSize);
+        }
 
         if (ftruncate(_logFd, newSize + HEADER_SIZE) != 0) {
           fprintf(stderr,
@@ -196,13 +370,14 @@ private:
 
     // free old mapping, if set
     if (_log != NULL) {
-      munmap(_log, REQUEST_SIZE);
+      munmap(_log, _mmapSize);
     }
 
-    _mmapOffset = *_fileSize - REQUEST_SIZE;
+    _mmapOffset = PAGE_ALIGN_DOWN(offset);
+    _mmapSize = *_fileSize - _mmapOffset;
 
     char *buf = (char *)WRAP(mmap)(NULL,
-                                   REQUEST_SIZE,
+                                   _mmapSize,
                                    PROT_WRITE,
                                    MAP_SHARED,
                                    _logFd,
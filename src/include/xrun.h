@@ -143,6 +143,9 @@ public:
     // Set correponding heap index.
     _memory.setThreadIndex(_thread_index);
 
+    // Events buffered by the parent are written by the parent.
+    _logger.resetBlock();
+
     // New thread will not own any blocks in the beginning
     // We should cleanup all blocks information inherited from the parent.
     _memory.cleanupOwnedBlocks();
@@ -81,22 +81,14 @@ class Result:
         self.log_size = log_size
         self.perf_stats = perf_stats
 
-    def _read_file_to_dict(self, path):
-        data = {}
-        with open(path) as stat_file:
-            for line in stat_file:
-                key, value = line.split(" ", 1)
-                data[key] = value.strip()
-        return data
-
-    def read_cpuacct_cgroup(self, cpuacct):
-        stat_path = os.path.join(cpuacct.mountpoint, "cpuacct.stat")
-        stats = self._read_file_to_dict(stat_path)
-        self.system_time = stats["system"]
-        self.user_time = stats["user"]
-        percpu_path = os.path.join(cpuacct.mountpoint, "cpuacct.usage_percpu")
-        with open(percpu_path) as percpu:
-            self.time_per_cpu = list(map(int, percpu.read().split()))
+    # stores a cgroups.Usage, times are in seconds
+    def read_usage(self, usage):
+        self.system_time = usage.system_time
+        self.user_time = usage.user_time
+        self.time_per_cpu = usage.time_per_cpu
+        self.memory_peak = usage.memory_peak
+        self.io_read_bytes = usage.io_read_bytes
+        self.io_write_bytes = usage.io_write_bytes
 
     def calculate_compressed_logsize(self, log_path):
         lz4 = subprocess.Popen(('lz4c', '--stdout', log_path),
@@ -211,7 +203,10 @@ class Benchmark():
             os.remove(perf_log)
         cgroup_name = "inspector-%d" % os.getpid()
 
+        # with cgroup v2 all of them are the same cgroup
         with cgroups.cpuacct(cgroup_name) as cpuacct, \
+                cgroups.memory(cgroup_name) as memory, \
+                cgroups.blkio(cgroup_name) as blkio, \
                 cgroups.perf_event(cgroup_name) as perf_event:
             perf = PerfStat(perf_event.name, perf_command=self.perf_command)
             perf.run()
@@ -221,7 +216,7 @@ class Benchmark():
                                  tthread_path=libtthread,
                                  perf_log=perf_log,
                                  perf_event_cgroup=perf_event,
-                                 additional_cgroups=[cpuacct],
+                                 additional_cgroups=[cpuacct, memory, blkio],
                                  env=self.env)
             status = proc.wait()
             if status.exit_code != 0:
@@ -232,7 +227,7 @@ class Benchmark():
                        args=self.args(cores),
                        log_size=os.path.getsize(perf_log),
                        perf_stats=perf_stats)
-            r.read_cpuacct_cgroup(cpuacct)
+            r.read_usage(cgroups.usage(cpuacct, memory, blkio))
             r.calculate_compressed_logsize(perf_log)
         return r
 
@@ -463,9 +458,12 @@ class BenchmarkSet():
                     "times": [],
                     "log_sizes": [],
                     "compressed_logsizes": [],
-                    "system_time": [],
-                    "user_time": [],
-                    "time_per_cpu": [],
+                    "system_seconds": [],
+                    "user_seconds": [],
+                    "seconds_per_cpu": [],
+                    "memory_peak": [],
+                    "io_read_bytes": [],
+                    "io_write_bytes": [],
                     "sigsegv": [],
                     "sigusr1": [],
                     "args": None
@@ -484,9 +482,15 @@ class BenchmarkSet():
             lib["times"].append(result.wall_time)
             lib["log_sizes"].append(result.log_size)
             lib["compressed_logsizes"].append(result.compressed_logsize)
-            lib["system_time"].append(result.system_time)
-            lib["user_time"].append(result.user_time)
-            lib["time_per_cpu"].append(result.time_per_cpu)
+            # missing in logs written by older versions, which stored cpu
+            # times in USER_HZ ticks and nanoseconds under other keys
+            for key, value in (("system_seconds", result.system_time),
+                               ("user_seconds", result.user_time),
+                               ("seconds_per_cpu", result.time_per_cpu),
+                               ("memory_peak", result.memory_peak),
+                               ("io_read_bytes", result.io_read_bytes),
+                               ("io_write_bytes", result.io_write_bytes)):
+                lib.setdefault(key, []).append(value)
             for event in EVENTS:
                 lib[event].append(result.perf_stats[event])
             lib["sigusr1"].append(result.perf_stats["sigusr1"])
@@ -3,4 +3,4 @@ class Error(Exception):
         super(Error, self).__init__(msg)
         self.error = error
 
-from .run import run, default_tthread_path  # flake8: noqa
+from .run import run, run_async, default_tthread_path  # flake8: noqa
@@ -1,58 +1,143 @@
 import os
 import signal
+from collections import namedtuple
 from . import Error
 
+# Resource usage of the processes of a cgroup: cpu times in seconds, memory
+# and io in bytes. Fields, which the cgroup does not account, are None.
+Usage = namedtuple("Usage", ["user_time",
+                             "system_time",
+                             "time_per_cpu",
+                             "memory_peak",
+                             "io_read_bytes",
+                             "io_write_bytes"])
 
-def find_mount(cgroup_type):
+# controllers of the unified hierarchy (cgroup v2), which account what a
+# cgroup v1 type accounts; perf_event is always enabled in cgroup v2
+unified_controllers = {
+    "cpuacct": "cpu",
+    "memory": "memory",
+    "blkio": "io",
+    "perf_event": None,
+}
+
+
+def _mounts():
     try:
         with open("/proc/mounts", "r") as mounts:
             for line in mounts:
                 fields = line.split(" ")
                 if len(fields) < 6:
                     continue
-                dev, mount, fs, opts, fs_freq, fs_passno = fields
-                if fs == "cgroup" and cgroup_type in opts:
-                    return mount
+                yield fields
     except OSError as e:
         raise Error("Failed to open /proc/mounts: %s" % e)
+
+
+def find_mount(cgroup_type):
+    for dev, mount, fs, opts, fs_freq, fs_passno in _mounts():
+        if fs == "cgroup" and cgroup_type in opts.split(","):
+            return mount
+    return None
+
+
+def find_unified_mount():
+    for dev, mount, fs, opts, fs_freq, fs_passno in _mounts():
+        if fs == "cgroup2":
+            return mount
     return None
 
 
+# Returns a cgroup of `type_`: in the cgroup v1 hierarchy of type_, if it is
+# mounted, otherwise in the unified hierarchy. In the unified hierarchy all
+# types share a single cgroup per name.
+def group(name, type_):
+    if find_mount(type_) is None and type_ in unified_controllers:
+        mount = find_unified_mount()
+        if mount is not None:
+            return UnifiedGroup(name, mount)
+    return Group(name, type_)
+
+
 def perf_event(name):
-    return Group(name, "perf_event")
+    return group(name, "perf_event")
 
 
 def cpuacct(name):
-    return Group(name, "cpuacct")
+    return group(name, "cpuacct")
 
 
 def memory(name):
-    return Group(name, "memory")
+    return group(name, "memory")
 
 
-class Group():
-    def __init__(self, name, type_):
-        mount = find_mount(type_)
-        if mount is None:
-            msg = "mount for %s cgroup not found in /proc/mounts." % type_
-            if type_ == "perf_events":
-                msg += " Has kernel CONFIG_PERF_EVENTS=y set?"
-            raise Error(msg)
-        self.name = name
-        self.mountpoint = os.path.join(mount, name)
-        self.type_ = type_
+def blkio(name):
+    return group(name, "blkio")
+
+
+# Returns the combined Usage of cgroups, e.g. of the cpuacct and memory
+# cgroups of a process in cgroup v1.
+def usage(*groups):
+    fields = [None] * len(Usage._fields)
+    for g in groups:
+        for i, value in enumerate(g.usage()):
+            if fields[i] is None:
+                fields[i] = value
+    return Usage(*fields)
+
+
+def _read_keys(path, separator=" "):
+    data = {}
+    with open(path) as stat_file:
+        for line in stat_file:
+            key, value = line.split(separator, 1)
+            data[key] = value.strip()
+    return data
+
+
+# Subclasses set `mountpoint` and implement _root(), which returns the root
+# cgroup of the hierarchy, and _usage().
+class _Base():
+    # file listing the processes of the cgroup
+    procs = "tasks"
+
+    def pids(self):
+        with open(os.path.join(self.mountpoint, self.procs)) as f:
+            return [line.strip() for line in f]
 
     def addPids(self, *pids):
-        tasks = os.path.join(self.mountpoint, "tasks")
+        path = os.path.join(self.mountpoint, self.procs)
         try:
-            with open(tasks, "a") as f:
+            with open(path, "a") as f:
                 for pid in pids:
+                    # cgroup.procs accepts a single pid per write
                     f.write("%s\n" % pid)
+                    f.flush()
         except OSError as e:
             msg = "Failed to add processes '%s' to cgroup '%s': %s" \
                   % (pids[0], self.mountpoint, e)
             raise Error(msg)
 
+    # Returns a file descriptor of the procs file to add processes with
+    # join(), so adding a process only writes to it
+    def open_procs(self):
+        path = os.path.join(self.mountpoint, self.procs)
+        try:
+            return os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+        except OSError as e:
+            msg = "Failed to open '%s' of cgroup '%s': %s" \
+                % (self.procs, self.mountpoint, e)
+            raise Error(msg)
+
+    # adds process `pid` through `fd` of open_procs()
+    def join(self, fd, pid):
+        try:
+            os.write(fd, b"%d\n" % pid)
+        except OSError as e:
+            msg = "Failed to add process '%s' to cgroup '%s': %s" \
+                  % (pid, self.mountpoint, e)
+            raise Error(msg)
+
     def create(self):
         try:
             os.mkdir(self.mountpoint)
@@ -64,31 +149,158 @@ class Group():
 
     def _move_processes(self, dest_cgroup):
         try:
-            pids = []
-            with open(os.path.join(self.mountpoint, "tasks")) as task:
-                for line in task:
-                    pids.append(line.strip())
-            dest_cgroup.addPids(*pids)
+            dest_cgroup.addPids(*self.pids())
         except OSError as e:
             msg = "Failed to move processes from cgroup '%s' to '%s': %s"\
                 % (self.mountpoint, dest_cgroup.mountpoint, e)
             raise Error(msg)
 
     def destroy(self):
-        self._move_processes(Group("", self.type_))
+        self._move_processes(self._root())
 
-        with open(os.path.join(self.mountpoint, "tasks"), "r") as f:
-            for line in f:
-                os.kill(int(line), signal.SIGKILL)
+        for pid in self.pids():
+            os.kill(int(pid), signal.SIGKILL)
         try:
             os.rmdir(self.mountpoint)
         except OSError as e:
             msg = "Failed to remove cgroup '%s': %s" % (self.mountpoint, e)
             raise Error(msg)
 
+    def usage(self):
+        try:
+            return self._usage()
+        except (OSError, ValueError) as e:
+            msg = "Failed to read usage of cgroup '%s': %s" \
+                % (self.mountpoint, e)
+            raise Error(msg)
+
     def __enter__(self):
         self.create()
         return self
 
     def __exit__(self, type, value, traceback):
         self.destroy()
+
+
+# cgroup v1
+class Group(_Base):
+    def __init__(self, name, type_):
+        mount = find_mount(type_)
+        if mount is None:
+            msg = "mount for %s cgroup not found in /proc/mounts." % type_
+            if type_ == "perf_event":
+                msg += " Has kernel CONFIG_PERF_EVENTS=y set?"
+            raise Error(msg)
+        self.name = name
+        self.mountpoint = os.path.join(mount, name)
+        self.type_ = type_
+
+    def _root(self):
+        return Group("", self.type_)
+
+    def _usage(self):
+        path = self.mountpoint
+        fields = dict.fromkeys(Usage._fields)
+        if self.type_ == "cpuacct":
+            # in USER_HZ
+            stats = _read_keys(os.path.join(path, "cpuacct.stat"))
+            hz = os.sysconf("SC_CLK_TCK")
+            fields["user_time"] = int(stats["user"]) / hz
+            fields["system_time"] = int(stats["system"]) / hz
+            percpu_path = os.path.join(path, "cpuacct.usage_percpu")
+            with open(percpu_path) as percpu:
+                fields["time_per_cpu"] = [int(ns) / 1e9
+                                          for ns in percpu.read().split()]
+        elif self.type_ == "memory":
+            peak_path = os.path.join(path, "memory.max_usage_in_bytes")
+            with open(peak_path) as peak:
+                fields["memory_peak"] = int(peak.read())
+        elif self.type_ == "blkio":
+            # lines of "<major>:<minor> <operation> <bytes>"
+            read = write = 0
+            io_path = os.path.join(path, "blkio.throttle.io_service_bytes")
+            with open(io_path) as io:
+                for line in io:
+                    columns = line.split()
+                    if len(columns) != 3:
+                        continue
+                    if columns[1] == "Read":
+                        read += int(columns[2])
+                    elif columns[1] == "Write":
+                        write += int(columns[2])
+            fields["io_read_bytes"] = read
+            fields["io_write_bytes"] = write
+        return Usage(**fields)
+
+
+# cgroup v2
+class UnifiedGroup(_Base):
+    procs = "cgroup.procs"
+
+    def __init__(self, name, mount):
+        self.name = name
+        self.mount = mount
+        self.mountpoint = os.path.join(mount, name)
+
+    def _root(self):
+        return UnifiedGroup("", self.mount)
+
+    def _enable_controllers(self):
+        # controllers are enabled for children in the parent cgroup, ones
+        # not available or already enabled are skipped
+        parent = os.path.dirname(self.mountpoint.rstrip("/"))
+        controllers_path = os.path.join(parent, "cgroup.controllers")
+        subtree_path = os.path.join(parent, "cgroup.subtree_control")
+        try:
+            with open(controllers_path) as f:
+                available = f.read().split()
+            with open(subtree_path) as f:
+                enabled = f.read().split()
+        except OSError:
+            return
+        for controller in unified_controllers.values():
+            if controller in available and controller not in enabled:
+                try:
+                    with open(subtree_path, "w") as f:
+                        f.write("+%s\n" % controller)
+                except OSError:
+                    pass
+
+    def create(self):
+        self._enable_controllers()
+        super().create()
+
+    def destroy(self):
+        # all types share a cgroup, which is only removed once
+        if not os.path.isdir(self.mountpoint):
+            return
+        super().destroy()
+
+    def _usage(self):
+        path = self.mountpoint
+        fields = dict.fromkeys(Usage._fields)
+        # in microseconds, available without the cpu controller
+        stats = _read_keys(os.path.join(path, "cpu.stat"))
+        fields["user_time"] = int(stats["user_usec"]) / 1e6
+        fields["system_time"] = int(stats["system_usec"]) / 1e6
+        # since Linux 5.19, memory.current is no peak and about 0 once the
+        # processes exited
+        peak_path = os.path.join(path, "memory.peak")
+        if os.path.exists(peak_path):
+            with open(peak_path) as f:
+                fields["memory_peak"] = int(f.read())
+        io_path = os.path.join(path, "io.stat")
+        if os.path.exists(io_path):
+            # lines of "<major>:<minor> rbytes=<n> wbytes=<n> ..."
+            read = write = 0
+            with open(io_path) as io:
+                for line in io:
+                    for column in line.split()[1:]:
+                        key, value = column.split("=", 1)
+                        if key == "rbytes":
+                            read += int(value)
+                        elif key == "wbytes":
+                            write += int(value)
+            fields["io_read_bytes"] = read
+            fields["io_write_bytes"] = write
+        return Usage(**fields)
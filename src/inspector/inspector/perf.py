@@ -1,10 +1,13 @@
 import os
 import time
+import asyncio
+import select
+import shutil
 import subprocess
 import signal
+import tempfile
 from . import Error
 from collections import namedtuple
-from threading import BrokenBarrierError
 
 Status = namedtuple("Status", ["exit_code", "perf_exit_code", "duration"])
 
@@ -18,20 +21,74 @@ class SnapshotHandler:
         os.kill(self.perf_pid, signal.SIGUSR2)
 
 
+# Control channel of perf record (--control fifo:ctl,ack, perf >= 5.10).
+# perf acknowledges each command, after it was applied, so recording is armed
+# once "enable" is acknowledged. "ping" (perf >= 5.11) is only acknowledged
+# and tells, that perf set up its events. Both fifos are opened read-write,
+# so opening never blocks, even if perf failed to start.
+class Control:
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="inspector-")
+        self.ctl_path = os.path.join(self.directory, "ctl")
+        self.ack_path = os.path.join(self.directory, "ack")
+        os.mkfifo(self.ctl_path)
+        os.mkfifo(self.ack_path)
+        self.ctl = os.open(self.ctl_path, os.O_RDWR | os.O_CLOEXEC)
+        self.ack = os.open(self.ack_path, os.O_RDWR | os.O_CLOEXEC)
+
+    def arguments(self):
+        return ["--control", "fifo:%s,%s" % (self.ctl_path, self.ack_path)]
+
+    # sends `command` and waits until perf acknowledged it
+    def send(self, command, perf_process, timeout=10):
+        os.write(self.ctl, (command + "\n").encode("ascii"))
+        deadline = time.monotonic() + timeout
+        reply = b""
+        while not reply.endswith(b"\n"):
+            if perf_process.poll() is not None:
+                raise Error("perf exited with %d before acknowledging '%s'"
+                            % (perf_process.returncode, command))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Error("perf did not acknowledge '%s'" % command)
+            # wake up periodically to notice, if perf exited
+            ready, _, _ = select.select([self.ack], [], [],
+                                        min(remaining, 0.1))
+            if ready:
+                reply += os.read(self.ack, 64)
+        if reply.strip() != b"ack":
+            raise Error("unexpected reply of perf to '%s': %s"
+                        % (command, reply))
+
+    def close(self):
+        if self.directory is None:
+            return
+        os.close(self.ctl)
+        os.close(self.ack)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+
+# Starts perf and, once it records, the traced process by calling `launch`,
+# which returns its subprocess.Popen. Nothing of the traced process is missed
+# and it does not wait for perf.
 def run(perf_command,
         perf_log,
-        barrier,
-        process,
+        launch,
         cgroup,
         processor_trace=True,
         trace_segfaults=True,
         remove_cgroup=True,
-        snapshot_mode=False):
+        snapshot_mode=False,
+        enabled=True):
+    control = Control()
+    # events are disabled until enabled through the control fifo
     command = [perf_command,
                "record",
                "--all-cpus",
                "--output", perf_log,
-               "--call-graph", "fp"]
+               "--call-graph", "fp",
+               "--delay=-1"] + control.arguments()
     if trace_segfaults:
         command += ["--event", "signal:signal_generate",
                     "--filter", "sig == 11"]
@@ -41,20 +98,58 @@ def run(perf_command,
         command += ["--event", "intel_pt/tsc=1/u",
                     "--cgroup", cgroup.name]
     # print("$ " + " ".join(command))
-    perf_process = subprocess.Popen(command)
-    if snapshot_mode:
-        SnapshotHandler(perf_process.pid)
+    perf_process = None
+    try:
+        try:
+            perf_process = subprocess.Popen(command)
+        except OSError as e:
+            raise Error("Failed to start perf: %s" % e)
+        if snapshot_mode:
+            SnapshotHandler(perf_process.pid)
+
+        if enabled:
+            control.send("enable", perf_process)
+        else:
+            # nothing is recorded until enable() is called
+            control.send("ping", perf_process)
+        process = launch()
+    except Error:
+        control.close()
+        if perf_process is not None and perf_process.poll() is None:
+            perf_process.terminate()
+            perf_process.wait()
+        if remove_cgroup:
+            cgroup.destroy()
+        raise
+    return Process(perf_process,
+                   process,
+                   cgroup,
+                   control,
+                   remove_cgroup=remove_cgroup)
 
-    for i in range(5):
-        if perf_process.poll() is not None:
-            raise Error("Failed to start perf")
-        # ugly hack, but there is no mechanims to ensure perf is ready
-        time.sleep(0.1)
+
+# pidfds (Linux 5.3, Python 3.9) become readable, when their process exited.
+# Waiting on them does not reap other children and signals sent through them
+# cannot hit a reused pid.
+def _pidfd_open(pid):
+    if not hasattr(os, "pidfd_open"):
+        return None
     try:
-        barrier.wait(timeout=3)
-    except BrokenBarrierError:
-        raise Error("Child process timed out")
-    return Process(perf_process, process, cgroup, remove_cgroup=remove_cgroup)
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+# returns a future, which is done, when the process of `pidfd` exited
+def _exit_future(loop, pidfd):
+    future = loop.create_future()
+
+    def on_readable():
+        loop.remove_reader(pidfd)
+        if not future.done():
+            future.set_result(None)
+    loop.add_reader(pidfd, on_readable)
+    return future
 
 
 class Process:
@@ -62,32 +157,163 @@ class Process:
                  perf_process,
                  traced_process,
                  cgroup,
+                 control,
                  remove_cgroup=True):
         self.perf_process = perf_process
         self.traced_process = traced_process
         self.cgroup = cgroup
+        self.control = control
         self.start_time = time.time()
         self.remove_cgroup = remove_cgroup
+        self.traced_pidfd = _pidfd_open(traced_process.pid)
+        self.perf_pidfd = _pidfd_open(perf_process.pid)
+        # wait status of the traced process, once it was reaped
+        self.exit_code = None
+        # event loop of wait_async()
+        self._loop = None
 
-    def _wait(self):
+    # start recording, e.g. at the beginning of a region of interest
+    def enable(self):
+        self.control.send("enable", self.perf_process)
+
+    # stop recording until enable() is called
+    def disable(self):
+        self.control.send("disable", self.perf_process)
+
+    def _has_pidfds(self):
+        return self.traced_pidfd is not None and self.perf_pidfd is not None
+
+    def _reaped(self, status):
+        self.exit_code = status
+        # otherwise Popen waits for the pid again, which may be reused
+        if os.WIFSIGNALED(status):
+            self.traced_process.returncode = -os.WTERMSIG(status)
+        else:
+            self.traced_process.returncode = os.WEXITSTATUS(status)
+
+    def _reap(self):
+        if self.exit_code is None:
+            _, status = os.waitpid(self.traced_process.pid, 0)
+            self._reaped(status)
+        return self.exit_code
+
+    def _signal_traced(self, signum):
+        if self.exit_code is not None:
+            return
+        if self.traced_pidfd is not None:
+            signal.pidfd_send_signal(self.traced_pidfd, signum)
+        else:
+            os.kill(self.traced_process.pid, signum)
+
+    def _perf_failed(self):
+        exitcode = self.perf_process.wait()
+        self._signal_traced(signal.SIGTERM)
+        raise Error("perf exited prematurally with %d" % exitcode)
+
+    def _wait_any(self):
         while True:
             pid, exitcode = os.wait()
             if pid == self.traced_process.pid:
-                duration = time.time() - self.start_time
-                self.perf_process.terminate()
-                perf_exitcode = self.perf_process.wait()
-                return Status(exitcode, perf_exitcode, duration)
+                self._reaped(exitcode)
+                return
             elif pid == self.perf_process.pid:
-                self.traced_process.terminate()
-                raise Error("perf exited prematurally with %d" % exitcode)
+                self.perf_process.returncode = exitcode
+                self._perf_failed()
             # else ignore other childs
 
+    def _wait(self):
+        if self._has_pidfds():
+            readable, _, _ = select.select([self.traced_pidfd,
+                                            self.perf_pidfd], [], [])
+            if self.traced_pidfd not in readable:
+                self._perf_failed()
+        else:
+            self._wait_any()
+        exitcode = self._reap()
+        duration = time.time() - self.start_time
+        self.perf_process.terminate()
+        perf_exitcode = self.perf_process.wait()
+        return Status(exitcode, perf_exitcode, duration)
+
+    def _cleanup(self):
+        if self.cgroup is None:
+            return
+        for pidfd in (self.traced_pidfd, self.perf_pidfd):
+            if pidfd is not None:
+                if self._loop is not None:
+                    self._loop.remove_reader(pidfd)
+                os.close(pidfd)
+        self.traced_pidfd = self.perf_pidfd = None
+        self.control.close()
+        cgroup, self.cgroup = self.cgroup, None
+        if self.remove_cgroup:
+            cgroup.destroy()
+
     def wait(self):
         try:
             return self._wait()
         except OSError as e:
             raise Error("Failed to wait for result of processes '%s'" % e)
         finally:
-            if self.remove_cgroup:
-                self.cgroup.destroy()
+            self._cleanup()
         raise Error("Program error! should not be reached")
+
+    async def _wait_async(self):
+        await asyncio.wait([self._traced_exit, self._perf_exit],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not self._traced_exit.done():
+            self._perf_failed()
+        exitcode = self._reap()
+        duration = time.time() - self.start_time
+        self.perf_process.terminate()
+        await asyncio.shield(self._perf_exit)
+        perf_exitcode = self.perf_process.wait()
+        return Status(exitcode, perf_exitcode, duration)
+
+    # kills the traced process and stops perf, which writes its log on
+    # SIGTERM
+    async def _abort(self):
+        try:
+            self._signal_traced(signal.SIGKILL)
+            await self._traced_exit
+            self._reap()
+            self.perf_process.terminate()
+            await self._perf_exit
+            self.perf_process.wait()
+        finally:
+            self._cleanup()
+
+    # Like wait(), but waits without blocking the event loop. Many processes
+    # can be waited for concurrently. If cancelled, the traced process is
+    # killed and perf is stopped.
+    async def wait_async(self):
+        if not self._has_pidfds():
+            self._cleanup()
+            raise Error("Waiting asynchronously requires pidfds "
+                        "(Linux 5.3, Python 3.9)")
+        self._loop = asyncio.get_running_loop()
+        self._traced_exit = _exit_future(self._loop, self.traced_pidfd)
+        self._perf_exit = _exit_future(self._loop, self.perf_pidfd)
+        abort = None
+        try:
+            return await self._wait_async()
+        except asyncio.CancelledError:
+            # finishes even if cancelled again
+            abort = asyncio.ensure_future(self._abort())
+            await asyncio.shield(abort)
+            raise
+        except OSError as e:
+            raise Error("Failed to wait for result of processes '%s'" % e)
+        finally:
+            if abort is None:
+                self._cleanup()
+
+    # kills the traced process, stops perf and waits for both
+    def kill(self):
+        try:
+            self._signal_traced(signal.SIGKILL)
+            self._reap()
+            self.perf_process.terminate()
+            self.perf_process.wait()
+        finally:
+            self._cleanup()
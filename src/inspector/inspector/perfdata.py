@@ -0,0 +1,629 @@
+import os
+import mmap
+import struct
+import operator
+from array import array
+from collections import namedtuple
+from . import Error
+
+# Reader of perf.data files as written by perf record, without perf
+#
+# The file is memory-mapped and records are decoded in place with
+# precompiled structs, so reading scales to multi-GB files. Records are
+# yielded one by one from records(), or samples as numpy structured arrays
+# from sample_batches(). Only files in file mode (not piped), little endian
+# and uncompressed (no perf record -z) are supported.
+#
+# Decoded records: SAMPLE (fields up to PERF_SAMPLE_RAW; branch stacks,
+# registers, user stacks and later fields are not decoded), MMAP, MMAP2,
+# COMM, FORK, EXIT, LOST, AUX, ITRACE_START and AUXTRACE. Other records are
+# skipped.
+#
+# Payloads of AUXTRACE (Intel PT) and raw samples are memoryviews into the
+# mapping and are not copied. The mapping stays until they are released.
+
+MAGIC = b"PERFILE2"
+
+# record types (perf_event_header.type)
+MMAP = 1
+LOST = 2
+COMM = 3
+EXIT = 4
+FORK = 7
+SAMPLE = 9
+MMAP2 = 10
+AUX = 11
+ITRACE_START = 12
+# record types synthesized by perf
+FINISHED_ROUND = 68
+AUXTRACE = 71
+
+# perf_event_attr.sample_type
+SAMPLE_IP = 1 << 0
+SAMPLE_TID = 1 << 1
+SAMPLE_TIME = 1 << 2
+SAMPLE_ADDR = 1 << 3
+SAMPLE_READ = 1 << 4
+SAMPLE_CALLCHAIN = 1 << 5
+SAMPLE_ID = 1 << 6
+SAMPLE_CPU = 1 << 7
+SAMPLE_PERIOD = 1 << 8
+SAMPLE_STREAM_ID = 1 << 9
+SAMPLE_RAW = 1 << 10
+SAMPLE_IDENTIFIER = 1 << 16
+
+# perf_event_attr.read_format
+FORMAT_TOTAL_TIME_ENABLED = 1 << 0
+FORMAT_TOTAL_TIME_RUNNING = 1 << 1
+FORMAT_ID = 1 << 2
+FORMAT_GROUP = 1 << 3
+FORMAT_LOST = 1 << 4
+
+# bit of perf_event_attr flags
+ATTR_FLAG_SAMPLE_ID_ALL = 1 << 18
+
+# perf_event_header.misc
+MISC_COMM_EXEC = 1 << 13
+MISC_MMAP_BUILD_ID = 1 << 14
+
+# header features (adds_features bits)
+FEATURE_EVENT_DESC = 12
+
+Attr = namedtuple("Attr", ["type",
+                           "config",
+                           "sample_period",
+                           "sample_type",
+                           "read_format",
+                           "flags",
+                           "ids",
+                           "name"])
+
+Sample = namedtuple("Sample", ["attr",  # index into PerfData.attrs
+                               "ip",
+                               "pid",
+                               "tid",
+                               "time",
+                               "address",
+                               "id",
+                               "cpu",
+                               "period",
+                               "callchain",
+                               "raw"])
+# prot is None for MMAP records
+Mmap = namedtuple("Mmap", ["pid",
+                           "tid",
+                           "address",
+                           "length",
+                           "offset",
+                           "filename",
+                           "prot",
+                           "time"])
+Comm = namedtuple("Comm", ["pid", "tid", "comm", "exec_", "time"])
+Fork = namedtuple("Fork", ["pid", "ppid", "tid", "ptid", "time"])
+Exit = namedtuple("Exit", ["pid", "ppid", "tid", "ptid", "time"])
+Lost = namedtuple("Lost", ["id", "lost", "time"])
+# a range of the aux buffer, which was filled
+Aux = namedtuple("Aux", ["offset", "size", "flags", "time"])
+ItraceStart = namedtuple("ItraceStart", ["pid", "tid", "time"])
+# aux buffer data (e.g. Intel PT packets) copied by perf into the file
+AuxTrace = namedtuple("AuxTrace", ["offset",
+                                   "reference",
+                                   "idx",
+                                   "tid",
+                                   "cpu",
+                                   "data"])
+
+_file_header = struct.Struct("<8sQQQQQQQQ32s")
+_event_header = struct.Struct("<IHH")
+_type_size = struct.Struct("<I2xH")
+_attr = struct.Struct("<IIQQQQQ")
+_section = struct.Struct("<QQ")
+_u32 = struct.Struct("<I")
+_u64 = struct.Struct("<Q")
+_mmap = struct.Struct("<IIQQQ")
+# MMAP2: pid, tid, address, length, offset, 24 bytes of device and inode or
+# build id, prot, flags
+_mmap2 = struct.Struct("<IIQQQ24xII")
+_pid_tid = struct.Struct("<II")
+_task = struct.Struct("<IIIIQ")
+_lost = struct.Struct("<QQ")
+_aux = struct.Struct("<QQQ")
+_auxtrace = struct.Struct("<QQQIII4x")
+
+# leading fields of samples, which have a fixed size, in file order:
+# (sample_type bit, struct format, Sample fields)
+_fixed_sample_fields = [
+    (SAMPLE_IDENTIFIER, "Q", ["id"]),
+    (SAMPLE_IP, "Q", ["ip"]),
+    (SAMPLE_TID, "II", ["pid", "tid"]),
+    (SAMPLE_TIME, "Q", ["time"]),
+    (SAMPLE_ADDR, "Q", ["address"]),
+    (SAMPLE_ID, "Q", ["id"]),
+    (SAMPLE_STREAM_ID, "Q", [None]),
+    (SAMPLE_CPU, "II", ["cpu", None]),
+    (SAMPLE_PERIOD, "Q", ["period"]),
+]
+
+# fields appended to non-sample records, if sample_id_all is set
+_sample_id_fields = [
+    (SAMPLE_TID, "II", ["pid", "tid"]),
+    (SAMPLE_TIME, "Q", ["time"]),
+    (SAMPLE_ID, "Q", ["id"]),
+    (SAMPLE_STREAM_ID, "Q", [None]),
+    (SAMPLE_CPU, "II", ["cpu", None]),
+    (SAMPLE_IDENTIFIER, "Q", ["id"]),
+]
+
+_none = (None,)
+
+# dtype of sample_batches(), fields not sampled are 0; attr is -1, if the
+# event of the sample is not known
+sample_dtype = [("attr", "i2"),
+                ("pid", "u4"),
+                ("tid", "u4"),
+                ("cpu", "u4"),
+                ("ip", "u8"),
+                ("time", "u8"),
+                ("address", "u8"),
+                ("id", "u8"),
+                ("period", "u8"),
+                # file offset of the record, see PerfData.record()
+                ("offset", "u8")]
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Error("numpy is required for sample batches of perf.data")
+    return numpy
+
+
+# Returns (struct format, offset of each field) of fields selected by
+# `sample_type`
+def _layout(sample_type, fields):
+    fmt = "<"
+    offsets = {}
+    position = 0
+    for bit, codes, names in fields:
+        if not sample_type & bit:
+            continue
+        for code, name in zip(codes, names):
+            if name is not None:
+                offsets[name] = position
+            position += struct.calcsize("<" + code)
+        fmt += codes
+    return fmt, offsets
+
+
+# Decoding of samples of one sample_type and read_format
+class _SampleLayout:
+    def __init__(self, sample_type, read_format):
+        self.sample_type = sample_type
+        fmt, self.offsets = _layout(sample_type, _fixed_sample_fields)
+        self.fixed = struct.Struct(fmt)
+        names = []
+        for bit, codes, field_names in _fixed_sample_fields:
+            if sample_type & bit:
+                names.extend(field_names)
+        # the unpacked fields are followed by None for fields not sampled,
+        # the identifier wins over a second id
+        absent = len(names)
+        indices = [names.index(f) if f in names else absent
+                   for f in Sample._fields[1:9]]
+        self.select = operator.itemgetter(*indices)
+        self.read = sample_type & SAMPLE_READ
+        self.read_format = read_format
+        self.callchain = sample_type & SAMPLE_CALLCHAIN
+        self.raw = sample_type & SAMPLE_RAW
+
+    def read_size(self, buffer, position):
+        read_format = self.read_format
+        values = 1 + bool(read_format & FORMAT_ID) \
+            + bool(read_format & FORMAT_LOST)
+        times = bool(read_format & FORMAT_TOTAL_TIME_ENABLED) \
+            + bool(read_format & FORMAT_TOTAL_TIME_RUNNING)
+        if read_format & FORMAT_GROUP:
+            nr, = _u64.unpack_from(buffer, position)
+            return 8 * (1 + times + nr * values)
+        return 8 * (times + values)
+
+
+# Offset of the time of non-sample records relative to their end, or None
+def _sample_id_time(attr):
+    if not attr.flags & ATTR_FLAG_SAMPLE_ID_ALL:
+        return None
+    fmt, offsets = _layout(attr.sample_type, _sample_id_fields)
+    if "time" not in offsets:
+        return None
+    return struct.calcsize(fmt) - offsets["time"]
+
+
+def _string(buffer, start, end):
+    nul = buffer.find(b"\0", start, end)
+    if nul < 0:
+        nul = end
+    return os.fsdecode(buffer[start:nul])
+
+
+class PerfData:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise Error("Failed to open perf data '%s': %s" % (path, e))
+        try:
+            self._read_header()
+        except (struct.error, ValueError) as e:
+            self.close()
+            raise Error("Corrupt perf data '%s': %s" % (path, e))
+        except Error:
+            self.close()
+            raise
+
+    def _read_header(self):
+        buffer = self._map
+        if len(buffer) < _file_header.size:
+            raise Error("'%s' is too short for perf data" % self.path)
+        (magic, size, attr_size,
+         attrs_offset, attrs_size,
+         self.data_offset, self.data_size,
+         _, _, features) = _file_header.unpack_from(buffer)
+        if magic == MAGIC[::-1]:
+            raise Error("Big endian perf data is not supported: '%s'"
+                        % self.path)
+        if magic != MAGIC:
+            raise Error("'%s' is not perf data" % self.path)
+        if size != _file_header.size:
+            raise Error("perf data in pipe mode is not supported: '%s'"
+                        % self.path)
+        self.features = {i for i in range(len(features) * 8)
+                         if features[i // 8] >> (i % 8) & 1}
+
+        self.attrs = []
+        for position in range(attrs_offset,
+                              attrs_offset + attrs_size,
+                              attr_size):
+            (type_, _, config, sample_period, sample_type, read_format,
+             flags) = _attr.unpack_from(buffer, position)
+            ids_offset, ids_size = \
+                _section.unpack_from(buffer, position + attr_size - 16)
+            ids = array("Q", buffer[ids_offset:ids_offset + ids_size])
+            self.attrs.append(Attr(type_, config, sample_period,
+                                   sample_type, read_format, flags,
+                                   ids.tolist(), None))
+        if not self.attrs:
+            raise Error("perf data '%s' has no events" % self.path)
+        self._read_event_desc()
+
+        # id -> index in attrs
+        self._attr_index = {}
+        for i, attr in enumerate(self.attrs):
+            for id_ in attr.ids:
+                self._attr_index[id_] = i
+        self._layouts = [_SampleLayout(a.sample_type, a.read_format)
+                         for a in self.attrs]
+        sample_types = {a.sample_type for a in self.attrs}
+        self._uniform = len(sample_types) == 1
+        if not self._uniform and \
+                not all(t & SAMPLE_IDENTIFIER for t in sample_types):
+            raise Error("perf data '%s' has events with different sample "
+                        "types without PERF_SAMPLE_IDENTIFIER" % self.path)
+        # the sample id of non-sample records is decoded with the first
+        # event, perf requires the same layout for all events
+        self._id_time = _sample_id_time(self.attrs[0])
+
+    # Feature sections follow the data, one per set feature bit
+    def _feature_section(self, feature):
+        if feature not in self.features:
+            return None
+        index = sum(1 for f in self.features if f < feature)
+        position = self.data_offset + self.data_size + index * _section.size
+        return _section.unpack_from(self._map, position)
+
+    # names of the events as given to perf record
+    def _read_event_desc(self):
+        section = self._feature_section(FEATURE_EVENT_DESC)
+        if section is None:
+            return
+        buffer = self._map
+        position, _ = section
+        nr, attr_size = struct.unpack_from("<II", buffer, position)
+        position += 8
+        for i in range(min(nr, len(self.attrs))):
+            position += attr_size
+            nr_ids, length = struct.unpack_from("<II", buffer, position)
+            position += 8
+            name = _string(buffer, position, position + length)
+            position += length + 8 * nr_ids
+            self.attrs[i] = self.attrs[i]._replace(name=name)
+
+    def close(self):
+        if self._map is None:
+            return
+        try:
+            self._map.close()
+        except BufferError:
+            # memoryviews of records are alive, the mapping is closed
+            # once they are released
+            pass
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _time(self, end):
+        if self._id_time is None:
+            return None
+        return _u64.unpack_from(self._map, end - self._id_time)[0]
+
+    def _sample(self, misc, position, end):
+        buffer = self._map
+        start = position
+        if self._uniform:
+            layout = self._layouts[0]
+        else:
+            # with different sample types the identifier comes first
+            id_, = _u64.unpack_from(buffer, position)
+            attr = self._attr_index.get(id_, -1)
+            if attr < 0:
+                return Sample(-1, None, None, None, None, None, id_, None,
+                              None, None, None)
+            layout = self._layouts[attr]
+        values = layout.fixed.unpack_from(buffer, position) + _none
+        position += layout.fixed.size
+        if layout.read:
+            position += layout.read_size(buffer, position)
+        callchain = raw = None
+        if layout.callchain:
+            nr, = _u64.unpack_from(buffer, position)
+            callchain = array("Q", buffer[position + 8:position + 8 + 8 * nr])
+            position += 8 + 8 * nr
+        if layout.raw:
+            size, = _u32.unpack_from(buffer, position)
+            raw = memoryview(buffer)[position + 4:position + 4 + size]
+            position += 4 + size
+        if position > end:
+            raise self._corrupt(start - 8)
+        fields = layout.select(values)
+        if self._uniform:
+            attr = 0 if len(self.attrs) == 1 \
+                else self._attr_index.get(fields[5], -1)
+        return Sample(attr, *fields, callchain, raw)
+
+    def _mmap(self, misc, position, end):
+        pid, tid, address, length, offset = \
+            _mmap.unpack_from(self._map, position)
+        filename = _string(self._map, position + _mmap.size, end)
+        return Mmap(pid, tid, address, length, offset, filename, None,
+                    self._time(end))
+
+    def _mmap2(self, misc, position, end):
+        pid, tid, address, length, offset, prot, _ = \
+            _mmap2.unpack_from(self._map, position)
+        filename = _string(self._map, position + _mmap2.size, end)
+        return Mmap(pid, tid, address, length, offset, filename, prot,
+                    self._time(end))
+
+    def _comm(self, misc, position, end):
+        pid, tid = _pid_tid.unpack_from(self._map, position)
+        comm = _string(self._map, position + _pid_tid.size, end)
+        return Comm(pid, tid, comm, bool(misc & MISC_COMM_EXEC),
+                    self._time(end))
+
+    def _fork(self, misc, position, end):
+        return Fork(*_task.unpack_from(self._map, position))
+
+    def _exit(self, misc, position, end):
+        return Exit(*_task.unpack_from(self._map, position))
+
+    def _lost(self, misc, position, end):
+        return Lost(*_lost.unpack_from(self._map, position),
+                    self._time(end))
+
+    def _aux(self, misc, position, end):
+        return Aux(*_aux.unpack_from(self._map, position), self._time(end))
+
+    def _itrace_start(self, misc, position, end):
+        return ItraceStart(*_pid_tid.unpack_from(self._map, position),
+                           self._time(end))
+
+    def _auxtrace(self, misc, position, end):
+        size, offset, reference, idx, tid, cpu = \
+            _auxtrace.unpack_from(self._map, position)
+        data = memoryview(self._map)[end:end + size]
+        return AuxTrace(offset, reference, idx, tid, cpu, data)
+
+    def _decoders(self, types):
+        decoders = {
+            SAMPLE: self._sample,
+            MMAP: self._mmap,
+            MMAP2: self._mmap2,
+            COMM: self._comm,
+            FORK: self._fork,
+            EXIT: self._exit,
+            LOST: self._lost,
+            AUX: self._aux,
+            ITRACE_START: self._itrace_start,
+            AUXTRACE: self._auxtrace,
+        }
+        if types is None:
+            return decoders
+        return {t: d for t, d in decoders.items() if t in types}
+
+    def _data_range(self):
+        start = self.data_offset
+        return start, min(start + self.data_size, len(self._map))
+
+    def _corrupt(self, position):
+        return Error("Corrupt record at offset %d of '%s'"
+                     % (position, self.path))
+
+    # Returns the offset of the record after the record at `position`,
+    # which must be within the data section
+    def _next_record(self, type_, position, size, end):
+        next_ = position + size
+        if size < 8 or next_ > end:
+            raise self._corrupt(position)
+        if type_ == AUXTRACE:
+            # the data follows the record
+            if size < 16:
+                raise self._corrupt(position)
+            next_ += _u64.unpack_from(self._map, position + 8)[0]
+            if next_ > end:
+                raise self._corrupt(position)
+        return next_
+
+    # Yields the decoded records of `types` (record type numbers, all
+    # decoded ones by default) in file order
+    def records(self, types=None):
+        get = self._decoders(types).get
+        buffer = self._map
+        unpack = _event_header.unpack_from
+        position, end = self._data_range()
+        while position + 8 <= end:
+            type_, misc, size = unpack(buffer, position)
+            next_ = self._next_record(type_, position, size, end)
+            decode = get(type_)
+            if decode is not None:
+                try:
+                    record = decode(misc, position + 8, position + size)
+                except struct.error:
+                    # the record is shorter than its fields
+                    raise self._corrupt(position)
+                yield record
+            position = next_
+
+    def samples(self):
+        return self.records((SAMPLE,))
+
+    # Decodes the record at file `offset`, e.g. the offset of a sample of
+    # sample_batches() to read its callchain
+    def record(self, offset):
+        start, end = self._data_range()
+        if offset < start or offset + 8 > end:
+            raise self._corrupt(offset)
+        type_, misc, size = _event_header.unpack_from(self._map, offset)
+        self._next_record(type_, offset, size, end)
+        decode = self._decoders(None).get(type_)
+        if decode is None:
+            return None
+        try:
+            return decode(misc, offset + 8, offset + size)
+        except struct.error:
+            raise self._corrupt(offset)
+
+    # Yields samples as numpy structured arrays of `sample_dtype` with up to
+    # `batch_size` samples. Only record headers are read in Python, fields
+    # are gathered with numpy.
+    def sample_batches(self, batch_size=65536):
+        numpy = _import_numpy()
+        raw = numpy.frombuffer(self._map, dtype=numpy.uint8)
+        words = numpy.frombuffer(self._map, dtype="<u8",
+                                 count=len(self._map) // 8)
+        offsets = array("Q")
+        append = offsets.append
+        count = 0
+        buffer = self._map
+        unpack = _type_size.unpack_from
+        position, end = self._data_range()
+        last = end - 8
+        # the loop runs per record and only does what it must
+        while position <= last:
+            type_, size = unpack(buffer, position)
+            if size < 8 or position + size > end:
+                raise self._corrupt(position)
+            if type_ == SAMPLE:
+                append(position)
+                count += 1
+                if count == batch_size:
+                    yield self._sample_batch(numpy, raw, words, offsets)
+                    offsets = array("Q")
+                    append = offsets.append
+                    count = 0
+            elif type_ == AUXTRACE:
+                position = self._next_record(type_, position, size, end)
+                continue
+            position += size
+        if offsets:
+            yield self._sample_batch(numpy, raw, words, offsets)
+        # the arrays export the mapping, which could not be closed otherwise
+        del raw, words
+
+    def _sample_batch(self, numpy, raw, words, offsets):
+        offsets = numpy.frombuffer(offsets, dtype=numpy.uint64)
+        batch = numpy.zeros(len(offsets), dtype=sample_dtype)
+        batch["offset"] = offsets
+        bodies = offsets.astype(numpy.int64) + _event_header.size
+        sizes = raw[bodies - 2] | raw[bodies - 1].astype(numpy.uint16) << 8
+
+        # samples must be long enough for the fields that are gathered
+        def check(size, mask=None):
+            short = sizes < _event_header.size + size
+            if mask is not None:
+                short &= mask
+            short = numpy.flatnonzero(short)
+            if len(short):
+                raise self._corrupt(int(offsets[short[0]]))
+
+        def gather(positions, dtype):
+            dtype = numpy.dtype(dtype)
+            size = dtype.itemsize
+            if size in (4, 8) and not (positions % size).any():
+                # records are 8-byte aligned in files written by perf
+                values = words[positions >> 3]
+                if size == 4:
+                    shifts = ((positions & 4) << 3).astype(numpy.uint64)
+                    values = (values >> shifts) & 0xffffffff
+                return values.astype(dtype)
+            index = positions[:, None] + numpy.arange(size)
+            return raw[index].view(dtype).reshape(-1)
+
+        def attrs_of(ids):
+            known = numpy.array(sorted(self._attr_index), dtype=numpy.uint64)
+            if not len(known):
+                return numpy.full(len(ids), -1, dtype=numpy.int16)
+            indices = numpy.array([self._attr_index[i]
+                                   for i in known.tolist()],
+                                  dtype=numpy.int16)
+            found = numpy.minimum(numpy.searchsorted(known, ids),
+                                  len(known) - 1)
+            return numpy.where(known[found] == ids, indices[found], -1)
+
+        layouts = self._layouts
+        if self._uniform:
+            groups = [(layouts[0], bodies, None)]
+        else:
+            # with different sample types the identifier comes first
+            check(8)
+            ids = gather(bodies, "<u8")
+            batch["id"] = ids
+            batch["attr"] = attrs = attrs_of(ids)
+            groups = []
+            for sample_type in {a.sample_type for a in self.attrs}:
+                same = [i for i, a in enumerate(self.attrs)
+                        if a.sample_type == sample_type]
+                mask = numpy.isin(attrs, same)
+                if mask.any():
+                    groups.append((layouts[same[0]], bodies[mask], mask))
+
+        for layout, positions, mask in groups:
+            check(layout.fixed.size, mask)
+            for name, offset in layout.offsets.items():
+                values = gather(positions + offset,
+                                batch.dtype[name].newbyteorder("<"))
+                if mask is None:
+                    batch[name] = values
+                else:
+                    batch[name][mask] = values
+        if self._uniform and len(self.attrs) > 1:
+            if "id" in layouts[0].offsets:
+                batch["attr"] = attrs_of(batch["id"])
+            else:
+                batch["attr"] = -1
+        return batch
@@ -1,7 +1,12 @@
 import os
-import multiprocessing as mp
+import asyncio
+import functools
+import itertools
 from . import cgroups, perf, tthread
 
+# numbers cgroups of concurrent runs
+_runs = itertools.count()
+
 
 def default_tthread_path():
     script_dir = os.path.dirname(__file__)
@@ -19,9 +24,10 @@ def run(command,
         snapshot_mode=False,
         additional_cgroups=[],
         perf_event_cgroup=None,
-        env={}):
+        env={},
+        enabled=True):
 
-    cgroup_name = "inspector-%d" % os.getpid()
+    cgroup_name = "inspector-%d-%d" % (os.getpid(), next(_runs))
 
     if perf_event_cgroup is None:
         perf_event_cgroup = cgroups.perf_event(cgroup_name)
@@ -30,23 +36,41 @@ def run(command,
     else:
         remove_cgroup = False
 
-    additional_cgroups.append(perf_event_cgroup)
+    additional_cgroups = list(additional_cgroups) + [perf_event_cgroup]
 
-    barrier = mp.Barrier(2)
     tthread_cmd = tthread.Command(tthread_path=tthread_path,
                                   user=user,
                                   group=group,
                                   cgroups=additional_cgroups,
                                   env=env)
-    process = mp.Process(target=tthread_cmd.exec,
-                         args=(command, barrier,))
-    process.start()
 
     return perf.run(perf_command,
                     perf_log,
-                    barrier,
-                    process,
+                    functools.partial(tthread_cmd.start, command),
                     perf_event_cgroup,
                     processor_trace=processor_trace,
                     snapshot_mode=snapshot_mode,
-                    remove_cgroup=remove_cgroup)
+                    remove_cgroup=remove_cgroup,
+                    enabled=enabled)
+
+
+def _kill_started(start):
+    if not start.cancelled() and start.exception() is None:
+        start.result().kill()
+
+
+# Runs `command` like run() and waits for it without blocking the event loop,
+# returns a perf.Status. Many commands can run concurrently, each needs its
+# own perf_log. On timeout (asyncio.TimeoutError) or cancellation the
+# command is killed and perf is stopped, so its log is complete.
+async def run_async(command, timeout=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    # run() blocks until perf is ready
+    start = loop.run_in_executor(None,
+                                 functools.partial(run, command, **kwargs))
+    try:
+        process = await asyncio.shield(start)
+    except asyncio.CancelledError:
+        start.add_done_callback(_kill_started)
+        raise
+    return await asyncio.wait_for(process.wait_async(), timeout)
@@ -1,29 +1,79 @@
 import os
-import sys
 import pwd
 import grp
-from threading import BrokenBarrierError
+import shutil
+import subprocess
+import tempfile
 
 from . import Error
 
 
-def drop_privileges(user, group):
+# Resolves user and group to (uid, gid) in the parent, the child must not
+# look up names after fork.
+def resolve_ids(user, group):
+    if user is None and group is None:
+        return None, None
     if os.getuid() != 0:
         raise Error("Must run as root to drop priviliges")
 
-    if type(group) is int:
-        os.setgid(group)
-    elif group is not None:
-        os.setgid(grp.getgrnam(group).gr_gid)
+    try:
+        if type(group) is int or group is None:
+            gid = group
+        else:
+            gid = grp.getgrnam(group).gr_gid
 
-    # Remove group privileges
-    if user is not None or group is not None:
-        os.setgroups([])
+        if type(user) is int or user is None:
+            uid = user
+        else:
+            uid = pwd.getpwnam(user).pw_uid
+    except KeyError as e:
+        raise Error("Unknown user or group: %s" % e)
+    return uid, gid
 
-    if type(user) is int:
-        os.setuid(user)
-    elif user is not None:
-        os.setuid(pwd.getpwnam(user).pw_uid)
+
+# Started instead of the command: waits for the go signal of the parent on a
+# fifo, which it writes after it added the shim to the cgroups, then executes
+# the command (its arguments) in place. So the command keeps the pid of the
+# shim and runs in the cgroups from its first instruction. The fifo is only
+# open while waiting, the command inherits no descriptor of it. The preload
+# library is passed in INSPECTOR_PRELOAD, so it is not loaded into the shell.
+_shim = """
+read go < "$INSPECTOR_GO" && [ "$go" = go ] || exit 126
+unset INSPECTOR_GO
+if [ -n "${INSPECTOR_PRELOAD+x}" ]; then
+    export LD_PRELOAD="$INSPECTOR_PRELOAD"
+    unset INSPECTOR_PRELOAD
+fi
+exec "$@"
+"""
+
+
+# Go signal of the shim. The fifo is opened read-write, so opening never
+# blocks and the shim can open it, before the signal is sent.
+class _Go:
+    def __init__(self, uid, gid):
+        self.directory = tempfile.mkdtemp(prefix="inspector-go-")
+        self.path = os.path.join(self.directory, "go")
+        try:
+            os.mkfifo(self.path, 0o600)
+            if uid is not None or gid is not None:
+                # the shim runs with the dropped privileges
+                os.chmod(self.directory, 0o711)
+                os.chown(self.path,
+                         -1 if uid is None else uid,
+                         -1 if gid is None else gid)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CLOEXEC)
+        except OSError as e:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            raise Error("Failed to create fifo for the go signal: %s" % e)
+
+    def send(self):
+        os.write(self.fd, b"go\n")
+
+    # without the signal the shim exits
+    def close(self):
+        os.close(self.fd)
+        shutil.rmtree(self.directory, ignore_errors=True)
 
 
 class Command():
@@ -39,19 +89,57 @@ class Command():
         self.cgroups = cgroups
         self.env = env
 
-    def exec(self, command, barrier):
+    # Starts `command` in the cgroups, returns its subprocess.Popen.
+    # Privileges are dropped by Popen. Popen runs no code of ours between
+    # fork and exec, unless it is given a preexec_fn, which is unsafe with
+    # threads. So the command is started through the shim (see above): the
+    # procs files of the cgroups are opened before, the shim is added to
+    # them through these descriptors and then released. Commands can be
+    # started from several threads.
+    def start(self, command):
         env = os.environ.copy()
         env.update(self.env)
         if self.tthread_path is not None:
-            env["LD_PRELOAD"] = str(self.tthread_path)
+            env["INSPECTOR_PRELOAD"] = str(self.tthread_path)
             env["TTHREAD_NO_LOG"] = "1"
             env["TTHREAD_NO_MMAP_PROTECT"] = "1"
             env["LD_BIND_NOW"] = "1"
+        uid, gid = resolve_ids(self.user, self.group)
+        ids = {}
+        if uid is not None or gid is not None:
+            # Remove group privileges
+            ids = dict(user=uid, group=gid, extra_groups=[])
+
+        # the shim reports a missing command only with its exit code
+        if shutil.which(command[0], path=env.get("PATH")) is None:
+            raise Error("Failed to start '%s': command not found or not "
+                        "executable" % command[0])
+
+        procs = []
+        go = None
         try:
-            barrier.wait(timeout=3)
-        except BrokenBarrierError:
-            print("Parent process timed out", file=sys.stderr)
-        for cgroup in self.cgroups:
-            cgroup.addPids(os.getpid())
-        drop_privileges(self.user, self.group)
-        os.execvpe(command[0], command, env)
+            for cgroup in self.cgroups or []:
+                procs.append(cgroup.open_procs())
+            go = _Go(uid, gid)
+            env["INSPECTOR_GO"] = go.path
+            shim = ["/bin/sh", "-c", _shim, "inspector-shim"]
+            try:
+                process = subprocess.Popen(shim + list(command),
+                                           env=env,
+                                           **ids)
+            except (OSError, subprocess.SubprocessError) as e:
+                raise Error("Failed to start '%s': %s" % (command[0], e))
+            try:
+                for fd, cgroup in zip(procs, self.cgroups):
+                    cgroup.join(fd, process.pid)
+                go.send()
+            except (Error, OSError) as e:
+                process.kill()
+                process.wait()
+                raise Error("Failed to start '%s': %s" % (command[0], e))
+        finally:
+            if go is not None:
+                go.close()
+            for fd in procs:
+                os.close(fd)
+        return process
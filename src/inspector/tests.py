@@ -1,8 +1,15 @@
 import os
+import asyncio
+import struct
 import unittest
 import tempfile
 import inspector
-from inspector import cgroups
+from inspector import cgroups, perfdata, tthread
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 TEST_ROOT = os.path.realpath(os.path.dirname(__file__))
 
@@ -12,10 +19,166 @@ class CgroupTest(unittest.TestCase):
         with cgroups.perf_event("inspector-test") as c:
             pid = str(os.getpid())
             c.addPids(pid)
-            f = open(os.path.join(c.mountpoint, "tasks"))
-            line = f.readline()
-            f.close()
-            self.assertEqual(pid + "\n", line)
+            self.assertEqual([pid], c.pids())
+
+    def test_usage(self):
+        name = "inspector-test-usage"
+        with cgroups.cpuacct(name) as cpu, cgroups.memory(name) as memory:
+            # joins before exec, memory is not moved with a process
+            command = tthread.Command(cgroups=[cpu, memory])
+            process = command.start(["sleep", "0.1"])
+            process.wait()
+            usage = cgroups.usage(cpu, memory)
+            self.assertGreaterEqual(usage.user_time, 0)
+            self.assertGreaterEqual(usage.system_time, 0)
+            if usage.memory_peak is not None:
+                self.assertGreater(usage.memory_peak, 0)
+
+
+# sample_id of non-sample records: tid, time, cpu, identifier
+def sample_id(time, id_):
+    return struct.pack("<IIQIIQ", 5, 5, time, 1, 0, id_)
+
+
+# NUL terminated and padded, so a sample_id is at the end of the record
+def string(s):
+    s += b"\0"
+    return s + b"\0" * (-len(s) % 8)
+
+
+def record(type_, body, misc=0):
+    body += b"\0" * (-len(body) % 8)
+    return struct.pack("<IHH", type_, misc, 8 + len(body)) + body
+
+
+# writes a perf.data with an Intel PT and a tracepoint event
+def write_perf_data(f):
+    id_all = perfdata.SAMPLE_IDENTIFIER | perfdata.SAMPLE_IP \
+        | perfdata.SAMPLE_TID | perfdata.SAMPLE_TIME | perfdata.SAMPLE_CPU
+    attrs = [(8, id_all, [10]),
+             (2, id_all | perfdata.SAMPLE_PERIOD | perfdata.SAMPLE_CALLCHAIN
+              | perfdata.SAMPLE_RAW, [20, 21])]
+    attr_size = 112
+    attrs_offset = 104
+    ids_offset = attrs_offset + len(attrs) * (attr_size + 16)
+    attr_data = ids_data = b""
+    for type_, sample_type, ids in attrs:
+        attr = struct.pack("<IIQQQQQ", type_, attr_size, 0, 1, sample_type,
+                           0, perfdata.ATTR_FLAG_SAMPLE_ID_ALL)
+        attr += b"\0" * (attr_size - len(attr))
+        attr_data += attr + struct.pack("<QQ",
+                                        ids_offset + len(ids_data),
+                                        8 * len(ids))
+        ids_data += struct.pack("<%dQ" % len(ids), *ids)
+
+    data = record(perfdata.COMM,
+                  struct.pack("<II", 5, 5) + string(b"usage-test")
+                  + sample_id(100, 10), misc=perfdata.MISC_COMM_EXEC)
+    data += record(perfdata.MMAP2,
+                   struct.pack("<IIQQQ24xII", 5, 5, 0x400000, 0x1000, 0, 5, 2)
+                   + string(b"/bin/usage-test") + sample_id(101, 10))
+    data += record(perfdata.SAMPLE,
+                   struct.pack("<QQIIQIIQQQQI", 21, 0x401000, 5, 5, 102, 1, 0,
+                               3, 2, 0x401000, 0x400500, 4) + b"raw!")
+    data += record(perfdata.AUX, struct.pack("<QQQ", 0, 16, 0)
+                   + sample_id(103, 10))
+    data += record(perfdata.AUXTRACE,
+                   struct.pack("<QQQIII4x", 16, 0, 7, 0, 5, 1)) + b"pt" * 8
+    data += record(perfdata.SAMPLE,
+                   struct.pack("<QQIIQII", 10, 0x401004, 5, 5, 104, 1, 0))
+    data += record(perfdata.FINISHED_ROUND, b"")
+
+    data_offset = ids_offset + len(ids_data)
+    features_offset = data_offset + len(data)
+    desc = struct.pack("<II", len(attrs), attr_size)
+    for name, (_, _, ids) in zip([b"intel_pt//u", b"signal:signal_generate"],
+                                 attrs):
+        name += b"\0" * (8 - len(name) % 8)
+        desc += b"\0" * attr_size + struct.pack("<II", len(ids), len(name)) \
+            + name + struct.pack("<%dQ" % len(ids), *ids)
+    features = bytearray(32)
+    features[perfdata.FEATURE_EVENT_DESC // 8] = \
+        1 << perfdata.FEATURE_EVENT_DESC % 8
+    f.write(struct.pack("<8sQQQQQQQQ32s", perfdata.MAGIC, 104,
+                        attr_size + 16, attrs_offset, len(attr_data),
+                        data_offset, len(data), 0, 0, bytes(features)))
+    f.write(attr_data + ids_data + data)
+    f.write(struct.pack("<QQ", features_offset + 16, len(desc)) + desc)
+    f.flush()
+
+
+class PerfDataTest(unittest.TestCase):
+    def test_records(self):
+        with tempfile.NamedTemporaryFile() as f:
+            write_perf_data(f)
+            with perfdata.PerfData(f.name) as data:
+                self.assertEqual(["intel_pt//u", "signal:signal_generate"],
+                                 [a.name for a in data.attrs])
+                records = list(data.records())
+                comm, mmap, sample, aux, auxtrace, pt_sample = records
+                self.assertEqual(perfdata.Comm(5, 5, "usage-test", True, 100),
+                                 comm)
+                self.assertEqual("/bin/usage-test", mmap.filename)
+                self.assertEqual((0x400000, 0x1000, 5, 101),
+                                 (mmap.address, mmap.length, mmap.prot,
+                                  mmap.time))
+                self.assertEqual((1, 0x401000, 102, 1, 3),
+                                 (sample.attr, sample.ip, sample.time,
+                                  sample.cpu, sample.period))
+                self.assertEqual([0x401000, 0x400500],
+                                 list(sample.callchain))
+                self.assertEqual(b"raw!", bytes(sample.raw))
+                self.assertEqual(perfdata.Aux(0, 16, 0, 103), aux)
+                self.assertEqual(b"pt" * 8, bytes(auxtrace.data))
+                self.assertEqual((0, 0x401004, None),
+                                 (pt_sample.attr, pt_sample.ip,
+                                  pt_sample.period))
+                self.assertEqual([1, 0], [s.attr for s in data.samples()])
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_sample_batches(self):
+        with tempfile.NamedTemporaryFile() as f:
+            write_perf_data(f)
+            with perfdata.PerfData(f.name) as data:
+                batches = list(data.sample_batches(batch_size=1))
+                self.assertEqual(2, len(batches))
+                batch = numpy.concatenate(batches)
+                self.assertEqual([1, 0], batch["attr"].tolist())
+                self.assertEqual([0x401000, 0x401004], batch["ip"].tolist())
+                self.assertEqual([102, 104], batch["time"].tolist())
+                self.assertEqual([3, 0], batch["period"].tolist())
+                self.assertEqual([21, 10], batch["id"].tolist())
+                sample = data.record(int(batch["offset"][0]))
+                self.assertEqual([0x401000, 0x400500],
+                                 list(sample.callchain))
+
+    # overwrites the data section `offset` bytes before its end
+    def assertCorrupt(self, offset, data):
+        with tempfile.NamedTemporaryFile() as f:
+            write_perf_data(f)
+            with perfdata.PerfData(f.name) as perf:
+                end = perf.data_offset + perf.data_size
+            f.seek(end - offset)
+            f.write(data)
+            f.flush()
+            with perfdata.PerfData(f.name) as perf:
+                with self.assertRaises(perfdata.Error):
+                    list(perf.records())
+                if numpy is not None:
+                    with self.assertRaises(perfdata.Error):
+                        list(perf.sample_batches())
+
+    def test_truncated(self):
+        # the FINISHED_ROUND record ends after the data section
+        self.assertCorrupt(8 - 6, struct.pack("<H", 16))
+        # the AUXTRACE data ends after the data section
+        self.assertCorrupt(120 - 8, struct.pack("<Q", 128))
+
+    def test_short_record(self):
+        # the last SAMPLE is shorter than its fixed fields
+        sample = record(perfdata.SAMPLE, struct.pack("<QQ", 10, 0))
+        self.assertCorrupt(56, sample
+                           + record(perfdata.FINISHED_ROUND, bytes(24)))
 
 
 def perf_cmd():
@@ -47,5 +210,53 @@ class PerfTest(unittest.TestCase):
             status = process.wait()
             self.assertEqual(0, status.exit_code)
 
+    def test_run_missing_command(self):
+        with tempfile.NamedTemporaryFile() as log_file:
+            with self.assertRaises(inspector.Error):
+                inspector.run(["/nonexistent"],
+                              perf_command=perf_cmd(),
+                              perf_log=log_file.name,
+                              processor_trace=False)
+
+    def test_enable(self):
+        sample_app = os.path.join(TEST_ROOT, "../../test/usage-test")
+
+        with tempfile.NamedTemporaryFile() as log_file:
+            process = inspector.run([sample_app],
+                                    perf_command=perf_cmd(),
+                                    perf_log=log_file.name,
+                                    processor_trace=False,
+                                    enabled=False)
+            process.enable()
+            process.disable()
+            status = process.wait()
+            self.assertEqual(0, status.exit_code)
+
+    def test_run_async(self):
+        sample_app = os.path.join(TEST_ROOT, "../../test/usage-test")
+
+        async def run_all(logs):
+            runs = [inspector.run_async([sample_app],
+                                        perf_command=perf_cmd(),
+                                        perf_log=log.name,
+                                        processor_trace=False)
+                    for log in logs]
+            return await asyncio.gather(*runs)
+
+        with tempfile.NamedTemporaryFile() as a, \
+                tempfile.NamedTemporaryFile() as b:
+            for status in asyncio.run(run_all([a, b])):
+                self.assertEqual(0, status.exit_code)
+                self.assertEqual(-15, status.perf_exit_code)
+
+        with tempfile.NamedTemporaryFile() as log_file:
+            run = inspector.run_async(["sleep", "10"],
+                                      timeout=0.5,
+                                      perf_command=perf_cmd(),
+                                      perf_log=log_file.name,
+                                      processor_trace=False)
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(run)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,126 @@
 #!/usr/bin/env python3
 
+import array
+import collections
+import gzip
+import io
+import json
 import os
+import sqlite3
+import struct
+import tempfile
 import unittest
 import tthread
+from tthread import accesslog, analysis, arrayfile, columnar, diff, formats
+from tthread import logindex, output, parallel, regions, serialization, sqlite
+from tthread import stats
+from tthread import provenance, symbols
 
 TEST_ROOT = os.path.realpath(os.path.dirname(__file__))
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+GLOBAL = (0x600000, 0x700000)
+HEAP = (0x100000000, 0x200000000)
+
+# (type, return_address, thread_id, address/id)
+SAMPLE_EVENTS = [
+    (accesslog.WRITE, 0x400100, 10, HEAP[0] + 0x10),
+    (accesslog.THUNK, 0x400200, 10, 1),
+    (accesslog.READ, 0x400300, 11, GLOBAL[0] + 0x2000),
+    (accesslog.WRITE, 0x400300, 11, 0x7f0000001000),
+    (accesslog.THUNK, 0x400200, 11, 1),
+    (accesslog.WRITE, 0x400400, 10, HEAP[0] + 0x5000),
+    (accesslog.FINISH, 0x400500, 11, 0),
+    (accesslog.FINISH, 0x400500, 10, 0),
+]
+
+
+def write_log(events):
+    f = tempfile.TemporaryFile()
+    header_size = 4096
+    header = struct.pack(accesslog.Header.fmt,
+                         accesslog.log_file_magic,
+                         1,
+                         header_size,
+                         len(events),
+                         GLOBAL[0], GLOBAL[1],
+                         HEAP[0], HEAP[1])
+    f.write(header.ljust(header_size, b"\0"))
+    for event in events:
+        f.write(struct.pack(accesslog.raw_event_fmt, *event))
+    f.seek(0)
+    return accesslog.Log(0, f)
+
+
+def varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+# encodes the events of one thread as version 2 block
+def encode_block(events, continued=False):
+    records = bytearray()
+    cache = [0] * accesslog.RETURN_ADDRESS_SLOTS
+    last = 0
+    for type_, return_address, _, payload in events:
+        slot = accesslog.return_address_slot(return_address)
+        if cache[slot] == return_address:
+            records += bytes([type_ | accesslog.RETURN_ADDRESS_CACHED, slot])
+        else:
+            records += bytes([type_]) + varint(return_address)
+            cache[slot] = return_address
+        if type_ in (accesslog.WRITE, accesslog.READ):
+            records += varint(zigzag(payload - last) & ((1 << 64) - 1))
+            last = payload
+        elif type_ == accesslog.THUNK:
+            records += varint(zigzag(payload))
+    size = accesslog.block_header_size + len(records)
+    flags = accesslog.BLOCK_CONTINUED if continued else 0
+    return struct.pack(accesslog.block_header_fmt,
+                       size,
+                       events[0][2],
+                       len(events) | flags) + records
+
+
+# splits events into blocks of consecutive events of the same thread, the
+# blocks ending at the indices in `continued` are marked as continued
+def write_compact_log(events, continued=()):
+    blocks = []
+    for i, event in enumerate(events):
+        if blocks and blocks[-1][-1][2] == event[2] \
+                and i - 1 not in continued:
+            blocks[-1].append(event)
+        else:
+            blocks.append([event])
+    ends = [sum(map(len, blocks[:i + 1])) - 1 for i in range(len(blocks))]
+    data = b"".join(encode_block(b, end in continued)
+                    for b, end in zip(blocks, ends))
+    f = tempfile.TemporaryFile()
+    header = struct.pack(accesslog.HeaderV2.fmt,
+                         accesslog.log_file_magic,
+                         accesslog.COMPACT_VERSION,
+                         4096,
+                         len(events),
+                         GLOBAL[0], GLOBAL[1],
+                         HEAP[0], HEAP[1],
+                         len(data))
+    f.write(header.ljust(4096, b"\0"))
+    f.write(data)
+    f.seek(0)
+    return accesslog.Log(0, f)
+
 
 class TthreadTest(unittest.TestCase):
     def test_accesslog(self):
@@ -29,5 +144,735 @@ class TthreadTest(unittest.TestCase):
         self.assertGreater(ev.thread_id, 0)
         log.close()
 
+    def test_read(self):
+        log = write_log(SAMPLE_EVENTS)
+        events = list(log.read())
+        self.assertEqual(len(events), len(SAMPLE_EVENTS))
+        self.assertIsInstance(events[1], accesslog.ThunkEvent)
+        self.assertEqual(events[1].id, 1)
+        self.assertTrue(log.is_heap(events[0].address))
+        self.assertTrue(log.is_global(events[2].address))
+        self.assertTrue(log.is_mmap(events[3].address))
+        log.close()
+
+    def test_iter_batches(self):
+        log = write_log(SAMPLE_EVENTS)
+        batches = list(log.iter_batches(batch_size=3))
+        self.assertEqual([len(b) for b in batches], [3, 3, 2])
+        self.assertEqual([b.start for b in batches], [0, 3, 6])
+        self.assertEqual(list(batches[1].writes.payload),
+                         [0x7f0000001000, HEAP[0] + 0x5000])
+        self.assertEqual(list(batches[1].thunks.thread_id), [11])
+        self.assertEqual(len(batches[2].reads.payload), 0)
+        events = list(log.iter_batches(start=2, stop=4))[0].events()
+        self.assertEqual([type(e) for e in events],
+                         [accesslog.ReadEvent, accesslog.WriteEvent])
+        log.close()
+
+    def test_filter(self):
+        log = write_log(SAMPLE_EVENTS)
+        events = list(log.read(types=[accesslog.WRITE], spaces=["heap"]))
+        self.assertEqual([e.address for e in events],
+                         [HEAP[0] + 0x10, HEAP[0] + 0x5000])
+        events = list(log.read(threads=[11], spaces=["global", "mmap"]))
+        self.assertEqual([e.address for e in events],
+                         [GLOBAL[0] + 0x2000, 0x7f0000001000])
+        events = list(log.read(address_range=(HEAP[0], HEAP[0] + 0x1000)))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(list(log.read(threads=[12])), [])
+        f = accesslog.Filter(types=[accesslog.THUNK])
+        batches = list(log.iter_batches(batch_size=3, filter=f))
+        self.assertEqual([list(b.thread_id) for b in batches], [[10], [11]])
+        with self.assertRaises(accesslog.Error):
+            accesslog.Filter(spaces=["stack"])
+        addresses = [HEAP[0], HEAP[1], GLOBAL[0], GLOBAL[1] + 1, 0]
+        self.assertEqual(accesslog.classify_spaces(addresses,
+                                                   log._read_header()),
+                         bytes([0, 0, 1, 2, 2]))
+        events = list(log.read(thunks=[(10, 1), (11, 0)]))
+        self.assertEqual([(e.thread_id, type(e)) for e in events],
+                         [(10, accesslog.ThunkEvent),
+                          (11, accesslog.ReadEvent),
+                          (11, accesslog.WriteEvent),
+                          (10, accesslog.WriteEvent),
+                          (10, accesslog.FinishEvent)])
+        # the thunk of thread 10 started before the first batch
+        f = accesslog.Filter(types=[accesslog.WRITE], thunks=[(10, 1)])
+        batches = list(log.iter_batches(start=3, filter=f))
+        self.assertEqual([list(b.payload) for b in batches],
+                         [[HEAP[0] + 0x5000]])
+        log.close()
+
+    def test_log_index(self):
+        log = write_log(SAMPLE_EVENTS)
+        self.assertIsNone(log.path)
+        index = logindex.LogIndex.build(log, checkpoint_interval=3)
+        self.assertEqual(index.threads(), [10, 11])
+        self.assertEqual(index.thread_ranges(11), [(2, 7)])
+        self.assertEqual(index.thunk_range(10, 1), (1, 8))
+        self.assertEqual(index.thunk_range(11, 0), (2, 4))
+        self.assertEqual(index.type_counts(log, 2, 7),
+                         [0, 2, 1, 1, 1])
+        with self.assertRaises(accesslog.Error):
+            index.thunk_range(10, 2)
+        with self.assertRaises(accesslog.Error):
+            index.thunk_range(10, -1)
+        self.assertEqual(index.runs[10][1].typecode, "Q")
+
+        events = list(log.events_in_thunk(10, 1))
+        self.assertEqual([type(e) for e in events],
+                         [accesslog.ThunkEvent,
+                          accesslog.WriteEvent,
+                          accesslog.FinishEvent])
+        self.assertEqual([e.thread_id for e in log.events_for_thread(11)],
+                         [11] * 4)
+        self.assertEqual([e.address for e in log.slice(2, 4)],
+                         [GLOBAL[0] + 0x2000, 0x7f0000001000])
+        self.assertEqual(log.type_counts()[accesslog.WRITE], 3)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log")
+            log.file.seek(0)
+            with open(path, "wb") as f:
+                f.write(log.file.read())
+            with open(path, "rb") as f:
+                stored = accesslog.Log(0, f)
+                # queries do not write the index
+                thunk = accesslog.Filter(types=[accesslog.WRITE],
+                                         thunks=[(10, 1)])
+                batches = list(stored.iter_batches(start=3, filter=thunk))
+                self.assertEqual([list(b.payload) for b in batches],
+                                 [[HEAP[0] + 0x5000]])
+                stored.index()
+                self.assertFalse(os.path.exists(path + ".idx"))
+                stored.index(save=True)
+                self.assertTrue(os.path.exists(path + ".idx"))
+            with open(path, "rb") as f:
+                stored = accesslog.Log(0, f)
+                index = logindex.load_sidecar(path, stored._read_header())
+                self.assertEqual(index.thunks, log.index().thunks)
+                self.assertEqual(index.runs, log.index().runs)
+                # only arrays are read, anything else is rebuilt
+                with open(path + ".idx", "wb") as idx:
+                    idx.write(b"\x80\x04N.")
+                header = stored._read_header()
+                self.assertIsNone(logindex.load_sidecar(path, header))
+        log.close()
+
+    def test_log_path(self):
+        log = write_log(SAMPLE_EVENTS)
+        log.file.seek(0)
+        data = log.file.read()
+        log.close()
+        with tempfile.TemporaryDirectory() as directory:
+            log_file, maps_file = tthread._open_log(log_dir=directory)
+            path = log_file.name
+            self.assertEqual(os.path.dirname(path), directory)
+            # preallocated space after the events is ignored
+            log_file.write(data + bytes(8192))
+            maps_file.write(b"00400000-00401000 r-xp 0 00:00 0 /bin/t\n")
+            log_file.close()
+            maps_file.close()
+
+            stored = accesslog.Log.open(path)
+            self.assertEqual(stored.path, path)
+            self.assertEqual([e.thread_id for e in stored.read()],
+                             [e[2] for e in SAMPLE_EVENTS])
+            self.assertEqual(len(stored.memory_map()), 1)
+            stored.close()
+            with self.assertRaises(accesslog.Error):
+                accesslog.Log.open(os.path.join(directory, "missing"))
+
+    def test_run_many(self):
+        # without libtthread, only scheduling and exit status are tested
+        commands = [["sh", "-c", "sleep 0.2; exit 3"],
+                    ["true"],
+                    ["false"]]
+        results = list(tthread.run_many(commands,
+                                        max_workers=2,
+                                        tthread_path=""))
+        self.assertEqual([r.index for r in results], [1, 2, 0])
+        self.assertEqual([r.return_code for r in results], [0, 1, 3])
+        self.assertGreaterEqual(results[2].wall_time, 0.2)
+        self.assertIs(results[2].command, commands[0])
+        for result in results:
+            result.log.close()
+
+        results = []
+        tthread.run_many([["true"]] * 3, callback=results.append,
+                         min_memory=0, tthread_path="")
+        self.assertEqual(sorted(r.index for r in results), [0, 1, 2])
+        for result in results:
+            result.log.close()
+        with self.assertRaises(tthread.Error):
+            tthread.run_many(commands, max_workers=0)
+
+    def test_diff(self):
+        log = write_log(SAMPLE_EVENTS)
+        # other process ids
+        renumbered = [(t, r, tid + 100, p) for t, r, tid, p in SAMPLE_EVENTS]
+        other = write_log(renumbered)
+        self.assertEqual(diff.diff(log, other), [])
+        self.assertEqual(diff.fingerprint(log), diff.fingerprint(other))
+        other.close()
+
+        # the second thunk of thread 10 writes another page
+        changed = list(SAMPLE_EVENTS)
+        changed[5] = (accesslog.WRITE, 0x400400, 10, HEAP[0] + 0x6000)
+        other = write_log(changed)
+        divergences = diff.diff(log, other)
+        self.assertEqual(len(divergences), 1)
+        divergence = divergences[0]
+        self.assertEqual((divergence.thread, divergence.position), (0, 1))
+        self.assertEqual((divergence.a.thunk_id, divergence.a.start), (1, 1))
+        self.assertNotEqual(divergence.a.digest, divergence.b.digest)
+        self.assertIn("thread 0, thunk #1", str(divergence))
+        other.close()
+
+        # the mmap page is at another address in a mapping of the same file
+        maps = "%x-%x rw-p 00002000 08:01 42 /tmp/data\n"
+        log.maps_file = io.BytesIO(maps.encode() % (0x7f0000000000,
+                                                    0x7f0000004000))
+        moved = [(t, r, tid, p + 0x1000000 if p >> 40 == 0x7f else p)
+                 for t, r, tid, p in SAMPLE_EVENTS]
+        other = write_log(moved)
+        other.maps_file = io.BytesIO(maps.encode() % (0x7f0001000000,
+                                                      0x7f0001004000))
+        self.assertEqual(diff.diff(log, other), [])
+        self.assertEqual(diff.fingerprint(log), diff.fingerprint(other))
+        # the page is at another offset of the file
+        other.maps_file = io.BytesIO(maps.encode() % (0x7f0000ffe000,
+                                                      0x7f0001004000))
+        self.assertEqual([(d.thread, d.position)
+                          for d in diff.diff(log, other)], [(1, 0)])
+        other.close()
+        log.maps_file = None
+
+        # thread 11 ends before its second thunk
+        other = write_log(SAMPLE_EVENTS[:4] + SAMPLE_EVENTS[5:])
+        divergences = diff.diff(log, other)
+        self.assertEqual([(d.thread, d.position) for d in divergences],
+                         [(1, 1)])
+        self.assertIsNone(divergences[0].b)
+        other.close()
+        log.close()
+
+    def test_sqlite(self):
+        log = write_log(SAMPLE_EVENTS)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.db")
+            self.assertEqual(sqlite.load(log, path), (len(SAMPLE_EVENTS), 4))
+            with self.assertRaises(sqlite.Error):
+                sqlite.load(log, path)
+            db = sqlite3.connect(path)
+            accesses = db.execute("SELECT access, thread_id, thunk_id, "
+                                  "thunk_return_address, space "
+                                  "FROM accesses ORDER BY id").fetchall()
+            self.assertEqual(accesses,
+                             [("write", 10, 0, None, "heap"),
+                              ("read", 11, 0, None, "global"),
+                              ("write", 11, 0, None, "mmap"),
+                              ("write", 10, 1, 0x400200, "heap")])
+            thunks = db.execute("SELECT thread_id, thunk_id, first_event, "
+                                "last_event, reads, writes "
+                                "FROM thunks ORDER BY id").fetchall()
+            self.assertEqual(thunks, [(10, 0, 0, 0, 0, 1),
+                                      (10, 1, 1, 7, 0, 1),
+                                      (11, 0, 2, 3, 1, 1),
+                                      (11, 1, 4, 6, 0, 0)])
+            pages = db.execute("SELECT page FROM thunk_pages "
+                               "WHERE thread_id = 11").fetchall()
+            self.assertEqual(sorted(pages),
+                             [((GLOBAL[0] + 0x2000) >> 12,),
+                              (0x7f0000001000 >> 12,)])
+            db.close()
+        log.close()
+
+    def test_stats(self):
+        log = write_log(SAMPLE_EVENTS)
+        output = io.StringIO()
+        stats.StatsWriter(log, top=2).write(output)
+        result = json.loads(output.getvalue())
+        self.assertEqual(result["events"], len(SAMPLE_EVENTS))
+        self.assertEqual(result["types"],
+                         {"write": 3, "read": 1, "thunk": 2, "finish": 2})
+        self.assertEqual(result["threads"]["11"],
+                         {"write": 1, "read": 1, "thunk": 1, "finish": 1})
+        self.assertEqual(result["spaces"]["heap"],
+                         {"write": 2, "read": 0, "pages": 2})
+        self.assertEqual(result["spaces"]["global"]["read"], 1)
+        self.assertEqual(result["pages"], 4)
+        self.assertEqual(result["call_sites"]["top"][0],
+                         {"return_address": 0x400300, "count": 2})
+        self.assertEqual(result["call_sites"]["max_error"], 0)
+        log.close()
+
+        hitters = stats.HeavyHitters(capacity=2)
+        hitters.update(collections.Counter("aaaaaab"))
+        hitters.update(collections.Counter("cccd"))
+        self.assertEqual(hitters.total, 11)
+        self.assertEqual([k for k, _ in hitters.top(2)], ["a", "c"])
+        for key, count in hitters.top(2):
+            true_count = "aaaaaabcccd".count(key)
+            self.assertLessEqual(count, true_count)
+            self.assertLessEqual(true_count, count + hitters.error)
+
+        counter = stats.DistinctCounter(precision=10, exact=100)
+        counter.update(range(50))
+        counter.update(range(50))
+        self.assertEqual(counter.count(), 50)
+        counter.update(range(0, 200000, 2))
+        # standard error is 3.25%
+        self.assertLess(abs(counter.count() - 100025), 10000)
+
+    def test_serialization(self):
+        log = write_log(SAMPLE_EVENTS)
+        result = serialization.analyze(log).result()
+        log.close()
+        # thread 10 commits thunk 0 at 2, thread 11 its thunks at 5; the
+        # last thunk of thread 10 is ready at 3 and waits for the token
+        self.assertEqual((result["time"], result["ideal_time"]), (6, 5))
+        self.assertEqual((result["work"], result["wait"]), (7, 2))
+        self.assertEqual(result["commits"], 4)
+        self.assertEqual(result["threads"][10],
+                         {"thunks": 2, "compute": 2, "commit": 2, "wait": 2,
+                          "conflict_wait": 0, "conflict_pages": 0})
+        # thread 10 thunk 0, thread 11 thunks 0 and 1, thread 10 thunk 1
+        path = result["critical_path"]
+        self.assertEqual((path["end"], path["thunks"]), (6, 4))
+        self.assertEqual([(t, a["thunks"], a["segments"])
+                          for t, a in path["threads"].items()],
+                         [(10, 2, 2), (11, 2, 1)])
+        self.assertEqual(path["threads"][10]["wait"], 2)
+        # thread 10 waited from 3 to 5, from 4 during the commit of thread 11
+        self.assertEqual([(b["thread_id"], b["thunk_id"], b["wait"])
+                          for b in result["blamed"]],
+                         [(11, 0, 1)])
+
+        # the same thunks in the blocks of a version 2 log
+        blocks = [SAMPLE_EVENTS[i] for i in (0, 2, 3, 4, 6, 1, 5, 7)]
+        log = write_compact_log(blocks)
+        self.assertEqual(serialization.analyze(log).result(), result)
+        log.close()
+        # the last thunk of thread 10 spans two blocks, a block of thread 11
+        # was written in between
+        blocks = [SAMPLE_EVENTS[i] for i in (0, 1, 2, 3, 4, 6, 5, 7)]
+        log = write_compact_log(blocks, continued={1})
+        self.assertEqual([list(b.continued) for b in log.iter_batches()],
+                         [[1]])
+        spanning = serialization.analyze(log).result()
+        log.close()
+        self.assertEqual(spanning["commits"], 4)
+        self.assertEqual(spanning["threads"][10]["thunks"], 2)
+
+        # thread 10 writes the page thread 11 committed during its thunk
+        changed = list(SAMPLE_EVENTS)
+        changed[5] = (accesslog.WRITE, 0x400400, 10, 0x7f0000001000)
+        log = write_log(changed)
+        result = serialization.analyze(log).result()
+        log.close()
+        self.assertEqual(result["ideal_time"], 6)
+        self.assertEqual(result["threads"][10]["conflict_wait"], 2)
+        self.assertEqual(result["threads"][10]["conflict_pages"], 1)
+
+        # state does not grow with the number of thunks
+        events = []
+        for i in range(300):
+            thread_id = 10 + i % 3
+            events.append((accesslog.THUNK, 0x400200, thread_id, i))
+            events.append((accesslog.WRITE, 0x400300, thread_id,
+                           0x7f0000001000 + 4096 * (i % 7)))
+        log = write_log(events)
+        analysis = serialization.Serialization(log._read_header(), top=2)
+        holders = 0
+        for batch in log.iter_batches(16):
+            analysis.add(batch)
+            holders = max(holders, len(analysis.holders))
+        analysis.finish()
+        log.close()
+        self.assertLessEqual(holders, 3)
+        self.assertEqual(analysis.critical_path()["thunks"], 300)
+        self.assertEqual(len(analysis.blamed()), 2)
+
+    def test_tsv(self):
+        log = write_log(SAMPLE_EVENTS)
+        output = io.StringIO()
+        formats.TsvWriter(log).write(output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), len(SAMPLE_EVENTS) + 1)
+        self.assertEqual(lines[1].split("\t")[4], "heap")
+        self.assertEqual(lines[2].split("\t")[:4],
+                         ["thunk", str(0x400200), "10", "1"])
+        self.assertEqual(lines[3].split("\t")[4], "global")
+        self.assertEqual(lines[4].split("\t")[4], "mmap")
+
+        output = io.StringIO()
+        formats.Tsv2Writer(log).write(output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[1].split("\t")[3:5], ["0", "_start"])
+        self.assertEqual(lines[4].split("\t")[3:5], ["1", str(0x400200)])
+        log.close()
+
+    def test_output(self):
+        log = write_log(SAMPLE_EVENTS)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.tsv")
+            with output.open_output(path) as f:
+                formats.TsvWriter(log).write(f)
+            with open(path) as f:
+                expected = f.read()
+            self.assertEqual(len(expected.splitlines()),
+                             len(SAMPLE_EVENTS) + 1)
+
+            path = os.path.join(directory, "log.tsv.gz")
+            with output.open_output(path) as f:
+                formats.TsvWriter(log).write(f)
+            with gzip.open(path, "rt") as f:
+                self.assertEqual(f.read(), expected)
+
+            # chunks are passed through the queue in order
+            f = output.open_output(path, binary=True)
+            data = os.urandom(3 * output.chunk_size + 1)
+            for i in range(0, len(data), 4096):
+                f.write(data[i:i + 4096])
+            f.close()
+            with gzip.open(path) as f:
+                self.assertEqual(f.read(), data)
+
+            with self.assertRaises(output.Error):
+                output.open_output(os.path.join(directory, "x", "log.tsv"))
+        log.close()
+
+    def test_chrome_trace(self):
+        log = write_log(SAMPLE_EVENTS)
+        output = io.StringIO()
+        formats.ChromeTraceWriter(log).write(output)
+        trace = json.loads(output.getvalue())["traceEvents"]
+        phases = collections.Counter(e["ph"] for e in trace)
+        self.assertEqual(phases, {"M": 3, "B": 4, "E": 4, "i": 4})
+        slices = [(e["tid"], e["ts"], e["name"])
+                  for e in trace if e["ph"] == "B"]
+        self.assertEqual(slices, [(10, 1, "thunk 0"),
+                                  (10, 2, "thunk 1"),
+                                  (11, 3, "thunk 0"),
+                                  (11, 5, "thunk 1")])
+        ends = [(e["tid"], e["ts"]) for e in trace if e["ph"] == "E"]
+        self.assertEqual(ends, [(10, 2), (11, 5), (11, 7), (10, 8)])
+        self.assertEqual(trace[3]["args"],
+                         {"address": hex(HEAP[0] + 0x10), "space": "heap"})
+
+        output = io.StringIO()
+        formats.ChromeTraceWriter(log, accesses=False).write(output)
+        trace = json.loads(output.getvalue())["traceEvents"]
+        self.assertNotIn("i", [e["ph"] for e in trace])
+        log.close()
+
+    def test_columnar(self):
+        log = write_log(SAMPLE_EVENTS)
+        with tempfile.TemporaryFile() as f:
+            columnar.ColumnarWriter(log).write(f)
+            reader = columnar.ColumnarReader(f)
+            self.assertEqual(reader.event_count, len(SAMPLE_EVENTS))
+            table = reader.read()
+            self.assertEqual(list(table["type"]),
+                             [e[0] for e in SAMPLE_EVENTS])
+            self.assertEqual(list(table["return_address"]),
+                             [e[1] for e in SAMPLE_EVENTS])
+            self.assertEqual(list(table["payload"]),
+                             [e[3] for e in SAMPLE_EVENTS])
+            table = reader.read(["thread_id"])
+            self.assertEqual(list(table.keys()), ["thread_id"])
+            self.assertEqual(list(table["thread_id"]),
+                             [e[2] for e in SAMPLE_EVENTS])
+            addresses = [SAMPLE_EVENTS[i][3] for i in (0, 2, 3)]
+            self.assertEqual(list(reader.spaces(addresses)), [0, 1, 2])
+        # columns are joined across row groups
+        row_group_size = columnar.row_group_size
+        columnar.row_group_size = 2
+        try:
+            with tempfile.TemporaryFile() as f:
+                columnar.ColumnarWriter(log).write(f)
+                reader = columnar.ColumnarReader(f)
+                self.assertGreater(len(reader.footer["row_groups"]), 1)
+                table = reader.read()
+                self.assertEqual(list(table["type"]),
+                                 [e[0] for e in SAMPLE_EVENTS])
+                self.assertEqual(list(table["payload"]),
+                                 [e[3] for e in SAMPLE_EVENTS])
+        finally:
+            columnar.row_group_size = row_group_size
+        log.close()
+
+    def test_columnar_deltas(self):
+        types = bytes([accesslog.WRITE, accesslog.THUNK, accesslog.READ,
+                       accesslog.FINISH, accesslog.WRITE])
+        payload = array.array("Q", [1 << 63, 3, 5, 0, (1 << 64) - 1])
+        numpy_module = columnar.numpy
+        encoded = []
+        try:
+            # with numpy, if it is installed, and with itertools
+            for module in {numpy_module, None}:
+                columnar.numpy = module
+                last = [0, 0]
+                deltas = columnar._delta_encode(types, payload, last)
+                self.assertEqual(last, [0, (1 << 64) - 1])
+                self.assertEqual(columnar._delta_decode(types, deltas,
+                                                        [0, 0]),
+                                 payload)
+                encoded.append(deltas)
+        finally:
+            columnar.numpy = numpy_module
+        self.assertEqual(encoded[0], encoded[-1])
+        self.assertEqual(list(array.array("q", encoded[0].tobytes())),
+                         [-(1 << 63), 3, -(1 << 63) + 5, -3, -6])
+
+    def test_page_index(self):
+        log = write_log(SAMPLE_EVENTS + [
+            (accesslog.READ, 0x400600, 11, HEAP[0] + 0x20),
+        ])
+        index = analysis.PageIndex.build(log)
+        page = analysis.page_of(HEAP[0])
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.writers_of(page), [10])
+        self.assertEqual(index.readers_of(page), [11])
+        self.assertEqual(index.write_shared_pages(), [page])
+        self.assertEqual(index.thunks_of(page),
+                         [(10, 0, analysis.WRITE), (11, 1, analysis.READ)])
+        self.assertEqual(index.access_mode(page, 11, 1), analysis.READ)
+        self.assertEqual(index.access_mode(page, 10, 1), 0)
+        self.assertEqual(index.first_touch_of(page), 0x400100)
+        with tempfile.TemporaryFile() as f:
+            index.save(f)
+            f.seek(0)
+            loaded = analysis.PageIndex.load(f)
+        self.assertEqual(loaded.pages(), index.pages())
+        self.assertEqual(loaded.write_shared_pages(), [page])
+        self.assertEqual(loaded.thunks_of(page), index.thunks_of(page))
+        self.assertEqual(loaded.access_mode(page, 11, 1), analysis.READ)
+        with tempfile.TemporaryFile() as f:
+            index.save(f)
+            f.truncate(f.tell() - 1)
+            f.seek(0)
+            with self.assertRaises(accesslog.Error):
+                analysis.PageIndex.load(f)
+        log.close()
+
+    def test_provenance(self):
+        log = write_log(SAMPLE_EVENTS + [
+            (accesslog.READ, 0x400600, 11, HEAP[0] + 0x20),
+            (accesslog.READ, 0x400600, 10, 0x7f0000001008),
+        ])
+        graph = provenance.Graph.build(log)
+        self.assertEqual(len(graph), 4)
+        self.assertEqual(graph.edge_count, 4)
+        node = graph.node(11, 1)
+        self.assertEqual(graph.thunk(node), (11, 1))
+        self.assertEqual(graph.parents(node), [graph.node(11, 0),
+                                               graph.node(10, 0)])
+        self.assertEqual(list(graph.in_edges(node))[1],
+                         (0, provenance.DATA, analysis.page_of(HEAP[0])))
+        self.assertEqual(list(graph.backward_slice(node)), [0, 2, 3])
+        self.assertEqual(list(graph.backward_slice(node, provenance.DATA)),
+                         [0, 3])
+        self.assertEqual(list(graph.forward_slice(0)), [0, 1, 3])
+        self.assertEqual(list(graph.forward_slice(2)), [1, 2, 3])
+        with tempfile.TemporaryFile() as f:
+            graph.save(f)
+            f.seek(0)
+            loaded = provenance.Graph.load(f)
+        self.assertEqual(sorted(loaded.children(2)), [1, 3])
+        self.assertEqual(list(loaded.in_edges(node)),
+                         list(graph.in_edges(node)))
+        with self.assertRaises(provenance.Error):
+            graph.node(10, 5)
+        log.close()
+
+    def test_regions(self):
+        mappings = symbols.parse_maps(
+            "00400000-00401000 r-xp 0 08:01 1 /usr/bin/app\n"
+            "00600000-00800000 rw-p 0 08:01 1 /usr/bin/app\n"
+            "7f0000000000-7f0000010000 r-xp 0 08:01 2 /lib/libc.so.6\n"
+            "7f0000010000-7f0000020000 rw-p 0 00:00 0\n"
+            "7ffe00000000-7ffe00021000 rw-p 0 00:00 0 [stack]\n")
+        log = write_log(SAMPLE_EVENTS)
+        index = regions.RegionIndex(mappings, log._read_header())
+        # the global range of the header overlays the data mapping
+        self.assertEqual(index.lookup(0x400010),
+                         (regions.FILE, mappings[0]))
+        self.assertEqual(index.lookup(GLOBAL[0] + 0x2000),
+                         (regions.GLOBAL, None))
+        self.assertEqual(index.lookup(GLOBAL[1] + 1)[0], regions.FILE)
+        self.assertEqual(index.kind_name(HEAP[0]), "heap")
+        self.assertEqual(index.kind_name(0x7f0000000000), "library")
+        self.assertEqual(index.kind_name(0x7f0000010000), "anonymous")
+        self.assertEqual(index.kind_name(0x7f0000020000), "unknown")
+        self.assertEqual(index.kind_name(0x7ffe00000100), "stack")
+        self.assertEqual(index.kind_name(0), "unknown")
+
+        addresses = array.array("Q", [0x7ffe00000100, HEAP[0], 0x401000])
+        self.assertEqual(index.classify(addresses),
+                         bytes([regions.STACK, regions.HEAP, regions.UNKNOWN]))
+        self.assertEqual(list(index.names(addresses)),
+                         ["stack", "heap", "unknown"])
+        histogram = index.histogram(addresses + addresses[:1])
+        self.assertEqual(histogram[0], (regions.STACK, mappings[4], 2))
+        if numpy is not None:
+            self.assertEqual(
+                list(index.classify(numpy.array(addresses, numpy.uint64))),
+                list(index.classify(addresses)))
+
+        output = io.StringIO()
+        formats.TsvWriter(log, regions=index).write(output)
+        rows = [line.split("\t") for line in output.getvalue().splitlines()]
+        self.assertEqual(rows[0][-1], "region")
+        spaces = [row[-1] for row in rows if row[0] in ("write", "read")]
+        self.assertEqual(spaces, ["heap", "global", "library", "heap"])
+        self.assertEqual(index.boundary_list(), list(index.boundaries))
+        log.close()
+
+    def test_symbolizer(self):
+        import ctypes
+        libc = ctypes.CDLL(None)
+        printf = ctypes.cast(libc.printf, ctypes.c_void_p).value
+        with open("/proc/self/maps") as f:
+            mappings = symbols.parse_maps(f.read())
+        with tempfile.TemporaryDirectory() as cache_dir:
+            symbolizer = symbols.Symbolizer(mappings, cache_dir=cache_dir)
+            self.assertEqual(symbolizer.resolve(printf + 4), "printf+0x4")
+            self.assertIsNone(symbolizer.resolve(0))
+            self.assertNotEqual(os.listdir(cache_dir), [])
+            # resolved from disk cache
+            symbolizer = symbols.Symbolizer(mappings, cache_dir=cache_dir)
+            self.assertEqual(symbolizer.resolve_many([printf, printf]),
+                             {printf: "printf+0x0"})
+
+    def test_symbol_table_cache(self):
+        table = symbols.SymbolTable("abc", [(0, 0x1000, 0x400000)],
+                                    array.array("Q", [0x401000, 0x402000]),
+                                    array.array("Q", [16, 0]),
+                                    ["main", "f\u00fc"])
+        f = io.BytesIO()
+        table.save(f)
+        f.seek(0)
+        loaded = symbols.SymbolTable.load(f, "abc")
+        self.assertEqual(loaded.segments, table.segments)
+        self.assertEqual(loaded.names, table.names)
+        self.assertEqual(loaded.lookup(0x402004), "f\u00fc+0x4")
+        with self.assertRaises(arrayfile.Error):
+            symbols.SymbolTable.load(io.BytesIO(b"\x80\x04junk"), "abc")
+
+    def test_parallel(self):
+        log = write_log(SAMPLE_EVENTS)
+        for writer in (formats.TsvWriter, formats.Tsv2Writer):
+            serial = io.StringIO()
+            writer(log).write(serial)
+            result = io.StringIO()
+            parallel.write(writer(log), result, workers=2, range_size=3)
+            self.assertEqual(result.getvalue(), serial.getvalue())
+        summary = parallel.summary(log, workers=2, range_size=3)
+        self.assertEqual(summary["events"], len(SAMPLE_EVENTS))
+        self.assertEqual(summary["types"],
+                         {"write": 3, "read": 1, "thunk": 2, "finish": 2})
+        self.assertEqual(summary["threads"], {10: 4, 11: 4})
+        self.assertEqual(summary["spaces"],
+                         {"heap": 2, "global": 1, "mmap": 1})
+        # the workers are forked before the compression thread starts
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.tsv.gz")
+            writer = parallel.ParallelWriter(formats.Tsv2Writer(log),
+                                             workers=2, range_size=3)
+            with output.open_output(path) as f:
+                writer.write(f)
+            with gzip.open(path, "rt", newline="") as f:
+                self.assertEqual(f.read(), serial.getvalue())
+        log.close()
+
+    def test_tail(self):
+        log = write_log(SAMPLE_EVENTS[:3] + [(0, 0, 0, 0)])
+        tail = accesslog.Tail(log.file)
+        batch = tail.poll()
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(len(tail.poll()), 0)
+        # event 3 is written after event_count was incremented
+        log.file.seek(4096 + 3 * accesslog.log_event_size)
+        log.file.write(struct.pack(accesslog.raw_event_fmt,
+                                   *SAMPLE_EVENTS[3]))
+        log.file.flush()
+        batch = tail.poll()
+        self.assertEqual(batch.start, 3)
+        self.assertEqual(list(batch.writes.payload), [SAMPLE_EVENTS[3][3]])
+        self.assertEqual(len(tail.poll(final=True)), 0)
+        log.close()
+
+        # the fields of event 1 are written, its type is written last
+        log = write_log(SAMPLE_EVENTS[:2])
+        tail = accesslog.Tail(log.file)
+        event = struct.pack(accesslog.raw_event_fmt, *SAMPLE_EVENTS[1])
+        log.file.seek(4096 + accesslog.log_event_size)
+        log.file.write(b"\0" + event[1:])
+        log.file.flush()
+        self.assertEqual(len(tail.poll()), 1)
+        log.file.seek(4096 + accesslog.log_event_size)
+        log.file.write(event[:1])
+        log.file.flush()
+        batch = tail.poll()
+        self.assertEqual(list(batch.thunks.payload), [SAMPLE_EVENTS[1][3]])
+        log.close()
+
+    def test_compact_log(self):
+        log = write_compact_log(SAMPLE_EVENTS)
+        expected = write_log(SAMPLE_EVENTS)
+        self.assertEqual(list(log.read()), list(expected.read()))
+        expected.close()
+        batches = list(log.iter_batches(batch_size=3, start=1, stop=7))
+        self.assertEqual([b.start for b in batches], [1, 2, 5])
+        self.assertEqual(sum(len(b) for b in batches), 6)
+        self.assertEqual(list(batches[1].thread_id), [11, 11, 11])
+        events = list(log.read(types=[accesslog.THUNK]))
+        self.assertEqual([e.id for e in events], [1, 1])
+        summary = parallel.summary(log, workers=2, range_size=2)
+        self.assertEqual(summary["types"]["write"], 3)
+
+        # the last block has not been written completely
+        tail = accesslog.Tail(log.file)
+        last_block = len(encode_block(SAMPLE_EVENTS[7:]))
+        log.file.seek(4096 + log.header.data_size - last_block)
+        block = log.file.read(4)
+        log.file.seek(-4, 1)
+        log.file.write(bytes(4))
+        log.file.flush()
+        self.assertEqual(len(tail.poll()), 7)
+        self.assertEqual(len(tail.poll()), 0)
+        log.file.seek(-4, 1)
+        log.file.write(block)
+        log.file.flush()
+        batch = tail.poll()
+        self.assertEqual((batch.start, list(batch.thread_id)), (7, [10]))
+        log.close()
+
+    @unittest.skipIf(numpy is None, "numpy not installed")
+    def test_to_array(self):
+        log = write_log(SAMPLE_EVENTS)
+        array = log.to_array()
+        self.assertEqual(len(array), len(SAMPLE_EVENTS))
+        self.assertEqual(len(array.writes), 3)
+        self.assertEqual(len(array.accesses), 4)
+        addresses = array.addresses(array.writes)
+        self.assertEqual(list(array.is_heap(addresses)),
+                         [True, False, True])
+        self.assertEqual(list(array.thunk_ids(array.thunks)), [1, 1])
+        self.assertEqual(array.thread_counts(), {10: 4, 11: 4})
+        selected = array.select(threads=[11], spaces=["global", "mmap"])
+        self.assertEqual(list(array.addresses(selected)),
+                         [GLOBAL[0] + 0x2000, 0x7f0000001000])
+        selected = array.select(thunks=[(10, 1), (11, 0)])
+        self.assertEqual(len(selected), 5)
+        selected = array.select(thunks=[(11, 1)])
+        self.assertEqual(list(selected["type"]),
+                         [accesslog.THUNK, accesslog.FINISH])
+        del array, addresses, selected
+        log.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,9 @@
 import os
+import time
+import queue
+import asyncio
 import tempfile
+import threading
 import subprocess
 
 
@@ -17,25 +21,102 @@ def default_library_path():
 
 
 class Process:
-    def __init__(self, popen, log_file):
+    def __init__(self, popen, log_file, maps_file=None):
         self.popen = popen
         self.log_file = log_file
+        self.maps_file = maps_file
 
-    def wait(self):
-        return accesslog.Log(self.popen.wait(), self.log_file)
+    # If `index` is set, the index of the log is built and saved next to the
+    # log (see Log.index())
+    def wait(self, index=False):
+        log = accesslog.Log(self.popen.wait(),
+                            self.log_file,
+                            maps_file=self.maps_file)
+        if index:
+            log.index(save=True)
+        return log
 
+    # Yields batches of events, while the process is still running.
+    # New events are polled every `poll_interval` seconds. If `discard` is
+    # set, disk space of already returned events is freed.
+    def follow_batches(self, poll_interval=0.1, discard=False):
+        tail = accesslog.Tail(self.log_file, discard=discard)
+        while True:
+            running = self.popen.poll() is None
+            batch = tail.poll(final=not running)
+            if len(batch) > 0:
+                yield batch
+            elif not running:
+                return
+            else:
+                time.sleep(poll_interval)
 
+    def follow(self, poll_interval=0.1, discard=False):
+        for batch in self.follow_batches(poll_interval, discard):
+            yield from batch.events()
+
+    # asyncio variant of follow_batches(): async for batch in ...
+    async def afollow_batches(self, poll_interval=0.1, discard=False):
+        tail = accesslog.Tail(self.log_file, discard=discard)
+        while True:
+            running = self.popen.poll() is None
+            batch = tail.poll(final=not running)
+            if len(batch) > 0:
+                yield batch
+            elif not running:
+                return
+            else:
+                await asyncio.sleep(poll_interval)
+
+    async def afollow(self, poll_interval=0.1, discard=False):
+        async for batch in self.afollow_batches(poll_interval, discard):
+            for event in batch.events():
+                yield event
+
+
+# Returns (log_file, maps_file). Logs with a path are kept after the process
+# exited, the maps are stored as `<log>.maps`.
+def _open_log(log_path=None, log_dir=None):
+    if log_path is None and log_dir is None:
+        return tempfile.TemporaryFile(), tempfile.TemporaryFile()
+    if log_path is None:
+        fd, log_path = tempfile.mkstemp(prefix="tthread-",
+                                        suffix=".log",
+                                        dir=log_dir)
+        os.close(fd)
+    try:
+        log_file = open(log_path, "w+b")
+        maps_file = open(accesslog.maps_path(log_path), "w+b")
+    except OSError as e:
+        raise Error("failed to create tthread_log: %s" % e)
+    return log_file, maps_file
+
+
+# The log is written to an anonymous temporary file unless `log_path` or
+# `log_dir` (a new file in this directory, e.g. on tmpfs) is given.
+# `expected_size` (in bytes) lets libtthread preallocate the log.
 def run(command,
         tthread_path=default_library_path(),
         stdin=None,
         stdout=None,
-        stderr=None):
-    log_file = tempfile.TemporaryFile()
+        stderr=None,
+        log_version=None,
+        log_path=None,
+        log_dir=None,
+        expected_size=None):
+    log_file, maps_file = _open_log(log_path, log_dir)
     log_fd = log_file.fileno()
-    pass_fds = [0, 1, 2, log_fd]
+    maps_fd = maps_file.fileno()
+    pass_fds = [0, 1, 2, log_fd, maps_fd]
     env = os.environ.copy()
     env["LD_PRELOAD"] = tthread_path
     env["TTHREAD_LOG_FD"] = str(log_fd)
+    env["TTHREAD_MAPS_FD"] = str(maps_fd)
+    if log_version is not None:
+        # 2: compact encoding, see accesslog.COMPACT_VERSION
+        env["TTHREAD_LOG_VERSION"] = str(log_version)
+    if expected_size is not None:
+        env["TTHREAD_LOG_SIZE"] = str(expected_size)
     env["LD_BIND_NOW"] = "1"
     popen = subprocess.Popen(command,
                              pass_fds=pass_fds,
@@ -43,4 +124,88 @@ def run(command,
                              stdin=stdin,
                              stdout=stdout,
                              stderr=stderr)
-    return Process(popen, log_file)
+    return Process(popen, log_file, maps_file)
+
+
+class Result:
+    def __init__(self, index, command, log, wall_time):
+        # position of the command in the commands passed to run_many()
+        self.index = index
+        self.command = command
+        self.log = log
+        # seconds from start to exit of the process
+        self.wall_time = wall_time
+
+    @property
+    def return_code(self):
+        return self.log.return_code
+
+    def __repr__(self):
+        return "Result(index=%d, return_code=%d, wall_time=%.3f)" % \
+            (self.index, self.return_code, self.wall_time)
+
+
+# available memory in bytes according to /proc/meminfo
+def _available_memory():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    raise Error("MemAvailable not found in /proc/meminfo")
+
+
+def _wait(process, start, index, finished):
+    process.popen.wait()
+    finished.put((index, time.monotonic() - start))
+
+
+def _run_many(commands, max_workers, min_memory, run_args):
+    commands = list(commands)
+    finished = queue.Queue()
+    running = {}
+    next_command = 0
+    while next_command < len(commands) or running:
+        # admission: at most max_workers processes and, if the limit is set,
+        # only while enough memory is available
+        while next_command < len(commands) and len(running) < max_workers:
+            if running and min_memory is not None \
+               and _available_memory() < min_memory:
+                break
+            start = time.monotonic()
+            process = run(commands[next_command], **run_args)
+            running[next_command] = process
+            waiter = threading.Thread(target=_wait,
+                                      args=(process,
+                                            start,
+                                            next_command,
+                                            finished),
+                                      daemon=True)
+            waiter.start()
+            next_command += 1
+        index, wall_time = finished.get()
+        log = running.pop(index).wait()
+        yield Result(index, commands[index], log, wall_time)
+
+
+# Runs `commands` concurrently, each like run(command, **run_args). At most
+# `max_workers` (default: number of cpus) processes run at the same time; if
+# `min_memory` (bytes) is set, no further process is started while less
+# memory is available. Results are returned in the order the processes exit:
+# passed to `callback`, or, without callback, as iterator.
+# Logs are not closed, log_dir keeps each log in its own file.
+def run_many(commands,
+             max_workers=None,
+             min_memory=None,
+             callback=None,
+             **run_args):
+    if "log_path" in run_args:
+        raise Error("log_path is not supported by run_many, use log_dir")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers < 1:
+        raise Error("max_workers must be at least 1")
+    results = _run_many(commands, max_workers, min_memory, run_args)
+    if callback is None:
+        return results
+    for result in results:
+        callback(result)
@@ -1,5 +1,9 @@
 import os
+import mmap
 import struct
+from array import array
+from bisect import bisect_right
+from itertools import compress
 from collections import namedtuple
 import tthread
 
@@ -51,31 +55,815 @@ FinishEvent = make_type("FinishEvent",
 events = [InvalidEvent, WriteEvent, ReadEvent, ThunkEvent, FinishEvent]
 log_event_size = max([e.size for e in events])
 
+# event types as defined in tthread/logevent.h, index into `events`
+INVALID, WRITE, READ, THUNK, FINISH = range(len(events))
+
+names = {
+    INVALID: "invalid",
+    WRITE: "write",
+    READ: "read",
+    THUNK: "thunk",
+    FINISH: "finish",
+}
+
+# numpy layout of a packed logevent, event specific data is kept as raw
+# 64-bit payload (address for read/write events, id for thunk events)
+array_fields = [
+        ("type", "u1"),
+        ("return_address", "u8"),
+        ("thread_id", "i4"),
+        ("payload", "u8"),
+        ]
+
+# struct layout of a packed logevent, see `array_fields`
+raw_event_fmt = "=BQiQ"
+assert struct.calcsize(raw_event_fmt) == log_event_size
+assert array("Q").itemsize == 8 and array("i").itemsize == 4
+
 Header = make_type("Header", header_fields)
 log_file_magic = 0xC3D2C3D2
 
+# log versions, see tthread/logheader.h
+VERSION = 1
+COMPACT_VERSION = 2
+
+# version 2 logs store the number of bytes used by blocks after the header
+HeaderV2 = make_type("Header", header_fields + [("data_size", "Q")])
+
+# block layout of version 2 logs, see tthread/logblock.h
+block_header_fmt = "=IiI"
+block_header_size = struct.calcsize(block_header_fmt)
+# flag of the event count: the thunk continues in the next block of the thread
+BLOCK_CONTINUED = 0x80000000
+RETURN_ADDRESS_CACHED = 0x08
+RETURN_ADDRESS_SLOTS = 64
+
+_mask64 = (1 << 64) - 1
+
 
 class Error(tthread.Error):
     pass
 
 
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Error("numpy is required for array access to tthread_log")
+    return numpy
+
+
+# Vectorized view of all events in a log. `events` is a numpy structured
+# array with the fields of `array_fields`, which is backed by the log file
+class EventArray:
+    def __init__(self, events, header):
+        self.events = events
+        self.header = header
+
+    def __len__(self):
+        return len(self.events)
+
+    def of_type(self, type_):
+        return self.events[self.events["type"] == type_]
+
+    @property
+    def writes(self):
+        return self.of_type(WRITE)
+
+    @property
+    def reads(self):
+        return self.of_type(READ)
+
+    @property
+    def thunks(self):
+        return self.of_type(THUNK)
+
+    @property
+    def finishes(self):
+        return self.of_type(FINISH)
+
+    @property
+    def accesses(self):
+        types = self.events["type"]
+        return self.events[(types == WRITE) | (types == READ)]
+
+    @staticmethod
+    def addresses(events):
+        return events["payload"]
+
+    @staticmethod
+    def thunk_ids(events):
+        # only the lower 4 bytes of the payload are set for thunk events
+        payload = events["payload"] & 0xFFFFFFFF
+        return payload.astype("u4").view("i4")
+
+    def is_heap(self, addresses):
+        h = self.header
+        return (h.heap_start <= addresses) & (addresses <= h.heap_end)
+
+    def is_global(self, addresses):
+        h = self.header
+        return (h.global_start <= addresses) & (addresses <= h.global_end)
+
+    def is_mmap(self, addresses):
+        return ~(self.is_heap(addresses) | self.is_global(addresses))
+
+    # vectorized version of Filter, returns the matching events
+    def select(self, types=None, threads=None, address_range=None,
+               spaces=None, thunks=None):
+        numpy = _import_numpy()
+        events = self.events
+        mask = numpy.ones(len(events), dtype=bool)
+        if types is not None:
+            mask &= numpy.isin(events["type"], list(types))
+        if threads is not None:
+            mask &= numpy.isin(events["thread_id"], list(threads))
+        if thunks is not None:
+            mask &= self._thunk_mask(numpy, thunks)
+        if address_range is not None or spaces is not None:
+            t = events["type"]
+            mask &= (t == WRITE) | (t == READ)
+        addresses = events["payload"]
+        if address_range is not None:
+            start, end = address_range
+            mask &= (start <= addresses) & (addresses < end)
+        if spaces is not None:
+            spaces = Filter(spaces=spaces).spaces
+            in_space = numpy.zeros(len(events), dtype=bool)
+            if "heap" in spaces:
+                in_space |= self.is_heap(addresses)
+            if "global" in spaces:
+                in_space |= self.is_global(addresses)
+            if "mmap" in spaces:
+                in_space |= self.is_mmap(addresses)
+            mask &= in_space
+        return events[mask]
+
+    def _thunk_mask(self, numpy, thunks):
+        events = self.events
+        mask = numpy.zeros(len(events), dtype=bool)
+        by_thread = {}
+        for thread_id, thunk_id_ in thunks:
+            by_thread.setdefault(thread_id, []).append(thunk_id_)
+        for thread_id, ids in by_thread.items():
+            indices = numpy.flatnonzero(events["thread_id"] == thread_id)
+            thread_events = events[indices]
+            starts = thread_events["type"] == THUNK
+            # position of the last thunk event of the thread, -1 before
+            last = numpy.maximum.accumulate(
+                numpy.where(starts, numpy.arange(len(indices)), -1))
+            current = numpy.where(last >= 0,
+                                  self.thunk_ids(thread_events)[last],
+                                  0)
+            mask[indices[numpy.isin(current, ids)]] = True
+        return mask
+
+    # returns dict thread_id -> number of events
+    def thread_counts(self, events=None):
+        if events is None:
+            events = self.events
+        numpy = _import_numpy()
+        threads, counts = numpy.unique(events["thread_id"],
+                                       return_counts=True)
+        return dict(zip(threads.tolist(), counts.tolist()))
+
+
+# thunk ids are stored as int in the lower 4 bytes of the payload
+def thunk_id(payload):
+    id = payload & 0xFFFFFFFF
+    return id - 0x100000000 if id & 0x80000000 else id
+
+
+type_bytes = [bytes((t,)) for t in range(len(events))]
+
+Columns = namedtuple("Columns", ["return_address", "thread_id", "payload"])
+
+
+# A block of consecutive events stored as columns. The columns
+# `return_address`, `thread_id` and `payload` are in log order, `types` holds
+# the type of each event. Use `of_type()` to get the columns of a single event
+# type.
+class Batch:
+    def __init__(self, start, types, return_address, thread_id, payload,
+                 continued=()):
+        # index of the first event in the log
+        self.start = start
+        self.types = types
+        self.return_address = return_address
+        self.thread_id = thread_id
+        self.payload = payload
+        # version 2: indices in the log of the last events of blocks, whose
+        # thunk continues in the next block of the thread
+        self.continued = continued
+        self._by_type = {}
+
+    def __len__(self):
+        return len(self.types)
+
+    def rows(self):
+        return zip(self.types,
+                   self.return_address,
+                   self.thread_id,
+                   self.payload)
+
+    def of_type(self, type_):
+        columns = self._by_type.get(type_)
+        if columns is None:
+            if type_ not in self.types:
+                columns = Columns(array("Q"), array("i"), array("Q"))
+            else:
+                mask = bytes(t == type_ for t in self.types)
+                columns = Columns(
+                    array("Q", compress(self.return_address, mask)),
+                    array("i", compress(self.thread_id, mask)),
+                    array("Q", compress(self.payload, mask)))
+            self._by_type[type_] = columns
+        return columns
+
+    @property
+    def writes(self):
+        return self.of_type(WRITE)
+
+    @property
+    def reads(self):
+        return self.of_type(READ)
+
+    @property
+    def thunks(self):
+        return self.of_type(THUNK)
+
+    @property
+    def finishes(self):
+        return self.of_type(FINISH)
+
+    # returns events [start, stop) of this batch, relative to its start
+    def _range(self, start, stop):
+        first, end = self.start + start, self.start + stop
+        return Batch(first,
+                     self.types[start:stop],
+                     self.return_address[start:stop],
+                     self.thread_id[start:stop],
+                     self.payload[start:stop],
+                     [i for i in self.continued if first <= i < end])
+
+    # returns a new batch with the events, for which mask has a non-zero byte
+    def select(self, mask):
+        # gathering by index only creates objects for the selected events,
+        # iterating the columns would create one per event
+        indices = list(compress(range(len(mask)), mask))
+        return Batch(self.start,
+                     bytes(map(self.types.__getitem__, indices)),
+                     array("Q", map(self.return_address.__getitem__, indices)),
+                     array("i", map(self.thread_id.__getitem__, indices)),
+                     array("Q", map(self.payload.__getitem__, indices)))
+
+    def events(self):
+        for type_, return_address, thread_id, payload in self.rows():
+            if type_ == WRITE or type_ == READ:
+                yield events[type_](type_bytes[type_],
+                                    return_address,
+                                    thread_id,
+                                    payload)
+            elif type_ == THUNK or type_ == FINISH:
+                yield events[type_](type_bytes[type_],
+                                    return_address,
+                                    thread_id,
+                                    thunk_id(payload))
+            else:
+                yield InvalidEvent(type_bytes[type_])
+
+
+# copies the field at `offset` of each packed event into a contiguous array
+def _column(raw, offset, typecode, count):
+    column = array(typecode)
+    width = column.itemsize
+    buf = bytearray(count * width)
+    for i in range(width):
+        buf[i::width] = raw[offset + i::log_event_size]
+    column.frombytes(buf)
+    return column
+
+
+# Decodes packed events into columns. Instead of unpacking every event, each
+# field is gathered with strided slices over the raw bytes, which keeps the
+# work per event in C.
+def decode_batch(view, start=0):
+    raw = bytes(view)
+    count = len(raw) // log_event_size
+    types = raw[0::log_event_size]
+    if count > 0 and max(types) >= len(events):
+        msg = "type field '%d' is out of range 0..%d" \
+                % (max(types), len(events))
+        raise Error(msg)
+    return Batch(start,
+                 types,
+                 _column(raw, 1, "Q", count),
+                 _column(raw, 9, "i", count),
+                 _column(raw, 13, "Q", count))
+
+
+def return_address_slot(address):
+    return ((address * 0x9E3779B97F4A7C15) & _mask64) >> 58
+
+
+def _varint(data, pos):
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    value = byte & 0x7F
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos + 1
+        shift += 7
+
+
+def _decode_records(data, pos, count, types, return_address, payload):
+    cache = [0] * RETURN_ADDRESS_SLOTS
+    last = 0
+    for _ in range(count):
+        tag = data[pos]
+        type_ = tag & 0x07
+        if tag & RETURN_ADDRESS_CACHED:
+            address = cache[data[pos + 1]]
+            pos += 2
+        else:
+            address, pos = _varint(data, pos + 1)
+            cache[return_address_slot(address)] = address
+        if type_ == WRITE or type_ == READ:
+            value, pos = _varint(data, pos)
+            # zigzag encoded difference to the previous address
+            last = (last + ((value >> 1) ^ -(value & 1))) & _mask64
+            value = last
+        elif type_ == THUNK:
+            value, pos = _varint(data, pos)
+            value = ((value >> 1) ^ -(value & 1)) & 0xFFFFFFFF
+        elif type_ == FINISH:
+            value = 0
+        else:
+            raise Error("type field '%d' is out of range 1..%d"
+                        % (type_, len(events) - 1))
+        types.append(type_)
+        return_address.append(address)
+        payload.append(value)
+    return pos
+
+
+# Decodes the complete blocks of a version 2 log at the beginning of `data`
+# until `max_events` are decoded. Returns the batch and the number of bytes
+# consumed. Decoding stops at a block, which is not written yet or exceeds
+# `data`.
+def decode_blocks(data, start=0, max_events=None):
+    types = bytearray()
+    return_address = array("Q")
+    thread_id = array("i")
+    payload = array("Q")
+    continued = []
+    pos = 0
+    while pos + block_header_size <= len(data):
+        size, tid, count = struct.unpack_from(block_header_fmt, data, pos)
+        if size == 0 or pos + size > len(data):
+            break
+        flags = count & BLOCK_CONTINUED
+        count &= ~BLOCK_CONTINUED
+        if max_events is not None and len(types) + count > max_events \
+                and len(types) > 0:
+            break
+        end = _decode_records(data, pos + block_header_size, count,
+                              types, return_address, payload)
+        if end != pos + size:
+            raise Error("corrupt block in tthread_log: "
+                        "expected %d bytes, decoded %d" % (size, end - pos))
+        thread_id.extend(array("i", [tid]) * count)
+        if flags and count > 0:
+            continued.append(start + len(types) - 1)
+        pos = end
+    return Batch(start, bytes(types), return_address, thread_id, payload,
+                 continued), pos
+
+
+def _parse_header(data):
+    header = Header(*struct.unpack_from(Header.fmt, data))
+    if header.version == COMPACT_VERSION:
+        header = HeaderV2(*struct.unpack_from(HeaderV2.fmt, data))
+    return header
+
+
+def _type_table(types):
+    return bytes(1 if t in types else 0 for t in range(256))
+
+
+_memory_table = _type_table((WRITE, READ))
+_not_table = bytes([1]) + bytes(255)
+space_names = ("heap", "global", "mmap")
+
+
+def _and(a, b):
+    n = len(a)
+    return (int.from_bytes(a, "little") &
+            int.from_bytes(b, "little")).to_bytes(n, "little")
+
+
+def _or(a, b):
+    n = len(a)
+    return (int.from_bytes(a, "little") |
+            int.from_bytes(b, "little")).to_bytes(n, "little")
+
+
+def _in_range(values, start, end):
+    return bytes(map(range(start, end).__contains__, values))
+
+
+# Returns the memory space of each address as bytes of indices into
+# `space_names`, computed with C-level iteration
+def classify_spaces(addresses, header):
+    heap = _in_range(addresses, header.heap_start, header.heap_end + 1)
+    global_ = _in_range(addresses, header.global_start, header.global_end + 1)
+    mmap_ = _or(heap, global_).translate(_not_table)
+    # heap 0, global 1, mmap 2: each byte is set in at most one mask
+    codes = int.from_bytes(global_, "little") \
+        + (int.from_bytes(mmap_, "little") << 1)
+    return codes.to_bytes(len(addresses), "little")
+
+
+# Selects events by type, thread, thunk, address range or memory space. The
+# masks are computed on the columns of a batch with C-level iteration
+# (bytes.translate, map over builtin methods), no event objects are created.
+# Address and space predicates only match read and write events.
+#
+# `thunks` are (thread_id, thunk_id) pairs. A thunk consists of its thunk
+# event and the following events of its thread up to the next thunk event,
+# events before the first thunk event belong to thunk 0. This predicate
+# keeps the current thunk of each thread, so batches must be applied in log
+# order; reading from the middle of a log starts from the log index.
+class Filter:
+    def __init__(self,
+                 types=None,
+                 threads=None,
+                 address_range=None,
+                 spaces=None,
+                 thunks=None):
+        self.types = None if types is None else _type_table(types)
+        self.threads = None if threads is None else frozenset(threads)
+        self.thunks = None if thunks is None else frozenset(thunks)
+        # thread_id -> current thunk id
+        self._current = {}
+        # [start, end)
+        self.address_range = address_range
+        if spaces is not None:
+            spaces = frozenset(spaces)
+            unknown = spaces - frozenset(space_names)
+            if unknown:
+                raise Error("unknown memory space: %s" % ", ".join(unknown))
+        self.spaces = spaces
+
+    def _space_mask(self, batch, header):
+        table = bytes(name in self.spaces for name in space_names)
+        return classify_spaces(batch.payload, header).translate(
+            table + bytes(256 - len(table)))
+
+    def _type_mask(self, batch, header):
+        return batch.types.translate(self.types)
+
+    def _thread_mask(self, batch, header):
+        return bytes(map(self.threads.__contains__, batch.thread_id))
+
+    def _thunk_mask(self, batch, header):
+        current = self._current
+        thunks = self.thunks
+        threads = {thread_id for thread_id, _ in thunks}
+        mask = bytearray(len(batch))
+        types = batch.types
+        thread_ids = batch.thread_id
+        # only events of the threads are visited
+        selected = bytes(map(threads.__contains__, thread_ids))
+        for i in compress(range(len(batch)), selected):
+            thread_id = thread_ids[i]
+            if types[i] == THUNK:
+                current[thread_id] = thunk_id(batch.payload[i])
+            if (thread_id, current.get(thread_id, 0)) in thunks:
+                mask[i] = 1
+        return bytes(mask)
+
+    # Sets the current thunks for reading from event `start` of `log`. They
+    # are looked up in the index of the log, if it has one, otherwise the
+    # thunk events before `start` are read.
+    def start(self, log, start):
+        self._current = {}
+        if self.thunks is None or start == 0:
+            return
+        threads = {thread_id for thread_id, _ in self.thunks}
+        index = log._loaded_index()
+        if index is None:
+            for batch in log.iter_batches(stop=start):
+                thunks = batch.thunks
+                for thread_id, payload in zip(thunks.thread_id,
+                                              thunks.payload):
+                    if thread_id in threads:
+                        self._current[thread_id] = thunk_id(payload)
+            return
+        for thread_id in threads:
+            ids, positions = index.thunks.get(thread_id, ((), ()))
+            i = bisect_right(positions, start - 1) - 1
+            if i >= 0:
+                self._current[thread_id] = ids[i]
+
+    def _memory_mask(self, batch, header):
+        return batch.types.translate(_memory_table)
+
+    def _address_mask(self, batch, header):
+        start, end = self.address_range
+        return _in_range(batch.payload, start, end)
+
+    # Predicates in two stages: the masks of a stage are combined and the
+    # batch is narrowed to the matching events, so the more expensive address
+    # predicates are only evaluated on the remaining events.
+    def _stages(self):
+        first = []
+        if self.types is not None:
+            first.append(self._type_mask)
+        if self.threads is not None:
+            first.append(self._thread_mask)
+        if self.thunks is not None:
+            # sees all thunk events, so it is never narrowed by other stages
+            first.append(self._thunk_mask)
+        if self.address_range is not None or self.spaces is not None:
+            first.append(self._memory_mask)
+        second = []
+        if self.address_range is not None:
+            second.append(self._address_mask)
+        if self.spaces is not None:
+            second.append(self._space_mask)
+        return [stage for stage in (first, second) if stage]
+
+    # returns a batch with the matching events
+    def apply(self, batch, header):
+        for stage in self._stages():
+            mask = stage[0](batch, header)
+            for predicate in stage[1:]:
+                mask = _and(mask, predicate(batch, header))
+            if 1 not in mask:
+                return batch.select(b"")
+            if 0 in mask:
+                batch = batch.select(mask)
+        return batch
+
+
+def maps_path(log_path):
+    return log_path + ".maps"
+
+
 class Log:
-    def __init__(self, return_code, log_file):
+    def __init__(self, return_code, log_file, maps_file=None):
         self.return_code = return_code
         self.file = log_file
+        # copy of /proc/<pid>/maps of the traced process, written on exit
+        self.maps_file = maps_file
+        self._mmap = None
+        # offsets and first event of all blocks in a version 2 log
+        self._blocks = None
+        self._index = None
+        self._index_saved = False
+
+    # Opens a log, which was written to `path` (see tthread.run(log_path=...))
+    @classmethod
+    def open(cls, path, return_code=None):
+        try:
+            log_file = open(path, "rb")
+        except OSError as e:
+            raise Error("failed to open tthread_log: %s" % e)
+        try:
+            maps_file = open(maps_path(path), "rb")
+        except FileNotFoundError:
+            maps_file = None
+        return cls(return_code, log_file, maps_file=maps_file)
+
+    # Yields events, optionally only those matching the arguments of Filter
+    def read(self, **filter_args):
+        filter = Filter(**filter_args) if filter_args else None
+        for batch in self.iter_batches(filter=filter):
+            yield from batch.events()
+
+    # path of the log file or None for anonymous files
+    @property
+    def path(self):
+        name = getattr(self.file, "name", None)
+        return name if isinstance(name, str) else None
+
+    # Returns the logindex.LogIndex of this log. It is read from the sidecar
+    # file next to the log or built on first use. If `save` is set and the
+    # log has a path, a built index is saved as sidecar file.
+    def index(self, save=False):
+        from tthread import logindex
+        index = self._loaded_index()
+        if index is None:
+            index = logindex.LogIndex.build(self)
+            self._set_index(index)
+        if save and not self._index_saved and self.path is not None:
+            logindex.save_sidecar(self.path, index)
+            self._index_saved = True
+        return index
 
-    def read(self):
+    # returns the index, if it was built or has a sidecar file, or None
+    def _loaded_index(self):
+        from tthread import logindex
         self.header = self._read_header()
-        for i in range(self.header.event_count):
-            event_bytes = self.file.read(log_event_size)
-            type_byte = event_bytes[0]
-            if type_byte >= len(events):
-                msg = "type field '%d' is out of range 0..%d" \
-                        % (type_byte, len(events))
+        if self._index is not None and self._index.is_current(self.header):
+            return self._index
+        if self.path is None:
+            return None
+        index = logindex.load_sidecar(self.path, self.header)
+        if index is not None:
+            self._set_index(index, saved=True)
+        return index
+
+    def _set_index(self, index, saved=False):
+        if index.blocks is not None:
+            self._blocks = index.blocks
+        self._index = index
+        self._index_saved = saved
+
+    # Yields the events [start, stop)
+    def slice(self, start, stop=None):
+        for batch in self.iter_batches(start=start, stop=stop):
+            yield from batch.events()
+
+    def _thread_events(self, thread_id, start=0, stop=None):
+        filter = Filter(threads=[thread_id])
+        for first, end in self.index().thread_ranges(thread_id, start, stop):
+            for batch in self.iter_batches(start=first,
+                                           stop=end,
+                                           filter=filter):
+                yield from batch.events()
+
+    # Yields the events of a thread, only the ranges of the log, which
+    # contain events of the thread, are read
+    def events_for_thread(self, thread_id):
+        return self._thread_events(thread_id)
+
+    # Yields the events of a thunk including its thunk event
+    def events_in_thunk(self, thread_id, thunk_id):
+        start, stop = self.index().thunk_range(thread_id, thunk_id)
+        return self._thread_events(thread_id, start, stop)
+
+    # returns dict event type -> number of events in [start, stop)
+    def type_counts(self, start=0, stop=None):
+        counts = self.index().type_counts(self, start, stop)
+        return {t: c for t, c in enumerate(counts) if t != INVALID}
+
+    # Decodes events [start, stop) in blocks of `batch_size` events,
+    # each block is read with a single read(). If a Filter is given, batches
+    # only contain matching events and empty batches are skipped.
+    def iter_batches(self, batch_size=65536, start=0, stop=None, filter=None):
+        if filter is not None:
+            filter.start(self, start)
+            for batch in self.iter_batches(batch_size, start, stop):
+                batch = filter.apply(batch, self.header)
+                if len(batch) > 0:
+                    yield batch
+            return
+
+        self.header = self._read_header()
+        if self.header.version == COMPACT_VERSION:
+            yield from self._iter_blocks(batch_size, start, stop)
+            return
+        count = self.header.event_count
+        if stop is None or stop > count:
+            stop = count
+        if start >= stop:
+            return
+        self.file.seek(self.header.header_size + start * log_event_size)
+        buf = bytearray(min(batch_size, stop - start) * log_event_size)
+        view = memoryview(buf)
+        while start < stop:
+            n = min(batch_size, stop - start)
+            size = n * log_event_size
+            read = self.file.readinto(view[:size])
+            if read != size:
+                msg = "tthread_log truncated: expected %d events, got %d" \
+                        % (stop, start + read // log_event_size)
                 raise Error(msg)
-            event = events[type_byte]
-            tuples = struct.unpack(event.fmt, event_bytes[:event.size])
-            yield event(*tuples)
+            yield decode_batch(view[:size], start)
+            start += n
+
+    # Returns (offsets, first events) of all blocks of a version 2 log.
+    # Only the block headers are read.
+    def _block_index(self):
+        if self._blocks is not None:
+            return self._blocks
+        fd = self.file.fileno()
+        offsets = array("Q")
+        first_events = array("Q")
+        pos = self.header.header_size
+        end = pos + self.header.data_size
+        index = 0
+        while pos < end:
+            data = os.pread(fd, block_header_size, pos)
+            if len(data) < block_header_size:
+                raise Error("tthread_log truncated at offset %d" % pos)
+            size, _, count = struct.unpack(block_header_fmt, data)
+            count &= ~BLOCK_CONTINUED
+            if size == 0:
+                raise Error("tthread_log truncated: "
+                            "incomplete block at offset %d" % pos)
+            offsets.append(pos)
+            first_events.append(index)
+            pos += size
+            index += count
+        self._blocks = (offsets, first_events)
+        return self._blocks
+
+    # iter_batches() for version 2 logs, the log is read with os.pread(),
+    # so forked processes can share the file
+    def _iter_blocks(self, batch_size, start, stop):
+        fd = self.file.fileno()
+        pos = self.header.header_size
+        end = pos + self.header.data_size
+        index = 0
+        if start > 0:
+            offsets, first_events = self._block_index()
+            i = bisect_right(first_events, start) - 1
+            if i < 0:
+                return
+            pos, index = offsets[i], first_events[i]
+        chunk_size = 1 << 20
+        while pos < end and (stop is None or index < stop):
+            data = os.pread(fd, min(chunk_size, end - pos), pos)
+            batch, consumed = decode_blocks(data, index, batch_size)
+            if consumed == 0:
+                size = 0
+                if len(data) >= block_header_size:
+                    size, _, _ = struct.unpack_from(block_header_fmt, data)
+                if size > len(data) and pos + size <= end:
+                    chunk_size = size
+                    continue
+                raise Error("tthread_log truncated: "
+                            "incomplete block at offset %d" % pos)
+            pos += consumed
+            first = max(start - index, 0)
+            last = len(batch)
+            if stop is not None:
+                last = min(last, stop - index)
+            index += len(batch)
+            if first > 0 or last < len(batch):
+                batch = batch._range(first, last)
+            if len(batch) > 0:
+                yield batch
+
+    # Memory-maps the log and returns all events as numpy structured array
+    # (see `array_fields`) without copying them
+    def mmap(self):
+        numpy = _import_numpy()
+        self.header = self._read_header()
+        if self.header.version != VERSION:
+            msg = "memory-mapped access requires a version %d tthread_log, " \
+                  "got version %d" % (VERSION, self.header.version)
+            raise Error(msg)
+        dtype = numpy.dtype(array_fields)
+        assert dtype.itemsize == log_event_size
+        if self.header.event_count == 0:
+            return numpy.zeros(0, dtype=dtype)
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self.file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        size = self.header.header_size \
+            + self.header.event_count * log_event_size
+        if len(self._mmap) < size:
+            msg = "expected tthread_log to be at least %d, got %d" \
+                    % (size, len(self._mmap))
+            raise Error(msg)
+        return numpy.frombuffer(self._mmap,
+                                dtype=dtype,
+                                count=self.header.event_count,
+                                offset=self.header.header_size)
+
+    # Returns an EventArray of all events. Version 1 logs are memory-mapped,
+    # version 2 logs are decoded into memory.
+    def to_array(self):
+        self.header = self._read_header()
+        if self.header.version == COMPACT_VERSION:
+            return EventArray(self._decode_array(), self.header)
+        return EventArray(self.mmap(), self.header)
+
+    def _decode_array(self):
+        numpy = _import_numpy()
+        batches = list(self.iter_batches())
+        array = numpy.zeros(sum(map(len, batches)),
+                            dtype=numpy.dtype(array_fields))
+        start = 0
+        for batch in batches:
+            end = start + len(batch)
+            array["type"][start:end] = numpy.frombuffer(batch.types, "u1")
+            array["return_address"][start:end] = \
+                numpy.frombuffer(batch.return_address, "u8")
+            array["thread_id"][start:end] = \
+                numpy.frombuffer(batch.thread_id, "i4")
+            array["payload"][start:end] = numpy.frombuffer(batch.payload, "u8")
+            start = end
+        return array
 
     def is_heap(self, addr):
         return self.header.heap_start <= addr <= self.header.heap_end
@@ -86,6 +874,25 @@ class Log:
     def is_mmap(self, addr):
         return not (self.is_heap(addr) or self.is_global(addr))
 
+    # returns the memory mappings of the traced process
+    # as list of symbols.Mapping
+    def memory_map(self):
+        from tthread import symbols
+        if self.maps_file is None:
+            raise Error("memory map of the traced process was not recorded")
+        self.maps_file.seek(0)
+        return symbols.parse_maps(self.maps_file.read().decode("utf-8"))
+
+    # returns a regions.RegionIndex of the memory map and the heap and global
+    # ranges of this log
+    def regions(self):
+        from tthread import regions
+        return regions.RegionIndex.from_log(self)
+
+    def symbolizer(self, **kwargs):
+        from tthread import symbols
+        return symbols.Symbolizer(self.memory_map(), **kwargs)
+
     def _read_header(self):
         try:
             stat = os.fstat(self.file.fileno())
@@ -95,15 +902,148 @@ class Log:
             msg = "expected tthread_log to be at least %d, got %d" \
                     % (Header.size, stat.st_size)
             raise Error(msg)
-        header_bytes = self.file.read(Header.size)
-        header = Header(*struct.unpack(Header.fmt, header_bytes))
-        self.file.seek(header.header_size)
+        self.file.seek(0)
+        header_bytes = self.file.read(HeaderV2.size)
+        header = _parse_header(header_bytes)
         if header.file_magic != log_file_magic:
             msg = "expect file_magick of tthread_log " \
                   "to be equal %d, got %d" \
-                  % (log_file_magic, header.file_magick)
+                  % (log_file_magic, header.file_magic)
             raise Error(msg)
+        if header.version not in (VERSION, COMPACT_VERSION):
+            raise Error("unsupported tthread_log version %d" % header.version)
+        self.file.seek(header.header_size)
         return header
 
     def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # arrays returned by mmap() are still alive,
+                # the mapping is released with them
+                pass
+            self._mmap = None
         self.file.close()
+        if self.maps_file is not None:
+            self.maps_file.close()
+
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+try:
+    import ctypes
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_int64, ctypes.c_int64]
+except (ImportError, OSError, AttributeError):
+    _fallocate = None
+
+
+def _punch_hole(fd, offset, length):
+    if _fallocate is None:
+        raise Error("discarding tthread_log ranges needs fallocate()")
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if _fallocate(fd, mode, offset, length) != 0:
+        errno = ctypes.get_errno()
+        raise Error("failed to discard tthread_log range: %s"
+                    % os.strerror(errno))
+
+
+# Incrementally reads a log, while it is still written by libtthread.
+# In version 1 logs the logger increments `event_count` before an event is
+# written and writes the type of an event last, so a poll stops at the first
+# event, which has not been written yet (type INVALID). In version 2 logs it
+# stops at the first block, which has no size yet.
+class Tail:
+    def __init__(self, log_file, discard=False):
+        self.fd = log_file.fileno()
+        self.header = None
+        # number of events returned so far
+        self.position = 0
+        # file offset after the events returned so far
+        self.offset = None
+        # free disk space of events returned so far
+        self.discard = discard
+        self._discarded = 0
+
+    def _read_header(self):
+        header_bytes = os.pread(self.fd, HeaderV2.size, 0)
+        if len(header_bytes) < HeaderV2.size:
+            # libtthread has not been initialized yet
+            return None
+        header = _parse_header(header_bytes)
+        if header.file_magic != log_file_magic:
+            return None
+        if header.version not in (VERSION, COMPACT_VERSION):
+            raise Error("unsupported tthread_log version %d" % header.version)
+        return header
+
+    # Returns a batch with all events written since the last call.
+    # If `final` is set, the writer has exited and all remaining events
+    # are returned.
+    def poll(self, final=False, batch_size=65536):
+        header = self._read_header()
+        if header is None:
+            if final:
+                raise Error("tthread_log was never initialized")
+            return decode_batch(b"", self.position)
+        self.header = header
+        if self.offset is None:
+            self.offset = header.header_size
+        if header.version == COMPACT_VERSION:
+            batch = self._poll_blocks(header, batch_size)
+        else:
+            batch = self._poll_events(header, final, batch_size)
+        self.position += len(batch)
+        if self.discard:
+            self._discard(header)
+        return batch
+
+    def _poll_events(self, header, final, batch_size):
+        count = min(header.event_count, self.position + batch_size)
+        if count <= self.position:
+            return decode_batch(b"", self.position)
+        data = os.pread(self.fd,
+                        (count - self.position) * log_event_size,
+                        self.offset)
+        n = len(data) // log_event_size
+        if not final:
+            unwritten = data[0:n * log_event_size:log_event_size].find(0)
+            if unwritten >= 0:
+                n = unwritten
+            # the fields of an event are written before its type, but may
+            # have been read before it: read the written events again
+            data = os.pread(self.fd, n * log_event_size, self.offset)
+            n = len(data) // log_event_size
+        size = n * log_event_size
+        self.offset += size
+        return decode_batch(memoryview(data)[:size], self.position)
+
+    def _poll_blocks(self, header, batch_size):
+        end = header.header_size + header.data_size
+        size = 1 << 20
+        while self.offset < end:
+            data = os.pread(self.fd, min(size, end - self.offset), self.offset)
+            batch, consumed = decode_blocks(data, self.position, batch_size)
+            if consumed > 0:
+                self.offset += consumed
+                return batch
+            if len(data) < block_header_size:
+                break
+            block_size, _, _ = struct.unpack_from(block_header_fmt, data)
+            if block_size <= len(data) or \
+                    self.offset + block_size > end:
+                # not written yet
+                break
+            size = block_size
+        return decode_batch(b"", self.position)
+
+    def _discard(self, header):
+        end = self.offset - self.offset % mmap.PAGESIZE
+        start = max(self._discarded, header.header_size)
+        if end > start:
+            _punch_hole(self.fd, start, end - start)
+            self._discarded = end
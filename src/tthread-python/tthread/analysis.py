@@ -0,0 +1,218 @@
+from array import array
+from bisect import bisect_left
+from tthread import accesslog, arrayfile
+
+PAGE_SHIFT = 12
+
+# access modes stored per (page, thunk)
+READ = 1
+WRITE = 2
+
+
+def page_of(addr):
+    return addr >> PAGE_SHIFT
+
+
+file_magic = b"TTPAGES\0"
+
+
+def _bits(mask):
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+# Index of all pages accessed in a log
+#
+# threads and thunks are numbered in the order of their first event:
+#   threads[i] = thread_id
+#   thunks[i] = (thread_id, thunk_id), thunk 0 of a thread contains all
+#   accesses before its first thunk event.
+# per page:
+#   readers/writers: bitmask over thread numbers
+#   page_thunks: sorted array of thunk numbers, which accessed the page
+#   page_modes: READ/WRITE bits for each entry in page_thunks
+#   first_touch: return address of the first access
+#
+# save() stores the index as arrayfile, the thread masks as bytes.
+class PageIndex:
+    version = 2
+
+    def __init__(self):
+        self.threads = []
+        self.thunks = []
+        # (thread_id, thunk_id) -> thunk number
+        self.thunk_numbers = {}
+        self.readers = {}
+        self.writers = {}
+        self.page_thunks = {}
+        self.page_modes = {}
+        self.first_touch = {}
+        self._write_shared = None
+
+    @classmethod
+    def build(cls, log, batch_size=65536):
+        index = cls()
+        thread_numbers = {}
+        thunk_numbers = index.thunk_numbers
+        # thread number -> current thunk number
+        current = {}
+        readers, writers = index.readers, index.writers
+        page_thunks, page_modes = index.page_thunks, index.page_modes
+        first_touch = index.first_touch
+        for batch in log.iter_batches(batch_size):
+            for type_, return_address, thread_id, payload in batch.rows():
+                thread = thread_numbers.get(thread_id)
+                if thread is None:
+                    thread = thread_numbers[thread_id] = len(index.threads)
+                    index.threads.append(thread_id)
+                    key = (thread_id, 0)
+                    thunk_numbers[key] = current[thread] = len(index.thunks)
+                    index.thunks.append(key)
+                if type_ == accesslog.THUNK:
+                    key = (thread_id, accesslog.thunk_id(payload))
+                    thunk = thunk_numbers.get(key)
+                    if thunk is None:
+                        thunk = thunk_numbers[key] = len(index.thunks)
+                        index.thunks.append(key)
+                    current[thread] = thunk
+                    continue
+                if type_ == accesslog.WRITE:
+                    mode = WRITE
+                    masks = writers
+                elif type_ == accesslog.READ:
+                    mode = READ
+                    masks = readers
+                else:
+                    continue
+                page = payload >> PAGE_SHIFT
+                masks[page] = masks.get(page, 0) | (1 << thread)
+                thunk = current[thread]
+                thunks = page_thunks.get(page)
+                if thunks is None:
+                    page_thunks[page] = array("I", [thunk])
+                    page_modes[page] = bytearray([mode])
+                    first_touch[page] = return_address
+                elif thunks[-1] == thunk:
+                    page_modes[page][-1] |= mode
+                else:
+                    thunks.append(thunk)
+                    page_modes[page].append(mode)
+        index._sort()
+        return index
+
+    # accesses of thunks running in parallel are interleaved in the log,
+    # sort and merge them to allow lookups with bisect
+    def _sort(self):
+        for page, thunks in self.page_thunks.items():
+            if all(a < b for a, b in zip(thunks, thunks[1:])):
+                continue
+            merged = {}
+            for thunk, mode in zip(thunks, self.page_modes[page]):
+                merged[thunk] = merged.get(thunk, 0) | mode
+            order = sorted(merged)
+            self.page_thunks[page] = array("I", order)
+            self.page_modes[page] = bytearray(merged[t] for t in order)
+
+    def __len__(self):
+        return len(self.page_thunks)
+
+    def __contains__(self, page):
+        return page in self.page_thunks
+
+    def pages(self):
+        return sorted(self.page_thunks)
+
+    def readers_of(self, page):
+        return [self.threads[i] for i in _bits(self.readers.get(page, 0))]
+
+    def writers_of(self, page):
+        return [self.threads[i] for i in _bits(self.writers.get(page, 0))]
+
+    def is_write_shared(self, page):
+        writers = self.writers.get(page, 0)
+        if writers == 0:
+            return False
+        accessors = writers | self.readers.get(page, 0)
+        return accessors & (accessors - 1) != 0
+
+    # pages written by one thread and accessed by at least one other thread
+    def write_shared_pages(self):
+        if self._write_shared is None:
+            self._write_shared = [p for p in sorted(self.writers)
+                                  if self.is_write_shared(p)]
+        return self._write_shared
+
+    # returns list of (thread_id, thunk_id, mode)
+    def thunks_of(self, page):
+        thunks = self.page_thunks.get(page, [])
+        modes = self.page_modes.get(page, b"")
+        return [self.thunks[t] + (m,) for t, m in zip(thunks, modes)]
+
+    # returns READ/WRITE bits of the accesses of a thunk to a page
+    def access_mode(self, page, thread_id, thunk_id):
+        thunks = self.page_thunks.get(page)
+        if thunks is None:
+            return 0
+        thunk = self.thunk_numbers.get((thread_id, thunk_id))
+        if thunk is None:
+            return 0
+        i = bisect_left(thunks, thunk)
+        if i < len(thunks) and thunks[i] == thunk:
+            return self.page_modes[page][i]
+        return 0
+
+    def first_touch_of(self, page):
+        return self.first_touch.get(page)
+
+    def save(self, f):
+        pages = self.pages()
+        masks = []
+        for table in (self.readers, self.writers):
+            lengths = array("I")
+            data = bytearray()
+            for page in pages:
+                mask = table.get(page, 0)
+                size = (mask.bit_length() + 7) // 8
+                lengths.append(size)
+                data += mask.to_bytes(size, "little")
+            masks += [lengths, data]
+        arrayfile.write(f, file_magic, self.version, [
+            array("i", self.threads),
+            array("i", (thread_id for thread_id, _ in self.thunks)),
+            array("i", (thunk_id for _, thunk_id in self.thunks)),
+            array("Q", pages),
+            array("Q", (len(self.page_thunks[p]) for p in pages)),
+            arrayfile.concat("I", (self.page_thunks[p] for p in pages)),
+            b"".join(self.page_modes[p] for p in pages),
+            array("Q", (self.first_touch[p] for p in pages)),
+        ] + masks)
+
+    @classmethod
+    def load(cls, f):
+        (threads, thunk_threads, thunk_ids, pages, counts, thunks, modes,
+         first_touch, reader_lengths, readers, writer_lengths,
+         writers) = arrayfile.read(f, file_magic, cls.version,
+                                   "iiiQQIBQIBIB")
+        if len(thunk_threads) != len(thunk_ids) \
+                or not len(pages) == len(counts) == len(first_touch) \
+                == len(reader_lengths) == len(writer_lengths) \
+                or len(modes) != len(thunks):
+            raise arrayfile.Error("page index is corrupt")
+        index = cls()
+        index.threads = threads.tolist()
+        index.thunks = list(zip(thunk_threads, thunk_ids))
+        index.thunk_numbers = {key: i for i, key in enumerate(index.thunks)}
+        index.page_thunks = dict(zip(pages, arrayfile.split(thunks, counts)))
+        index.page_modes = {page: bytearray(m) for page, m in
+                            zip(pages, arrayfile.split(modes, counts))}
+        index.first_touch = dict(zip(pages, first_touch))
+        for table, lengths, data in ((index.readers, reader_lengths, readers),
+                                     (index.writers, writer_lengths, writers)):
+            for page, mask in zip(pages, arrayfile.split(data, lengths)):
+                if mask:
+                    table[page] = int.from_bytes(mask, "little")
+        return index
@@ -5,7 +5,10 @@ import os
 import argparse
 import tthread
 
-from tthread import formats
+from tthread.formats import ChromeTraceWriter, TabularWriter
+from tthread.output import compressor_for, open_output
+from tthread import formats, columnar, diff, parallel, serialization
+from tthread import sqlite, stats
 
 
 def abort(msg):
@@ -15,6 +18,10 @@ def abort(msg):
 formats = {
         "tsv": formats.TsvWriter,
         "tsv2": formats.Tsv2Writer,
+        "columnar": columnar.ColumnarWriter,
+        "stats": stats.StatsWriter,
+        "chrome": formats.ChromeTraceWriter,
+        "serialization": serialization.SerializationWriter,
 }
 
 supported_formats = ", ".join(formats.keys())
@@ -29,7 +36,8 @@ def parse_arguments():
                         nargs="?",
                         default=tthread.default_library_path(),
                         help=h1)
-    h2 = "path to trace file (default: stdout); " \
+    h2 = "path to trace file (default: stdout), compressed if it ends " \
+         "with .gz, .zst or .lz4; " \
          "if no trace file is specified, " \
          "stdout of programm is redirected to stderr"
     parser.add_argument("--output", nargs="?",
@@ -39,6 +47,26 @@ def parse_arguments():
     parser.add_argument("--format", nargs="?",
                         default="tsv",
                         help=h3)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes to decode the log "
+                        "(supported by tsv and tsv2; default: 1)")
+    parser.add_argument("--symbolize", action="store_true",
+                        help="resolve return addresses to symbols "
+                        "(supported by tsv, tsv2, stats and chrome)")
+    parser.add_argument("--regions", action="store_true",
+                        help="classify addresses outside heap and global by "
+                        "their mapping (library, file, stack, anonymous) "
+                        "instead of mmap (supported by tsv and tsv2)")
+    parser.add_argument("--log-version", type=int, choices=[1, 2],
+                        default=1,
+                        help="format of the log written by libtthread, "
+                        "2 is more compact (default: 1)")
+    parser.add_argument("--log",
+                        help="keep the raw log of libtthread at this path "
+                        "(default: temporary file)")
+    parser.add_argument("--log-size", type=int,
+                        help="expected size of the raw log in bytes, "
+                        "libtthread preallocates it")
     parser.add_argument("command", nargs=1,
                         help="command to execute with")
     parser.add_argument("arguments", nargs="*",
@@ -47,9 +75,65 @@ def parse_arguments():
     return parser.parse_args()
 
 
+def parse_diff_arguments(argv):
+    desc = "Compare the pages accessed by each thunk of two logs " \
+           "(written with --log)."
+    parser = argparse.ArgumentParser(prog="tthread diff", description=desc)
+    parser.add_argument("--limit", type=int,
+                        help="stop after this many threads diverged")
+    parser.add_argument("log_a", help="first log")
+    parser.add_argument("log_b", help="second log")
+    return parser.parse_args(argv)
+
+
+# exit status as diff(1): 0 if the logs match, 1 if they diverge
+def diff_main(argv):
+    args = parse_diff_arguments(argv)
+    try:
+        a = tthread.accesslog.Log.open(args.log_a)
+        b = tthread.accesslog.Log.open(args.log_b)
+        divergences = diff.diff(a, b, limit=args.limit)
+    except tthread.Error as e:
+        print("diff fails: %s" % e, file=sys.stderr)
+        sys.exit(2)
+    for divergence in divergences:
+        print(divergence)
+    sys.exit(1 if divergences else 0)
+
+
+def parse_load_sqlite_arguments(argv):
+    desc = "Load a log (written with --log) into an SQLite database."
+    parser = argparse.ArgumentParser(prog="tthread load-sqlite",
+                                     description=desc)
+    parser.add_argument("log", help="log to load")
+    parser.add_argument("database", help="new SQLite database")
+    return parser.parse_args(argv)
+
+
+def load_sqlite_main(argv):
+    args = parse_load_sqlite_arguments(argv)
+    try:
+        log = tthread.accesslog.Log.open(args.log)
+        events, thunks = sqlite.load(log, args.database)
+    except tthread.Error as e:
+        abort("load-sqlite fails: %s" % e)
+    print("loaded %d events and %d thunks into %s"
+          % (events, thunks, args.database), file=sys.stderr)
+    sys.exit(0)
+
+
+commands = {
+        "diff": diff_main,
+        "load-sqlite": load_sqlite_main,
+}
+
+
 def main():
     if sys.version_info < (3, 0):
         abort("this script requires Python 3.x, not Python 2.x")
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        # use `tthread -- diff ...` to trace diff(1)
+        commands[sys.argv[1]](sys.argv[2:])
     args = parse_arguments()
 
     if not os.path.isfile(args.libtthread_path):
@@ -60,23 +144,61 @@ def main():
     if formatter is None:
         abort("unsupported format %s, supported formats are %s" %
               (args.format, supported_formats))
+    tabular = issubclass(formatter, TabularWriter)
+    symbolize = tabular or formatter in (stats.StatsWriter, ChromeTraceWriter)
+    if args.symbolize and not symbolize:
+        abort("format %s does not support --symbolize" % args.format)
+    if args.regions and not tabular:
+        abort("format %s does not support --regions" % args.format)
+    if args.jobs > 1 and not tabular:
+        abort("format %s does not support --jobs" % args.format)
 
     if args.output is None:
         stdout = sys.stderr
-        output = sys.stdout
     else:
         stdout = sys.stdout
         try:
-            output = open(args.output)
-        except EnvironmentError as e:
-            abort("failed to open output '%s'" % e)
+            # fails before the run, if the compression module is missing
+            compressor_for(args.output)
+        except tthread.Error as e:
+            abort(str(e))
 
     command = args.command + args.arguments
     try:
-        process = tthread.run(command, args.libtthread_path, stdout=stdout)
+        process = tthread.run(command,
+                              args.libtthread_path,
+                              stdout=stdout,
+                              log_version=args.log_version,
+                              log_path=args.log,
+                              expected_size=args.log_size)
         log = process.wait()
         if log.return_code != 0:
             print("process exited with: %d" % log.return_code, file=sys.stderr)
+        options = {}
+        if args.symbolize:
+            options["symbolizer"] = log.symbolizer()
+        if args.regions:
+            options["regions"] = log.regions()
+        writer = formatter(log, **options)
+        if args.jobs > 1:
+            # forks the workers before open_output() starts a thread
+            writer = parallel.ParallelWriter(writer, workers=args.jobs)
     except tthread.Error as e:
         abort("Execution fails: %s" % e)
-    formatter(log).write(output)
+
+    # binary formats are written to a byte stream
+    binary = getattr(formatter, "binary", False)
+    if args.output is None:
+        output = sys.stdout.buffer if binary else sys.stdout
+    else:
+        try:
+            # compressed according to the extension (.gz, .zst, .lz4)
+            output = open_output(args.output, binary)
+        except tthread.Error as e:
+            abort(str(e))
+    writer.write(output)
+    if args.output is not None:
+        try:
+            output.close()
+        except tthread.Error as e:
+            abort(str(e))
@@ -0,0 +1,86 @@
+import struct
+import sys
+from array import array
+from itertools import accumulate
+from tthread import accesslog
+
+# File of arrays, used to store indexes of logs
+#
+# file layout:
+#   header: magic, version, byte order, number of arrays
+#   per array: typecode, size in bytes, followed by the items
+#
+# Only arrays are stored, loading a file never creates other objects.
+
+header_fmt = "=8sIBxxxI"
+array_header_fmt = "=c7xQ"
+
+_byteorder = {"little": 0, "big": 1}[sys.byteorder]
+
+
+class Error(accesslog.Error):
+    pass
+
+
+# writes `arrays`, a bytes-like object is written as array("B")
+def write(f, magic, version, arrays):
+    f.write(struct.pack(header_fmt, magic, version, _byteorder, len(arrays)))
+    for values in arrays:
+        if not isinstance(values, array):
+            values = array("B", values)
+        data = values.tobytes()
+        f.write(struct.pack(array_header_fmt,
+                            values.typecode.encode("ascii"),
+                            len(data)))
+        f.write(data)
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise Error("array file is truncated")
+    return data
+
+
+# returns the list of arrays written by write(), whose typecodes must match
+# `typecodes`
+def read(f, magic, version, typecodes):
+    header = _read(f, struct.calcsize(header_fmt))
+    magic_, version_, byteorder, count = struct.unpack(header_fmt, header)
+    if magic_ != magic:
+        raise Error("not a %s file" % magic.rstrip(b"\0").decode("ascii"))
+    if version_ != version:
+        raise Error("unsupported %s version %d"
+                    % (magic.rstrip(b"\0").decode("ascii"), version_))
+    if byteorder != _byteorder:
+        raise Error("array file has a different byte order")
+    if count != len(typecodes):
+        raise Error("array file has %d arrays, expected %d"
+                    % (count, len(typecodes)))
+    arrays = []
+    for typecode in typecodes:
+        header = _read(f, struct.calcsize(array_header_fmt))
+        typecode_, size = struct.unpack(array_header_fmt, header)
+        values = array(typecode)
+        if typecode_ != typecode.encode("ascii") \
+                or size % values.itemsize != 0:
+            raise Error("array file is corrupt")
+        values.frombytes(_read(f, size))
+        arrays.append(values)
+    return arrays
+
+
+# concatenates arrays of `typecode`
+def concat(typecode, parts):
+    values = array(typecode)
+    for part in parts:
+        values.extend(part)
+    return values
+
+
+# splits `values` into parts of `counts` items
+def split(values, counts):
+    if sum(counts) != len(values):
+        raise Error("array file is corrupt")
+    ends = list(accumulate(counts))
+    return [values[end - count:end] for count, end in zip(counts, ends)]
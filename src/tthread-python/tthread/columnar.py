@@ -0,0 +1,260 @@
+import json
+import operator
+import struct
+import zlib
+from array import array
+from collections import namedtuple
+from itertools import accumulate, chain, compress, count, filterfalse, islice
+from tthread import accesslog
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Columnar container for access logs
+#
+# file layout:
+#   magic
+#   row group 0: one zlib-compressed block per column
+#   row group 1: ...
+#   footer: json document with the memory layout and
+#           the offsets of all column blocks
+#   footer size (uint64) + magic
+#
+# columns:
+#   type: one byte per event
+#   thread_id: int32 per event
+#   return_address: uint32 index into the return address dictionary,
+#       each row group stores the dictionary entries it added
+#       in the block `return_address_dict` (uint64)
+#   payload: address or thunk id; delta-encoded (int64) against the previous
+#       payload of a memory event respectively of a thunk/finish event
+
+# memory layout of the traced process, stored in the footer
+Layout = namedtuple("Layout", ["global_start", "global_end",
+                               "heap_start", "heap_end"])
+
+file_magic = b"TTCOLv1\0"
+footer_fmt = "=Q"
+column_names = ["type", "return_address", "thread_id", "payload"]
+row_group_size = 1 << 20
+
+_mask = (1 << 64) - 1
+
+
+class Error(accesslog.Error):
+    pass
+
+
+# 1 for read and write events, whose payload is an address
+_memory_table = bytes(t in (accesslog.WRITE, accesslog.READ)
+                      for t in range(256))
+_invert_table = bytes([1, 0]) + bytes(254)
+
+# Deltas are computed per stream (memory and other events) on whole columns:
+# with numpy if it is installed, otherwise with C-level iteration: the
+# payloads are split with the memory mask, differenced or summed with
+# map/accumulate, and merged back in event order by taking the next value of
+# the stream each mask byte selects.
+
+
+def _split(payload, memory):
+    return (array("Q", compress(payload, memory.translate(_invert_table))),
+            array("Q", compress(payload, memory)))
+
+
+def _merge(memory, streams):
+    iterators = tuple(map(iter, streams))
+    return array("Q", map(next, map(iterators.__getitem__, memory)))
+
+
+# applies `function(values, last)`, which returns the result and the new
+# last payload, to the memory and to the other events with numpy; uint64
+# arithmetic wraps around
+def _numpy_streams(function, types, values, last):
+    memory = numpy.frombuffer(types.translate(_memory_table), dtype=bool)
+    values = numpy.frombuffer(values, dtype=numpy.uint64)
+    result = numpy.empty_like(values)
+    for i, selected in enumerate((~memory, memory)):
+        stream = values[selected]
+        if len(stream):
+            result[selected], last[i] = function(stream,
+                                                 numpy.uint64(last[i]))
+    return array("Q", result.tobytes())
+
+
+def _numpy_deltas(payload, last):
+    return numpy.diff(payload, prepend=last), int(payload[-1])
+
+
+def _numpy_sums(deltas, last):
+    payload = numpy.cumsum(deltas, dtype=numpy.uint64) + last
+    return payload, int(payload[-1])
+
+
+# deltas modulo 2**64, which are stored as int64
+def _delta_encode(types, payload, last):
+    if numpy is not None:
+        return _numpy_streams(_numpy_deltas, types, payload, last)
+    memory = types.translate(_memory_table)
+    streams = _split(payload, memory)
+    deltas = []
+    for i, values in enumerate(streams):
+        previous = chain((last[i],), values)
+        deltas.append(array("Q", map(_mask.__and__,
+                                     map(operator.sub, values, previous))))
+        if values:
+            last[i] = values[-1]
+    return _merge(memory, deltas)
+
+
+def _delta_decode(types, deltas, last):
+    if numpy is not None:
+        return _numpy_streams(_numpy_sums, types, deltas, last)
+    memory = types.translate(_memory_table)
+    streams = _split(deltas, memory)
+    payloads = []
+    for i, values in enumerate(streams):
+        sums = islice(accumulate(chain((last[i],), values)), 1, None)
+        payloads.append(array("Q", map(_mask.__and__, sums)))
+        if values:
+            last[i] = payloads[-1][-1]
+    return _merge(memory, payloads)
+
+
+class ColumnarWriter:
+    binary = True
+
+    def __init__(self, log, compression_level=6):
+        self.log = log
+        self.compression_level = compression_level
+
+    def write(self, f):
+        f.write(file_magic)
+        offset = len(file_magic)
+        row_groups = []
+        addresses = {}
+        last_payload = [0, 0]
+        for batch in self.log.iter_batches(batch_size=row_group_size):
+            # addresses not seen before, in the order they appear
+            new_addresses = array("Q", filterfalse(
+                addresses.__contains__,
+                dict.fromkeys(batch.return_address)))
+            addresses.update(zip(new_addresses, count(len(addresses))))
+            indices = array("I", map(addresses.__getitem__,
+                                     batch.return_address))
+            payload = _delta_encode(batch.types, batch.payload, last_payload)
+            blocks = [
+                ("type", batch.types),
+                ("return_address", indices.tobytes()),
+                ("return_address_dict", new_addresses.tobytes()),
+                ("thread_id", batch.thread_id.tobytes()),
+                ("payload", payload.tobytes()),
+            ]
+            group = {"count": len(batch), "columns": {}}
+            for name, data in blocks:
+                block = zlib.compress(data, self.compression_level)
+                f.write(block)
+                group["columns"][name] = [offset, len(block)]
+                offset += len(block)
+            row_groups.append(group)
+
+        header = self.log.header
+        footer = json.dumps({
+            "version": 1,
+            "event_count": sum(g["count"] for g in row_groups),
+            "global_start": header.global_start,
+            "global_end": header.global_end,
+            "heap_start": header.heap_start,
+            "heap_end": header.heap_end,
+            "row_groups": row_groups,
+        }).encode("utf-8")
+        f.write(footer)
+        f.write(struct.pack(footer_fmt, len(footer)))
+        f.write(file_magic)
+
+
+# Loads columns written by ColumnarWriter. Only the blocks of the requested
+# columns are read and decompressed.
+class ColumnarReader:
+    def __init__(self, f):
+        self.file = f
+        self.footer = self._read_footer()
+        self.event_count = self.footer["event_count"]
+        self.layout = Layout(*(self.footer[name] for name in Layout._fields))
+
+    def _read_footer(self):
+        tail_size = struct.calcsize(footer_fmt) + len(file_magic)
+        self.file.seek(0)
+        if self.file.read(len(file_magic)) != file_magic:
+            raise Error("not a columnar tthread log")
+        self.file.seek(-tail_size, 2)
+        tail = self.file.read(tail_size)
+        if tail[-len(file_magic):] != file_magic:
+            raise Error("columnar tthread log is truncated")
+        size, = struct.unpack(footer_fmt, tail[:-len(file_magic)])
+        self.file.seek(-(tail_size + size), 2)
+        return json.loads(self.file.read(size).decode("utf-8"))
+
+    # returns the memory space of each address as bytes of indices into
+    # accesslog.space_names
+    def spaces(self, addresses):
+        return accesslog.classify_spaces(addresses, self.layout)
+
+    def _block(self, group, name):
+        offset, size = group["columns"][name]
+        self.file.seek(offset)
+        return zlib.decompress(self.file.read(size))
+
+    # Yields one dict column name -> array per row group
+    def iter_row_groups(self, columns=column_names):
+        for name in columns:
+            if name not in column_names:
+                raise Error("unknown column '%s'" % name)
+        dictionary = array("Q")
+        last_payload = [0, 0]
+        for group in self.footer["row_groups"]:
+            result = {}
+            types = None
+            if "type" in columns or "payload" in columns:
+                types = self._block(group, "type")
+            if "type" in columns:
+                result["type"] = types
+            if "return_address" in columns:
+                dictionary.frombytes(self._block(group,
+                                                 "return_address_dict"))
+                indices = array("I", self._block(group, "return_address"))
+                result["return_address"] = array(
+                    "Q", map(dictionary.__getitem__, indices))
+            if "thread_id" in columns:
+                result["thread_id"] = array("i", self._block(group,
+                                                             "thread_id"))
+            if "payload" in columns:
+                deltas = array("Q", self._block(group, "payload"))
+                result["payload"] = _delta_decode(types,
+                                                  deltas,
+                                                  last_payload)
+            yield result
+
+    # Returns dict column name -> array of all events
+    def read(self, columns=column_names):
+        result = {}
+        # bytes columns are joined once, concatenating copies them
+        parts = {}
+        for group in self.iter_row_groups(columns):
+            for name, values in group.items():
+                if not isinstance(values, array):
+                    parts.setdefault(name, []).append(values)
+                elif name in result:
+                    result[name] += values
+                else:
+                    result[name] = values
+        for name, values in parts.items():
+            result[name] = b"".join(values)
+        return result
+
+
+def load(path, columns=column_names):
+    with open(path, "rb") as f:
+        return ColumnarReader(f).read(columns)
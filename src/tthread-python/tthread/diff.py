@@ -0,0 +1,233 @@
+import hashlib
+import struct
+from array import array
+from bisect import bisect_right
+from collections import deque, namedtuple
+from itertools import zip_longest
+from tthread import accesslog, regions
+from tthread.analysis import PAGE_SHIFT
+
+# Determinism check of two logs
+#
+# The accesses of each thunk are reduced to a digest of the sorted set of
+# (page, space, write) keys. Threads are numbered in the order of their first
+# event in the log, heap and global pages are counted from the start of their
+# region and other pages from the start of their mapping in the recorded
+# memory map (see Log.memory_map()). A mapping is identified by its path, its
+# file offset and its position among the mappings with the same path and
+# offset. So digests of two runs of a deterministic program match, although
+# process ids and the address space layout differ. Accesses outside of heap,
+# global and the recorded mappings (e.g. of mappings, which were unmapped
+# before the process exited, or all of them if the log has no memory map)
+# cannot be matched between runs and are left out of the digests.
+#
+# The thunks of each thread are compared in order. Both logs are read at the
+# same time, only the page set of the current thunk of each thread and the
+# digests of thunks, which one log is ahead of the other, are kept in memory.
+
+# indices into accesslog.space_names
+HEAP, GLOBAL, MMAP = range(3)
+
+# bits of a mmap page key for the mapping and the page in the mapping
+_mapping_bits = 28
+_page_bits = 33
+
+# start: number of the first event of the thunk in its log
+# pages: number of (page, space, write) keys
+Thunk = namedtuple("Thunk", "thunk_id start pages digest")
+
+
+class Divergence:
+    def __init__(self, thread, position, a, b):
+        # thread number (see above), starting at 0
+        self.thread = thread
+        # number of the thunk in this thread, starting at 0
+        self.position = position
+        # Thunk of the first and second log, None if missing
+        self.a = a
+        self.b = b
+
+    def _describe(self, thunk):
+        if thunk is None:
+            return "missing"
+        return "thunk %d at event %d, %d pages" \
+            % (thunk.thunk_id, thunk.start, thunk.pages)
+
+    def __str__(self):
+        return "thread %d, thunk #%d: %s <> %s" \
+            % (self.thread, self.position,
+               self._describe(self.a), self._describe(self.b))
+
+
+# Returns (boundaries, bases) of the recorded mappings of a log: the key of
+# a page in region i (see regions.RegionIndex) is bases[i] + page, bases[i]
+# is None outside of mappings.
+def _mapping_bases(log):
+    try:
+        mappings = log.memory_map()
+    except accesslog.Error:
+        mappings = []
+    index = regions.RegionIndex(mappings)
+    ordinals = {}
+    bases = []
+    for mapping in index.mappings:
+        if mapping is None:
+            bases.append(None)
+            continue
+        key = (mapping.path, mapping.offset)
+        ordinal = ordinals[key] = ordinals.get(key, -1) + 1
+        name = "%s\0%d\0%d" % (mapping.path, mapping.offset, ordinal)
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=4).digest()
+        number = int.from_bytes(digest, "little") >> (32 - _mapping_bits)
+        bases.append((number << _page_bits)
+                     + (mapping.offset >> PAGE_SHIFT)
+                     - (mapping.start >> PAGE_SHIFT))
+    return index.boundary_list(), bases
+
+
+# Computes the digests of the thunks of a log, `emit(thread, thunk)` is
+# called for each thunk, when it ended.
+class _Digester:
+    def __init__(self, log, emit):
+        self.header = log._read_header()
+        self.emit = emit
+        # thread_id -> thread number
+        self.threads = {}
+        # thread_id -> [thunk_id, start, keys]
+        self.current = {}
+        # thread number -> rolling hash of the thunks of the thread
+        self.rolling = []
+        self.boundaries, self.bases = _mapping_bases(log)
+
+    def _close(self, thread_id):
+        thread = self.threads[thread_id]
+        thunk = self.current.pop(thread_id, None)
+        if thunk is None:
+            return
+        thunk_id, start, keys = thunk
+        data = array("Q", sorted(keys)).tobytes()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        self.rolling[thread].update(struct.pack("=i", thunk_id) + digest)
+        self.emit(thread, Thunk(thunk_id, start, len(keys), digest))
+
+    def add(self, batch):
+        header = self.header
+        heap_start, global_start = header.heap_start, header.global_start
+        current = self.current
+        threads = self.threads
+        boundaries, bases = self.boundaries, self.bases
+        position = batch.start
+        spaces = accesslog.classify_spaces(batch.payload, header)
+        rows = zip(batch.types, batch.thread_id, batch.payload, spaces)
+        for type_, thread_id, payload, space in rows:
+            position += 1
+            if thread_id not in threads:
+                threads[thread_id] = len(self.rolling)
+                self.rolling.append(hashlib.blake2b(digest_size=16))
+            if type_ == accesslog.THUNK:
+                self._close(thread_id)
+                current[thread_id] = [accesslog.thunk_id(payload),
+                                      position - 1,
+                                      set()]
+                continue
+            if type_ == accesslog.FINISH:
+                self._close(thread_id)
+                continue
+            if type_ != accesslog.WRITE and type_ != accesslog.READ:
+                continue
+            thunk = current.get(thread_id)
+            if thunk is None:
+                # accesses before the first thunk event
+                thunk = current[thread_id] = [0, position - 1, set()]
+            if space == HEAP:
+                key = ((payload - heap_start) >> PAGE_SHIFT) << 3 | HEAP << 1
+            elif space == GLOBAL:
+                key = ((payload - global_start) >> PAGE_SHIFT) << 3 \
+                    | GLOBAL << 1
+            else:
+                base = bases[bisect_right(boundaries, payload)]
+                if base is None:
+                    continue
+                key = (base + (payload >> PAGE_SHIFT)) << 3 | MMAP << 1
+            thunk[2].add(key | (type_ == accesslog.WRITE))
+
+    def finish(self):
+        for thread_id in sorted(self.current):
+            self._close(thread_id)
+
+
+class _Comparison:
+    def __init__(self):
+        # per log: thread -> thunks not compared yet
+        self.pending = ({}, {})
+        # thread -> number of compared thunks
+        self.positions = {}
+        # thread -> first Divergence
+        self.diverged = {}
+
+    def _diverge(self, thread, a, b):
+        position = self.positions.get(thread, 0)
+        self.diverged[thread] = Divergence(thread, position, a, b)
+        self.pending[0].pop(thread, None)
+        self.pending[1].pop(thread, None)
+
+    def add(self, side, thread, thunk):
+        if thread in self.diverged:
+            return
+        other = self.pending[1 - side].get(thread)
+        if not other:
+            self.pending[side].setdefault(thread, deque()).append(thunk)
+            return
+        a, b = other.popleft(), thunk
+        if side == 0:
+            a, b = b, a
+        if a.thunk_id != b.thunk_id or a.digest != b.digest:
+            self._diverge(thread, a, b)
+        else:
+            self.positions[thread] = self.positions.get(thread, 0) + 1
+
+    def finish(self):
+        # thunks, which only one log has
+        for side in (0, 1):
+            for thread, thunks in list(self.pending[side].items()):
+                if thunks:
+                    thunk = thunks[0]
+                    if side == 0:
+                        self._diverge(thread, thunk, None)
+                    else:
+                        self._diverge(thread, None, thunk)
+
+
+# Compares the per-thunk page sets of two logs. Returns the first Divergence
+# of each thread, which differs, ordered by thread. Reading stops once
+# `limit` threads diverged.
+def diff(a, b, limit=None, batch_size=65536):
+    comparison = _Comparison()
+    digesters = [_Digester(a, lambda t, thunk: comparison.add(0, t, thunk)),
+                 _Digester(b, lambda t, thunk: comparison.add(1, t, thunk))]
+    batches = zip_longest(a.iter_batches(batch_size),
+                          b.iter_batches(batch_size))
+    for batch_a, batch_b in batches:
+        if batch_a is not None:
+            digesters[0].add(batch_a)
+        if batch_b is not None:
+            digesters[1].add(batch_b)
+        if limit is not None and len(comparison.diverged) >= limit:
+            break
+    else:
+        digesters[0].finish()
+        digesters[1].finish()
+        comparison.finish()
+    divergences = [comparison.diverged[t] for t in sorted(comparison.diverged)]
+    return divergences[:limit]
+
+
+# Returns the rolling hash of the thunks of each thread (in the order of
+# Divergence.thread) as hex strings. Logs with equal fingerprints do not
+# diverge.
+def fingerprint(log, batch_size=65536):
+    digester = _Digester(log, lambda thread, thunk: None)
+    for batch in log.iter_batches(batch_size):
+        digester.add(batch)
+    digester.finish()
+    return [h.hexdigest() for h in digester.rolling]
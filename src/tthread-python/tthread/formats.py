@@ -1,8 +1,77 @@
 import csv
+import json
+import itertools
 from tthread import accesslog
 
 
-class TsvWriter:
+# returns the name of the memory space of each event of a batch
+def _space_names(batch, header):
+    codes = accesslog.classify_spaces(batch.payload, header)
+    return map(accesslog.space_names.__getitem__, codes)
+
+
+# appends the symbol of the return address (second column) to each row
+def with_symbols(rows, symbols):
+    for row in rows:
+        yield row + (symbols[row[1]] or "-",)
+
+
+# Base class of the tab-separated formats. Subclasses implement
+# _rows(batch, state), where state is carried from one batch to the next.
+class TabularWriter:
+    # set if rows depend on events of previous batches (see update_state)
+    stateful = False
+
+    header = []
+
+    # `regions`: regions.RegionIndex to classify addresses outside heap and
+    # global by their mapping instead of as "mmap", the "heap/global" column
+    # is named "region" then
+    def __init__(self, log, symbolizer=None, regions=None):
+        self.log = log
+        self.symbolizer = symbolizer
+        self.regions = regions
+        if regions is not None:
+            self.header = ["region" if name == "heap/global" else name
+                           for name in self.header]
+        if symbolizer is not None:
+            self.header = self.header + ["symbol"]
+
+    def initial_state(self):
+        return None
+
+    # applies the events of a batch to state without writing rows,
+    # used to compute the state at the start of a range of events
+    def update_state(self, state, batch):
+        pass
+
+    # merges the state after a range of events into the state before it
+    def merge_state(self, state, later):
+        return state
+
+    # returns the memory space of each event of a batch
+    def _spaces(self, batch):
+        if self.regions is not None:
+            return self.regions.names(batch.payload)
+        return _space_names(batch, self.log.header)
+
+    def _symbolize(self, batch, rows):
+        if self.symbolizer is None:
+            return rows
+        symbols = self.symbolizer.resolve_many(batch.return_address)
+        return with_symbols(rows, symbols)
+
+    def write(self, csvfile):
+        w = csv.writer(csvfile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+        w.writerow(self.header)
+        self.write_rows(w, self.log.iter_batches(), self.initial_state())
+
+    def write_rows(self, writer, batches, state):
+        for batch in batches:
+            writer.writerows(self._symbolize(batch, self._rows(batch, state)))
+
+
+class TsvWriter(TabularWriter):
     header = [
         "type",
         "return_address",
@@ -11,54 +80,25 @@ class TsvWriter:
         "heap/global"
     ]
 
-    def __init__(self, log):
-        self.log = log
+    def _rows(self, batch, state):
+        rows = zip(batch.rows(), self._spaces(batch))
+        for (type_, return_address, thread_id, payload), space in rows:
+            if type_ == accesslog.WRITE:
+                yield ("write", return_address, thread_id,
+                       payload, space)
+            elif type_ == accesslog.READ:
+                yield ("read", return_address, thread_id,
+                       payload, space)
+            elif type_ == accesslog.THUNK:
+                yield ("thunk", return_address, thread_id,
+                       accesslog.thunk_id(payload), "-")
+            elif type_ == accesslog.FINISH:
+                yield ("finish", return_address, thread_id, "-", "-")
 
-    def write(self, csvfile):
-        w = csv.writer(csvfile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
-        w.writerow(self.header)
-        for event in self.log.read():
-            if type(event) is accesslog.ThunkEvent:
-                self._write_thunk(w, event)
-            elif type(event) is accesslog.FinishEvent:
-                self._write_finish(w, event)
-            else:
-                self._write_access(w, event)
-
-    def _write_finish(self, writer, event):
-        writer.writerow(("finish",
-                        event.return_address,
-                        event.thread_id,
-                        "-", "-"))
-
-    def _write_thunk(self, writer, event):
-        writer.writerow(("thunk",
-                        event.return_address,
-                        event.thread_id,
-                        event.id,
-                        "-"))
-
-    def _write_access(self, writer, event):
-        if type(event) is accesslog.WriteEvent:
-            t = "write"
-        elif type(event) is accesslog.ReadEvent:
-            t = "read"
-        else:
-            return
-        if self.log.is_heap(event.address):
-            space = "heap"
-        elif self.log.is_global(event.address):
-            space = "global"
-        else:
-            space = "mmap"
-        writer.writerow((t,
-                        event.return_address,
-                        event.thread_id,
-                        event.address,
-                        space))
 
+class Tsv2Writer(TabularWriter):
+    stateful = True
 
-class Tsv2Writer:
     header = [
         "access",
         "return_address",
@@ -68,36 +108,135 @@ class Tsv2Writer:
         "heap/global"
     ]
 
-    def __init__(self, log):
-        self.log = log
+    # state: thread_id -> (thunk_id, thunk_return_address) of current thunk
+    def initial_state(self):
+        return {}
 
-    def write(self, csvfile):
-        w = csv.writer(csvfile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
-        w.writerow(self.header)
-        threads = {}
-        for event in self.log.read():
-            if type(event) is accesslog.ThunkEvent:
-                threads[event.thread_id] = (event.id, event.return_address)
+    def update_state(self, threads, batch):
+        thunks = batch.thunks
+        for thread_id, payload, return_address in zip(thunks.thread_id,
+                                                      thunks.payload,
+                                                      thunks.return_address):
+            threads[thread_id] = (accesslog.thunk_id(payload), return_address)
+
+    def merge_state(self, threads, later):
+        merged = dict(threads)
+        merged.update(later)
+        return merged
+
+    def _rows(self, batch, threads):
+        rows = zip(batch.rows(), self._spaces(batch))
+        for (type_, return_address, thread_id, payload), space in rows:
+            if type_ == accesslog.THUNK:
+                threads[thread_id] = (accesslog.thunk_id(payload),
+                                      return_address)
+                continue
+            if type_ == accesslog.WRITE:
+                a = "write"
+            elif type_ == accesslog.READ:
+                a = "read"
             else:
-                self._write_access(w, event, threads)
+                continue
+            thunk = threads.get(thread_id, (0, "_start"))
+            yield (a,
+                   return_address,
+                   thread_id,
+                   thunk[0],
+                   thunk[1],
+                   space)
 
-    def _write_access(self, writer, event, threads):
-        if type(event) is accesslog.WriteEvent:
-            a = "write"
-        elif type(event) is accesslog.ReadEvent:
-            a = "read"
+
+# Chrome trace event format (chrome://tracing, Perfetto UI). Each thread is a
+# track, thunks are slices and reads/writes (page faults) are instant events.
+# The log has no timestamps, the position of an event in the log is used as
+# time (1 event = 1us). Events are written as they are decoded, the document
+# is never held in memory.
+class ChromeTraceWriter:
+    # pid of all tracks
+    pid = 1
+
+    def __init__(self, log, symbolizer=None, accesses=True):
+        self.log = log
+        self.symbolizer = symbolizer
+        # write instant events for reads and writes
+        self.accesses = accesses
+        self._symbols = {}
+
+    def _symbol(self, address):
+        symbol = self._symbols.get(address)
+        if symbol is None:
+            name = self.symbolizer.resolve(address) or "0x%x" % address
+            symbol = self._symbols[address] = json.dumps(name)
+        return symbol
+
+    def _begin(self, ts, thread_id, thunk_id, return_address):
+        if self.symbolizer is None:
+            at = '"0x%x"' % return_address
         else:
-            return
-        thunk = threads.get(event.thread_id, (0, "_start"))
-        if self.log.is_heap(event.address):
-            space = "heap"
-        elif self.log.is_global(event.address):
-            space = "global"
+            at = self._symbol(return_address)
+        return ',\n{"ph":"B","pid":%d,"tid":%d,"ts":%d,"name":"thunk %d",' \
+               '"args":{"return_address":%s}}' \
+               % (self.pid, thread_id, ts, thunk_id, at)
+
+    def _end(self, ts, thread_id):
+        return ',\n{"ph":"E","pid":%d,"tid":%d,"ts":%d}' \
+            % (self.pid, thread_id, ts)
+
+    def _thread_name(self, thread_id):
+        return ',\n{"ph":"M","pid":%d,"tid":%d,"name":"thread_name",' \
+               '"args":{"name":"thread %d"}}' \
+               % (self.pid, thread_id, thread_id)
+
+    def _instant(self, ts, thread_id, name, address, space):
+        return ',\n{"ph":"i","s":"t","pid":%d,"tid":%d,"ts":%d,' \
+               '"name":"%s","args":{"address":"0x%x","space":"%s"}}' \
+               % (self.pid, thread_id, ts, name, address, space)
+
+    def _lines(self, batch, threads):
+        if self.accesses:
+            spaces = _space_names(batch, self.log.header)
         else:
-            space = "mmap"
-        writer.writerow((a,
-                        event.return_address,
-                        event.thread_id,
-                        thunk[0],
-                        thunk[1],
-                        space))
+            spaces = itertools.repeat(None)
+        ts = batch.start
+        rows = zip(batch.rows(), spaces)
+        for (type_, return_address, thread_id, payload), space in rows:
+            ts += 1
+            open_ = threads.get(thread_id)
+            if open_ is None:
+                yield self._thread_name(thread_id)
+                threads[thread_id] = open_ = False
+            if type_ == accesslog.THUNK:
+                if open_:
+                    yield self._end(ts, thread_id)
+                threads[thread_id] = True
+                yield self._begin(ts, thread_id,
+                                  accesslog.thunk_id(payload),
+                                  return_address)
+            elif type_ == accesslog.FINISH:
+                if open_:
+                    yield self._end(ts, thread_id)
+                threads[thread_id] = False
+            elif type_ == accesslog.WRITE or type_ == accesslog.READ:
+                if not open_:
+                    # accesses before the first thunk
+                    threads[thread_id] = True
+                    yield self._begin(ts, thread_id, 0, return_address)
+                if self.accesses:
+                    name = "write" if type_ == accesslog.WRITE else "read"
+                    yield self._instant(ts, thread_id, name,
+                                        payload, space)
+
+    def write(self, f):
+        f.write('{"traceEvents":[\n'
+                '{"ph":"M","pid":%d,"name":"process_name",'
+                '"args":{"name":"tthread"}}' % self.pid)
+        # thread_id -> True if a thunk is open
+        threads = {}
+        end = 0
+        for batch in self.log.iter_batches():
+            f.write("".join(self._lines(batch, threads)))
+            end = batch.start + len(batch)
+        f.write("".join(self._end(end + 1, thread_id)
+                        for thread_id, open_ in sorted(threads.items())
+                        if open_))
+        f.write("\n]}\n")
@@ -0,0 +1,256 @@
+import operator
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress
+from tthread import accesslog, arrayfile
+
+# Index of a log for random access by thread, thunk and event number
+#
+#   runs: thread_id -> (starts, lengths) of the runs of consecutive events of
+#       the thread
+#   thunks: thread_id -> (thunk ids, event numbers of the thunk events)
+#   checkpoints: the number of events of each type before every
+#       `checkpoint_interval` events, len(accesslog.events) values each
+#   blocks: (offsets, first events) of all blocks of a version 2 log
+#
+# The index is stored next to the log as `<log>.idx` (see arrayfile). It is
+# rebuilt if the log was changed.
+
+_thunk_table = bytes(1 if t == accesslog.THUNK else 0 for t in range(256))
+
+# runs of a thread closer than this (in events) are read at once
+merge_gap = 4096
+
+
+def sidecar_path(log_path):
+    return log_path + ".idx"
+
+
+def _key(header):
+    return (header.version,
+            header.event_count,
+            getattr(header, "data_size", 0))
+
+
+file_magic = b"TTIDX\0\0\0"
+
+
+class LogIndex:
+    version = 3
+
+    def __init__(self, checkpoint_interval=1 << 16):
+        self.key = None
+        self.event_count = 0
+        self.runs = {}
+        self.thunks = {}
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoints = array("Q")
+        self.blocks = None
+
+    @classmethod
+    def build(cls, log, batch_size=65536, checkpoint_interval=1 << 16):
+        index = cls(checkpoint_interval)
+        types = len(accesslog.events)
+        counts = [0] * types
+        index.checkpoints.extend(counts)
+        next_checkpoint = checkpoint_interval
+        last_thread = None
+        for batch in log.iter_batches(batch_size):
+            start, n = batch.start, len(batch)
+            thread_ids = batch.thread_id
+
+            # runs
+            changes = map(operator.ne, thread_ids[1:], thread_ids[:-1])
+            boundaries = [0]
+            boundaries.extend(i + 1 for i in compress(range(n - 1), changes))
+            boundaries.append(n)
+            for i in range(len(boundaries) - 1):
+                first, end = boundaries[i], boundaries[i + 1]
+                thread_id = thread_ids[first]
+                if first == 0 and thread_id == last_thread:
+                    index.runs[thread_id][1][-1] += end
+                    continue
+                runs = index.runs.get(thread_id)
+                if runs is None:
+                    runs = index.runs[thread_id] = (array("Q"), array("Q"))
+                runs[0].append(start + first)
+                runs[1].append(end - first)
+            last_thread = thread_ids[n - 1]
+
+            # thunks
+            for i in compress(range(n), batch.types.translate(_thunk_table)):
+                thunks = index.thunks.get(thread_ids[i])
+                if thunks is None:
+                    thunks = index.thunks[thread_ids[i]] = (array("i"),
+                                                            array("Q"))
+                thunks[0].append(accesslog.thunk_id(batch.payload[i]))
+                thunks[1].append(start + i)
+
+            # checkpoints
+            position = 0
+            while next_checkpoint <= start + n:
+                part = batch.types[position:next_checkpoint - start]
+                for t in range(types):
+                    counts[t] += part.count(t)
+                index.checkpoints.extend(counts)
+                position = next_checkpoint - start
+                next_checkpoint += checkpoint_interval
+            part = batch.types[position:]
+            for t in range(types):
+                counts[t] += part.count(t)
+            index.event_count = start + n
+
+        if log.header.version == accesslog.COMPACT_VERSION:
+            index.blocks = log._block_index()
+        index.key = _key(log.header)
+        return index
+
+    def is_current(self, header):
+        return self.key == _key(header)
+
+    def threads(self):
+        return sorted(self.runs)
+
+    # Returns [start, stop) ranges of events to read to get all events of a
+    # thread in [start, stop). Nearby runs are merged.
+    def thread_ranges(self, thread_id, start=0, stop=None):
+        if stop is None:
+            stop = self.event_count
+        runs = self.runs.get(thread_id)
+        if runs is None:
+            return []
+        starts, lengths = runs
+        i = max(bisect_right(starts, start) - 1, 0)
+        ranges = []
+        for first, length in zip(starts[i:], lengths[i:]):
+            if first >= stop:
+                break
+            first, end = max(first, start), min(first + length, stop)
+            if first >= end:
+                continue
+            if ranges and first - ranges[-1][1] <= merge_gap:
+                ranges[-1][1] = end
+            else:
+                ranges.append([first, end])
+        return [tuple(r) for r in ranges]
+
+    # Returns [start, stop) of the events of a thunk. Thunk 0 holds the
+    # events before the first thunk event of a thread. Thunk ids increase
+    # within a thread, so they are searched with bisect.
+    def thunk_range(self, thread_id, thunk_id):
+        if thread_id not in self.runs:
+            raise accesslog.Error("no thread %d in tthread_log" % thread_id)
+        ids, starts = self.thunks.get(thread_id, (array("i"), array("Q")))
+        i = bisect_left(ids, thunk_id)
+        found = i < len(ids) and ids[i] == thunk_id
+        if thunk_id == 0 and not found:
+            start = self.runs[thread_id][0][0]
+            return start, starts[0] if starts else self.event_count
+        if not found:
+            raise accesslog.Error("no thunk %d in thread %d"
+                                  % (thunk_id, thread_id))
+        if i + 1 < len(starts):
+            return starts[i], starts[i + 1]
+        return starts[i], self.event_count
+
+    # number of events of each type before `position`, the events after the
+    # last checkpoint are counted in log
+    def _counts_before(self, log, position):
+        types = len(accesslog.events)
+        checkpoint = min(position // self.checkpoint_interval,
+                         len(self.checkpoints) // types - 1)
+        counts = list(self.checkpoints[checkpoint * types:
+                                       (checkpoint + 1) * types])
+        start = checkpoint * self.checkpoint_interval
+        if start < position:
+            for batch in log.iter_batches(start=start, stop=position):
+                for t in range(types):
+                    counts[t] += batch.types.count(t)
+        return counts
+
+    # returns the number of events of each type in [start, stop)
+    def type_counts(self, log, start=0, stop=None):
+        if stop is None or stop > self.event_count:
+            stop = self.event_count
+        if start >= stop:
+            return [0] * len(accesslog.events)
+        before = self._counts_before(log, start)
+        return [a - b for a, b in zip(self._counts_before(log, stop), before)]
+
+    def save(self, f):
+        runs = sorted(self.runs.items())
+        thunks = sorted(self.thunks.items())
+        blocks = self.blocks or (array("Q"), array("Q"))
+        arrayfile.write(f, file_magic, self.version, [
+            array("Q", self.key),
+            array("Q", [self.event_count,
+                        self.checkpoint_interval,
+                        self.blocks is not None]),
+            self.checkpoints,
+            array("i", (t for t, _ in runs)),
+            array("Q", (len(r[0]) for _, r in runs)),
+            arrayfile.concat("Q", (r[0] for _, r in runs)),
+            arrayfile.concat("Q", (r[1] for _, r in runs)),
+            array("i", (t for t, _ in thunks)),
+            array("Q", (len(r[0]) for _, r in thunks)),
+            arrayfile.concat("i", (r[0] for _, r in thunks)),
+            arrayfile.concat("Q", (r[1] for _, r in thunks)),
+            blocks[0],
+            blocks[1],
+        ])
+
+    @classmethod
+    def load(cls, f):
+        (key, scalars, checkpoints,
+         run_threads, run_counts, starts, lengths,
+         thunk_threads, thunk_counts, ids, positions,
+         offsets, first_events) = arrayfile.read(f, file_magic, cls.version,
+                                                 "QQQiQQQiQiQQQ")
+        if len(key) != 3 or len(scalars) != 3 \
+                or len(run_threads) != len(run_counts) \
+                or len(thunk_threads) != len(thunk_counts):
+            raise arrayfile.Error("log index is corrupt")
+        event_count, checkpoint_interval, has_blocks = scalars
+        index = cls(checkpoint_interval)
+        index.key = tuple(key)
+        index.event_count = event_count
+        index.checkpoints = checkpoints
+        index.runs = dict(zip(run_threads,
+                              zip(arrayfile.split(starts, run_counts),
+                                  arrayfile.split(lengths, run_counts))))
+        index.thunks = dict(zip(thunk_threads,
+                                zip(arrayfile.split(ids, thunk_counts),
+                                    arrayfile.split(positions,
+                                                    thunk_counts))))
+        if has_blocks:
+            index.blocks = (offsets, first_events)
+        return index
+
+
+# Loads the sidecar index of the log at `path`, returns None if it does not
+# exist or is outdated. An index older than the log belongs to a previous log
+# at the same path.
+def load_sidecar(path, header):
+    try:
+        with open(sidecar_path(path), "rb") as f:
+            if os.fstat(f.fileno()).st_mtime_ns < os.stat(path).st_mtime_ns:
+                return None
+            index = LogIndex.load(f)
+    except (OSError, accesslog.Error):
+        return None
+    if not index.is_current(header):
+        return None
+    return index
+
+
+def save_sidecar(path, index):
+    path = sidecar_path(path)
+    tmp = "%s.%d" % (path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            index.save(f)
+        os.rename(tmp, path)
+    except OSError:
+        # the index can be rebuilt
+        pass
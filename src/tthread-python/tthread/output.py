@@ -0,0 +1,152 @@
+import io
+import queue
+import threading
+import zlib
+import tthread
+
+# Output files of tthread.app, compressed according to the file extension:
+#
+#   .gz: gzip (zlib)
+#   .zst: zstandard (requires the zstandard module)
+#   .lz4: lz4 frame (requires the lz4 module)
+#
+# Compression runs on a writer thread, which is fed through a bounded queue.
+# zlib, zstandard and lz4 release the GIL while compressing, so formatting and
+# compression overlap.
+
+# size of the chunks passed to the writer thread
+chunk_size = 1 << 20
+# number of chunks waiting for the writer thread
+queue_size = 8
+
+
+class Error(tthread.Error):
+    pass
+
+
+class _Gzip:
+    def __init__(self, level):
+        # wbits + 16: gzip header and trailer
+        self._compressor = zlib.compressobj(level,
+                                            zlib.DEFLATED,
+                                            zlib.MAX_WBITS + 16)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _Zstd:
+    def __init__(self, level):
+        try:
+            import zstandard
+        except ImportError:
+            raise Error("zstandard is required for .zst output")
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _Lz4:
+    def __init__(self, level):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise Error("lz4 is required for .lz4 output")
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b""
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+# extension -> (compressor, default level), the default levels favour speed,
+# so compression keeps up with formatting
+compressors = {
+    ".gz": (_Gzip, 1),
+    ".zst": (_Zstd, 3),
+    ".lz4": (_Lz4, 0),
+}
+
+
+# Writes chunks compressed to `f` on a separate thread. write() blocks only
+# if `queue_size` chunks are waiting.
+class CompressingWriter(io.RawIOBase):
+    def __init__(self, f, compressor, queue_size=queue_size):
+        self.file = f
+        self.compressor = compressor
+        self._queue = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise Error("failed to write output: %s" % self._error)
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is not None:
+                # drop data, so write() does not block
+                continue
+            try:
+                self.file.write(self.compressor.compress(data))
+            except Exception as e:
+                self._error = e
+        try:
+            if self._error is None:
+                self.file.write(self.compressor.flush())
+        except Exception as e:
+            self._error = e
+
+    def close(self):
+        if self.closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self.file.close()
+        super().close()
+        if self._error is not None:
+            raise Error("failed to write output: %s" % self._error)
+
+
+def compressor_for(path, level=None):
+    for extension, (compressor, default_level) in compressors.items():
+        if path.endswith(extension):
+            return compressor(default_level if level is None else level)
+    return None
+
+
+# Opens `path` for writing, compressed according to its extension. Returns a
+# text stream unless `binary` is set.
+def open_output(path, binary=False, level=None):
+    compressor = compressor_for(path, level)
+    try:
+        f = open(path, "wb")
+    except OSError as e:
+        raise Error("failed to open output '%s': %s" % (path, e))
+    if compressor is not None:
+        raw = CompressingWriter(f, compressor)
+        f = io.BufferedWriter(raw, buffer_size=chunk_size)
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding="utf-8")
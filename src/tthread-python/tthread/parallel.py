@@ -0,0 +1,217 @@
+import io
+import csv
+import mmap
+import os
+import multiprocessing
+from collections import Counter, deque
+from tthread import accesslog
+from tthread.accesslog import names
+
+# Parallel decoding of a log
+#
+# The log is an array of fixed-size events, so [0, event_count) is split into
+# ranges, which are decoded by a pool of forked worker processes. Each worker
+# maps the log file on its own. Results are returned in the order of the
+# ranges. Version 2 logs are split at block boundaries.
+#
+# Forking a process with threads can leave locks held forever in the child,
+# only the thread calling fork() exists there. The workers are forked, when a
+# reader is started, which has to happen before threads are started (e.g. the
+# compression thread of output.open_output()).
+
+# the reader, set in the parent before the workers are forked, so it does not
+# have to be pickled
+_task = None
+# mapping of the log file in a worker process
+_worker_mmap = None
+
+
+def _run_range(job):
+    func, start, stop, arg = job
+    return func(_task.iter_batches(start, stop), arg)
+
+
+class ParallelReader:
+    def __init__(self,
+                 log,
+                 workers=None,
+                 range_size=1 << 20,
+                 batch_size=65536):
+        self.log = log
+        self.fd = log.file.fileno()
+        log.header = self.header = log._read_header()
+        self.workers = workers or os.cpu_count()
+        self.range_size = range_size
+        self.batch_size = batch_size
+        self._pool = None
+
+    # Forks the worker processes, which are used by map() until close()
+    def start(self):
+        global _task
+        if self._pool is None:
+            _task = self
+            context = multiprocessing.get_context("fork")
+            self._pool = context.Pool(self.workers)
+        return self
+
+    def close(self):
+        global _task
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            _task = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def ranges(self):
+        if self.header.version == accesslog.COMPACT_VERSION:
+            return self._block_ranges()
+        count = self.header.event_count
+        return [(start, min(start + self.range_size, count))
+                for start in range(0, count, self.range_size)]
+
+    def _block_ranges(self):
+        _, first_events = self.log._block_index()
+        ranges = []
+        start = 0
+        for first in first_events:
+            if first - start >= self.range_size:
+                ranges.append((start, first))
+                start = first
+        count = self.header.event_count
+        if count > start:
+            ranges.append((start, count))
+        return ranges
+
+    # executed in the worker process
+    def iter_batches(self, start, stop):
+        global _worker_mmap
+        if self.header.version == accesslog.COMPACT_VERSION:
+            # reads with os.pread(), the block index is inherited
+            yield from self.log._iter_blocks(self.batch_size, start, stop)
+            return
+        if _worker_mmap is None:
+            _worker_mmap = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        view = memoryview(_worker_mmap)
+        offset = self.header.header_size
+        size = accesslog.log_event_size
+        try:
+            for i in range(start, stop, self.batch_size):
+                end = min(i + self.batch_size, stop)
+                yield accesslog.decode_batch(view[offset + i * size:
+                                                  offset + end * size], i)
+        finally:
+            view.release()
+
+    # Calls func(batches, arg) for each range in a worker process, where arg
+    # is taken from args (one per range, default None), and yields the
+    # results in order. At most two ranges per worker are in flight. The
+    # workers are started for the call, unless the reader was started.
+    def map(self, func, args=None):
+        if self._pool is None:
+            with self:
+                yield from self.map(func, args)
+            return
+        ranges = self.ranges()
+        if args is None:
+            args = [None] * len(ranges)
+        pending = deque()
+        for (start, stop), arg in zip(ranges, args):
+            job = (func, start, stop, arg)
+            pending.append(self._pool.apply_async(_run_range, (job,)))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _summarize(batches, _):
+    header = _task.header
+    types = Counter()
+    threads = Counter()
+    spaces = Counter()
+    for batch in batches:
+        types.update(batch.types)
+        threads.update(batch.thread_id)
+        for type_ in (accesslog.WRITE, accesslog.READ):
+            payload = batch.of_type(type_).payload
+            codes = accesslog.classify_spaces(payload, header)
+            for code, name in enumerate(accesslog.space_names):
+                count = codes.count(code)
+                if count:
+                    spaces[name] += count
+    return types, threads, spaces
+
+
+# Counts events per type, thread and memory space
+def summary(log, workers=None, range_size=1 << 20):
+    reader = ParallelReader(log, workers, range_size)
+    types, threads, spaces = Counter(), Counter(), Counter()
+    for t, th, sp in reader.map(_summarize):
+        types += t
+        threads += th
+        spaces += sp
+    return {
+        "events": reader.header.event_count,
+        "types": {names[t]: c for t, c in sorted(types.items())},
+        "threads": dict(sorted(threads.items())),
+        "spaces": dict(spaces),
+    }
+
+
+def _scan_state(batches, _):
+    writer = _task.writer
+    state = writer.initial_state()
+    for batch in batches:
+        writer.update_state(state, batch)
+    return state
+
+
+def _format_range(batches, state):
+    writer = _task.writer
+    output = io.StringIO()
+    w = csv.writer(output, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+    writer.write_rows(w, batches, state)
+    return output.getvalue()
+
+
+# Parallel version of formats.TabularWriter. The workers are forked when it
+# is created, so it has to be created before the output is opened.
+class ParallelWriter:
+    def __init__(self, writer, workers=None, range_size=1 << 20):
+        self.writer = writer
+        self.reader = ParallelReader(writer.log, workers, range_size)
+        self.reader.writer = writer
+        self.reader.start()
+
+    def write(self, csvfile):
+        writer, reader = self.writer, self.reader
+        try:
+            w = csv.writer(csvfile, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+            w.writerow(writer.header)
+
+            state = writer.initial_state()
+            states = [state]
+            if writer.stateful:
+                for later in list(reader.map(_scan_state))[:-1]:
+                    state = writer.merge_state(state, later)
+                    states.append(state)
+            else:
+                states *= len(reader.ranges())
+            for chunk in reader.map(_format_range, states):
+                csvfile.write(chunk)
+        finally:
+            self.close()
+
+    def close(self):
+        self.reader.close()
+
+
+# Parallel version of formats.TabularWriter.write()
+def write(writer, csvfile, workers=None, range_size=1 << 20):
+    ParallelWriter(writer, workers, range_size).write(csvfile)
@@ -0,0 +1,257 @@
+from array import array
+from collections import deque
+from itertools import accumulate
+from tthread import accesslog, arrayfile
+from tthread.analysis import PAGE_SHIFT
+
+# Thunk-level provenance graph
+#
+# Nodes are thunks, numbered in the order of their first event. A thread gets
+# an implicit thunk (thunk id 0) if it accesses memory before its first thunk
+# event.
+#
+# edges (source -> target):
+#   ORDER: the previous thunk of the same thread
+#   DATA: the thunk, which wrote a page last, to each thunk reading the page
+#       afterwards. `page` of the edge is the first such page.
+#
+# Nodes and edges are stored in arrays, the edges as CSR in both directions:
+# the successors of node n are targets[offsets[n]:offsets[n + 1]]. save()
+# writes these arrays as arrayfile.
+
+ORDER = 1
+DATA = 2
+
+file_magic = b"TTPROV\0\0"
+
+
+class Error(accesslog.Error):
+    pass
+
+
+# compressed sparse rows of the edges grouped by `keys`
+class _Adjacency:
+    def __init__(self, count, keys, values, pages, kinds):
+        offsets = array("Q", bytes(8 * (count + 1)))
+        for key in keys:
+            offsets[key + 1] += 1
+        self.offsets = array("Q", accumulate(offsets))
+        positions = self.offsets[:-1]
+        size = len(keys)
+        self.nodes = array("I", bytes(4 * size))
+        self.pages = array("Q", bytes(8 * size))
+        self.kinds = bytearray(size)
+        for i, key in enumerate(keys):
+            p = positions[key]
+            positions[key] = p + 1
+            self.nodes[p] = values[i]
+            self.pages[p] = pages[i]
+            self.kinds[p] = kinds[i]
+
+    def neighbours(self, node, kinds=ORDER | DATA):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return [n for n, k in zip(self.nodes[start:end],
+                                  self.kinds[start:end])
+                if k & kinds]
+
+    def edges(self, node):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.nodes[start:end],
+                   self.kinds[start:end],
+                   self.pages[start:end])
+
+
+class _Builder:
+    def __init__(self):
+        self.thread_ids = array("i")
+        self.thunk_ids = array("i")
+        self.return_addresses = array("Q")
+        self.sources = array("I")
+        self.targets = array("I")
+        self.pages = array("Q")
+        self.kinds = bytearray()
+        # thread_id -> current node
+        self.current = {}
+        # thread_id -> {source node: page} of DATA edges to the current node
+        self.incoming = {}
+        # page -> node, which wrote it last
+        self.last_writer = {}
+
+    def _add_edge(self, source, target, kind, page):
+        self.sources.append(source)
+        self.targets.append(target)
+        self.kinds.append(kind)
+        self.pages.append(page)
+
+    def _flush(self, thread_id):
+        incoming = self.incoming.get(thread_id)
+        if not incoming:
+            return
+        target = self.current[thread_id]
+        for source in sorted(incoming):
+            self._add_edge(source, target, DATA, incoming[source])
+        incoming.clear()
+
+    def start_thunk(self, thread_id, thunk_id, return_address):
+        node = len(self.thread_ids)
+        self.thread_ids.append(thread_id)
+        self.thunk_ids.append(thunk_id)
+        self.return_addresses.append(return_address)
+        previous = self.current.get(thread_id)
+        if previous is not None:
+            self._flush(thread_id)
+            self._add_edge(previous, node, ORDER, 0)
+        else:
+            self.incoming[thread_id] = {}
+        self.current[thread_id] = node
+        return node
+
+    def add(self, batch):
+        current = self.current
+        last_writer = self.last_writer
+        for type_, return_address, thread_id, payload in batch.rows():
+            if type_ == accesslog.THUNK:
+                self.start_thunk(thread_id,
+                                 accesslog.thunk_id(payload),
+                                 return_address)
+                continue
+            if type_ != accesslog.READ and type_ != accesslog.WRITE:
+                continue
+            node = current.get(thread_id)
+            if node is None:
+                node = self.start_thunk(thread_id, 0, 0)
+            page = payload >> PAGE_SHIFT
+            if type_ == accesslog.WRITE:
+                last_writer[page] = node
+                continue
+            writer = last_writer.get(page)
+            if writer is not None and writer != node:
+                incoming = self.incoming[thread_id]
+                if writer not in incoming:
+                    incoming[writer] = page
+
+    def finish(self):
+        for thread_id in self.current:
+            self._flush(thread_id)
+        graph = Graph()
+        graph.thread_ids = self.thread_ids
+        graph.thunk_ids = self.thunk_ids
+        graph.return_addresses = self.return_addresses
+        graph.edge_count = len(self.sources)
+        count = len(self.thread_ids)
+        graph.successors = _Adjacency(count, self.sources, self.targets,
+                                      self.pages, self.kinds)
+        graph.predecessors = _Adjacency(count, self.targets, self.sources,
+                                        self.pages, self.kinds)
+        return graph
+
+
+class Graph:
+    version = 2
+
+    def __init__(self):
+        # per node
+        self.thread_ids = array("i")
+        self.thunk_ids = array("i")
+        # return address of the thunk event, 0 for implicit thunks
+        self.return_addresses = array("Q")
+        self.edge_count = 0
+        self.successors = None
+        self.predecessors = None
+        # (thread_id, thunk_id) -> node, built on first use
+        self._nodes = None
+
+    @classmethod
+    def build(cls, log, batch_size=65536):
+        builder = _Builder()
+        for batch in log.iter_batches(batch_size):
+            builder.add(batch)
+        return builder.finish()
+
+    def __len__(self):
+        return len(self.thread_ids)
+
+    def node(self, thread_id, thunk_id):
+        if self._nodes is None:
+            keys = zip(self.thread_ids, self.thunk_ids)
+            self._nodes = {key: n for n, key in enumerate(keys)}
+        try:
+            return self._nodes[(thread_id, thunk_id)]
+        except KeyError:
+            raise Error("no thunk %d in thread %d" % (thunk_id, thread_id))
+
+    # returns (thread_id, thunk_id) of a node
+    def thunk(self, node):
+        return (self.thread_ids[node], self.thunk_ids[node])
+
+    def parents(self, node, kinds=ORDER | DATA):
+        return self.predecessors.neighbours(node, kinds)
+
+    def children(self, node, kinds=ORDER | DATA):
+        return self.successors.neighbours(node, kinds)
+
+    # yields (source, kind, page) of all edges to node
+    def in_edges(self, node):
+        return self.predecessors.edges(node)
+
+    # yields (target, kind, page) of all edges from node
+    def out_edges(self, node):
+        return self.successors.edges(node)
+
+    def _reachable(self, adjacency, nodes, kinds):
+        visited = bytearray(len(self))
+        queue = deque(nodes)
+        for node in nodes:
+            visited[node] = 1
+        while queue:
+            for n in adjacency.neighbours(queue.popleft(), kinds):
+                if not visited[n]:
+                    visited[n] = 1
+                    queue.append(n)
+        return array("I", (n for n, v in enumerate(visited) if v))
+
+    # all nodes, which node(s) depend on, including themselves
+    def backward_slice(self, nodes, kinds=ORDER | DATA):
+        if isinstance(nodes, int):
+            nodes = [nodes]
+        return self._reachable(self.predecessors, nodes, kinds)
+
+    # all nodes, which depend on node(s), including themselves
+    def forward_slice(self, nodes, kinds=ORDER | DATA):
+        if isinstance(nodes, int):
+            nodes = [nodes]
+        return self._reachable(self.successors, nodes, kinds)
+
+    def save(self, f):
+        arrays = [self.thread_ids, self.thunk_ids, self.return_addresses]
+        for adjacency in (self.successors, self.predecessors):
+            arrays += [adjacency.offsets, adjacency.nodes, adjacency.pages,
+                       adjacency.kinds]
+        arrayfile.write(f, file_magic, self.version, arrays)
+
+    @classmethod
+    def load(cls, f):
+        arrays = arrayfile.read(f, file_magic, cls.version,
+                                "iiQ" + "QIQB" * 2)
+        graph = cls()
+        graph.thread_ids, graph.thunk_ids, graph.return_addresses = arrays[:3]
+        count = len(graph.thread_ids)
+        if not count == len(graph.thunk_ids) == len(graph.return_addresses):
+            raise Error("provenance graph is corrupt")
+        adjacencies = []
+        for offsets, nodes, pages, kinds in (arrays[3:7], arrays[7:]):
+            size = len(nodes)
+            if len(offsets) != count + 1 or offsets[-1] != size \
+                    or not size == len(pages) == len(kinds) \
+                    or any(n >= count for n in nodes) \
+                    or any(a > b for a, b in zip(offsets, offsets[1:])):
+                raise Error("provenance graph is corrupt")
+            adjacency = _Adjacency.__new__(_Adjacency)
+            adjacency.offsets = offsets
+            adjacency.nodes = nodes
+            adjacency.pages = pages
+            adjacency.kinds = bytearray(kinds)
+            adjacencies.append(adjacency)
+        graph.successors, graph.predecessors = adjacencies
+        graph.edge_count = len(graph.successors.nodes)
+        return graph
@@ -0,0 +1,167 @@
+import os
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from itertools import repeat
+from tthread import accesslog
+
+# Classification of data addresses by the memory region they belong to.
+#
+# The regions are the mappings of the traced process, recorded by libtthread
+# on exit (see Log.memory_map()), overlaid with the heap and global ranges of
+# the log header. Mappings, which were unmapped before the process exited,
+# are not known; their addresses are UNKNOWN.
+#
+# The index is a sorted array of region boundaries covering the whole address
+# space, gaps between mappings are regions of kind UNKNOWN. The region of an
+# address is found by bisection, for whole columns with C-level iteration or
+# numpy.searchsorted().
+
+HEAP, GLOBAL, LIBRARY, FILE, STACK, ANONYMOUS, SPECIAL, UNKNOWN = range(8)
+
+kind_names = ("heap",
+              "global",
+              "library",
+              "file",
+              "stack",
+              "anonymous",
+              "special",
+              "unknown")
+
+
+def mapping_kind(mapping):
+    path = mapping.path
+    if path == "":
+        return ANONYMOUS
+    if path.startswith("[stack"):
+        return STACK
+    if path == "[heap]":
+        # brk heap, not used by libtthread's allocator
+        return ANONYMOUS
+    if path.startswith("["):
+        # [vdso], [vvar], [vsyscall]
+        return SPECIAL
+    if path.startswith("/dev/zero") or path.startswith("/SYSV"):
+        # shared anonymous memory
+        return ANONYMOUS
+    name = os.path.basename(path.replace(" (deleted)", ""))
+    if name.endswith(".so") or ".so." in name:
+        return LIBRARY
+    return FILE
+
+
+_max_address = (1 << 64) - 1
+
+
+# removes [start, end) from sorted, non-overlapping intervals
+def _subtract(intervals, start, end):
+    result = []
+    for interval in intervals:
+        s, e = interval[0], interval[1]
+        if e <= start or s >= end:
+            result.append(interval)
+            continue
+        if s < start:
+            result.append((s, start) + interval[2:])
+        if e > end:
+            result.append((end, e) + interval[2:])
+    return result
+
+
+class RegionIndex:
+    def __init__(self, mappings, header=None):
+        # (start, end, kind, mapping)
+        intervals = [(m.start, m.end, mapping_kind(m), m)
+                     for m in mappings if m.start < m.end]
+        if header is not None:
+            for kind, start, end in ((HEAP,
+                                      header.heap_start,
+                                      header.heap_end + 1),
+                                     (GLOBAL,
+                                      header.global_start,
+                                      header.global_end + 1)):
+                if start < end:
+                    intervals = _subtract(intervals, start, end)
+                    intervals.append((start, end, kind, None))
+        intervals.sort(key=lambda i: i[:2])
+        # region i covers [boundaries[i - 1], boundaries[i]), region 0 starts
+        # at address 0 and the last region ends at the end of the address space
+        self.boundaries = array("Q")
+        self.mappings = [None]
+        kinds = [UNKNOWN]
+        position = 0
+        for start, end, kind, mapping in intervals:
+            # overlapping mappings: the first one wins
+            start = max(start, position)
+            if start >= end:
+                continue
+            for address, k, m in ((start, kind, mapping),
+                                  (end, UNKNOWN, None)):
+                if address == (self.boundaries[-1] if self.boundaries else 0):
+                    kinds[-1], self.mappings[-1] = k, m
+                elif address <= _max_address:
+                    self.boundaries.append(address)
+                    kinds.append(k)
+                    self.mappings.append(m)
+            position = end
+        self.kinds = bytes(kinds)
+        # bisection is faster on a list
+        self._boundaries = self.boundaries.tolist()
+
+    @classmethod
+    def from_log(cls, log):
+        return cls(log.memory_map(), log._read_header())
+
+    def __len__(self):
+        return len(self.kinds)
+
+    # Returns the region boundaries as sorted list, see boundaries
+    def boundary_list(self):
+        return self._boundaries
+
+    def region(self, address):
+        return bisect_right(self._boundaries, address)
+
+    # returns (kind, symbols.Mapping or None) of an address
+    def lookup(self, address):
+        i = self.region(address)
+        return self.kinds[i], self.mappings[i]
+
+    def kind_name(self, address):
+        return kind_names[self.kinds[self.region(address)]]
+
+    # Returns the region numbers of addresses, as array of "I" for a
+    # sequence and as numpy array for a numpy array
+    def regions(self, addresses):
+        if hasattr(addresses, "dtype"):
+            numpy = accesslog._import_numpy()
+            boundaries = numpy.frombuffer(self.boundaries, dtype=numpy.uint64)
+            return numpy.searchsorted(boundaries,
+                                      addresses.astype(numpy.uint64),
+                                      side="right")
+        return array("I", map(bisect_right,
+                              repeat(self._boundaries),
+                              addresses))
+
+    # Returns the kinds of addresses, as bytes for a sequence and as numpy
+    # array of uint8 for a numpy array
+    def classify(self, addresses):
+        regions = self.regions(addresses)
+        if hasattr(regions, "dtype"):
+            numpy = accesslog._import_numpy()
+            kinds = numpy.frombuffer(self.kinds, dtype=numpy.uint8)
+            return kinds[regions]
+        return bytes(map(self.kinds.__getitem__, regions))
+
+    # Returns the names of the kinds of addresses
+    def names(self, addresses):
+        return map(kind_names.__getitem__, self.classify(addresses))
+
+    # Returns the number of addresses per mapping as list of
+    # (kind, mapping or None, count), ordered by count
+    def histogram(self, addresses):
+        counts = Counter(self.regions(addresses))
+        result = [(self.kinds[i], self.mappings[i], c)
+                  for i, c in counts.items()]
+        result.sort(key=lambda r: r[2], reverse=True)
+        return result
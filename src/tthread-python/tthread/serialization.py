@@ -0,0 +1,377 @@
+import heapq
+import json
+from collections import deque
+from tthread import accesslog
+from tthread.analysis import PAGE_SHIFT
+
+# Serialization analysis of the thunk sequence
+#
+# The log has no timestamps, so the run is replayed on a logical clock:
+#
+#   - a thunk computes for `fault_cost` per read or write event (each one is a
+#     page fault) and then commits its written pages for `commit_cost` each
+#   - commits hold the token, so they are serialized in the order the thunks
+#     ended in the log: at the next thunk or finish event of their thread in
+#     version 1 logs; in version 2 logs, whose blocks are written when a thunk
+#     committed, when a block of another thread follows, unless the block is
+#     marked as continued (a thunk, which did not fit in one block)
+#   - the next thunk of a thread starts when its commit finished
+#
+# A thunk, which finished computing while the token was held, waits. The wait
+# is due to a conflict, if the thunk accessed a page another thread committed
+# since the thunk started, otherwise it is only lost to the serialization of
+# commits.
+#
+# The time the program would need, if commits only waited for the commits of
+# pages their thunk accessed (data dependencies) and not for the token, is
+# tracked as well. The difference to the replayed time is the parallelism
+# lost to the token.
+#
+# The log is read once and the results are updated as commits arrive. State
+# is kept per page (last commit), per thread (current thunk, its written pages
+# and the critical path up to its last commit, summarized per thread) and for
+# the commits, which may still be waited for: commits, which ended before the
+# earliest start of a thunk still to commit, are final. Thunks are blamed for
+# the time thunks of other threads waited during their commit; only the `top`
+# thunks are kept. At most `window` commits are kept for blaming, so memory
+# does not grow with the number of thunks.
+
+
+# Aggregates of the critical path ending at a commit, per thread on it.
+# A path is shared by the token and the threads, whose last commit it ends
+# at; `refs` counts them, so an unshared path is extended in place.
+class _Path:
+    __slots__ = ("threads", "last_thread", "end", "refs")
+
+    def __init__(self):
+        # thread_id -> [thunks, compute, commit, wait, segments]
+        self.threads = {}
+        self.last_thread = None
+        self.end = 0
+        self.refs = 0
+
+    def copy(self):
+        path = _Path()
+        path.threads = {t: list(a) for t, a in self.threads.items()}
+        path.last_thread = self.last_thread
+        path.end = self.end
+        return path
+
+    # `token` is set, if the commit waited for the commit at the end of the
+    # path, otherwise it follows the previous commit of its thread
+    def add(self, thread_id, compute, commit, wait, end, token):
+        aggregates = self.threads.get(thread_id)
+        if aggregates is None:
+            aggregates = self.threads[thread_id] = [0, 0, 0, 0, 0]
+        aggregates[0] += 1
+        aggregates[1] += compute
+        aggregates[2] += commit
+        aggregates[3] += wait
+        if token or self.last_thread != thread_id:
+            aggregates[4] += 1
+        self.last_thread = thread_id
+        self.end = end
+
+    def result(self):
+        return {
+            "end": self.end,
+            "thunks": sum(a[0] for a in self.threads.values()),
+            "threads": {t: {"thunks": a[0],
+                            "compute": a[1],
+                            "commit": a[2],
+                            "wait": a[3],
+                            "segments": a[4]}
+                        for t, a in sorted(self.threads.items())},
+        }
+
+
+# A commit, which thunks may still be waiting for
+class _Holder:
+    __slots__ = ("thread_id", "thunk_id", "pages", "start", "end", "blame")
+
+    def __init__(self, thread_id, thunk_id, pages, start, end):
+        self.thread_id = thread_id
+        self.thunk_id = thunk_id
+        self.pages = pages
+        self.start = start
+        self.end = end
+        self.blame = 0
+
+
+class _Thread:
+    def __init__(self, thread_id, start, sequence, ideal):
+        self.thread_id = thread_id
+        self.thunk_id = 0
+        self.open = False
+        self.finished = False
+        # time the current thunk started and number of commits before it
+        self.start = start
+        self.sequence = sequence
+        # start of the current thunk without serialization of commits and
+        # the end of the last commit it depends on
+        self.ideal = ideal
+        self.depends = 0
+        self.faults = 0
+        self.written = set()
+        # pages of other threads committed while the thunk ran
+        self.conflicts = set()
+        # critical path up to the last commit of the thread
+        self.path = None
+        # totals
+        self.thunks = 0
+        self.compute = 0
+        self.commit_time = 0
+        self.wait = 0
+        self.conflict_wait = 0
+        self.conflict_pages = 0
+
+    def result(self):
+        return {
+            "thunks": self.thunks,
+            "compute": self.compute,
+            "commit": self.commit_time,
+            "wait": self.wait,
+            "conflict_wait": self.conflict_wait,
+            "conflict_pages": self.conflict_pages,
+        }
+
+
+class Serialization:
+    def __init__(self, header, fault_cost=1, commit_cost=1, top=20,
+                 window=1 << 16):
+        self.fault_cost = fault_cost
+        self.commit_cost = commit_cost
+        self.top = top
+        self.window = window
+        self.compact = header.version == accesslog.COMPACT_VERSION
+        # page -> (commit sequence, thread_id, ideal end of the commit)
+        self.pages = {}
+        # thread_id -> _Thread
+        self.threads = {}
+        self.sequence = 0
+        # the token is free at `time`, after the last commit, which ended at
+        # `token_ideal` without serialization and ends the critical `path`
+        self.time = 0
+        self.path = None
+        self.token_ideal = 0
+        # commits in the order they held the token, which may still be
+        # waited for
+        self.holders = deque()
+        # heap of the `top` (wait caused, thread_id, thunk_id, pages)
+        self._blamed = []
+        self.ideal_time = 0
+        self.waits = 0
+        self._last_thread = None
+        # version 2: the last event of the previous block ends a block, whose
+        # thunk continues in the next block of its thread
+        self._continued = False
+
+    def _thread(self, thread_id):
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            # threads are started by a commit of their parent
+            thread = _Thread(thread_id,
+                             self.time,
+                             self.sequence,
+                             self.token_ideal)
+            self.threads[thread_id] = thread
+        return thread
+
+    def _commit(self, thread):
+        if not thread.open:
+            return
+        pages = self.pages
+        thread_id = thread.thread_id
+        for page in thread.written:
+            sequence, writer, writer_ideal = pages.get(page, (-1, 0, 0))
+            if writer != thread_id and sequence >= thread.sequence:
+                thread.conflicts.add(page)
+                thread.depends = max(thread.depends, writer_ideal)
+        compute = thread.faults * self.fault_cost
+        commit = len(thread.written) * self.commit_cost
+        ready = thread.start + compute
+        wait = max(0, self.time - ready)
+        end = max(ready, self.time) + commit
+        ideal = max(thread.ideal + compute, thread.depends) + commit
+
+        self._blame(thread_id, ready, self.time)
+        if commit > 0:
+            self.holders.append(_Holder(thread_id, thread.thunk_id,
+                                        len(thread.written), end - commit,
+                                        end))
+
+        token = wait > 0 or thread.path is None
+        path = self._extend(thread, self.path if token else thread.path)
+        path.add(thread_id, compute, commit, wait, end, token)
+
+        for page in thread.written:
+            pages[page] = (self.sequence, thread_id, ideal)
+        self.sequence += 1
+        self.time = end
+        self.token_ideal = ideal
+        self.ideal_time = max(self.ideal_time, ideal)
+        self.waits += wait
+
+        thread.thunks += 1
+        thread.compute += compute
+        thread.commit_time += commit
+        thread.wait += wait
+        if thread.conflicts:
+            thread.conflict_wait += wait
+            thread.conflict_pages += len(thread.conflicts)
+        thread.open = False
+        thread.start = end
+        thread.sequence = self.sequence
+        thread.ideal = ideal
+        thread.depends = 0
+        thread.faults = 0
+        thread.written = set()
+        thread.conflicts = set()
+        self._retire()
+
+    # Returns the path to extend by the next commit of `thread`, `base` is
+    # copied if it is still the path of the token or another thread
+    def _extend(self, thread, base):
+        for old in (self.path, thread.path):
+            if old is not None:
+                old.refs -= 1
+        if base is None:
+            path = _Path()
+        elif base.refs > 0:
+            path = base.copy()
+        else:
+            path = base
+        path.refs = 2
+        self.path = thread.path = path
+        return path
+
+    # blames the commits of other threads, which held the token while a
+    # thunk of `thread_id` waited from `ready` to `start`
+    def _blame(self, thread_id, ready, start):
+        if ready >= start:
+            return
+        for holder in reversed(self.holders):
+            if holder.end <= ready:
+                break
+            overlap = min(holder.end, start) - max(holder.start, ready)
+            if overlap > 0 and holder.thread_id != thread_id:
+                holder.blame += overlap
+
+    # Moves commits, which no thunk still to commit can wait for, to the
+    # blamed thunks. Thunks start after the commit of their previous thunk,
+    # so a commit before the earliest start is final.
+    def _retire(self):
+        holders = self.holders
+        starts = [t.start for t in self.threads.values() if not t.finished]
+        horizon = min(starts) if starts else self.time
+        while holders and (holders[0].end <= horizon
+                           or len(holders) > self.window):
+            self._add_blamed(holders.popleft())
+
+    def _add_blamed(self, holder):
+        if holder.blame <= 0 or self.top <= 0:
+            return
+        item = (holder.blame, holder.thread_id, holder.thunk_id, holder.pages)
+        if len(self._blamed) < self.top:
+            heapq.heappush(self._blamed, item)
+        else:
+            heapq.heappushpop(self._blamed, item)
+
+    def add(self, batch):
+        pages = self.pages
+        compact = self.compact
+        continued = set(batch.continued)
+        position = batch.start
+        for type_, _, thread_id, payload in batch.rows():
+            if compact and thread_id != self._last_thread:
+                # a block of another thread: the previous block was written,
+                # when its thunk committed
+                last = self.threads.get(self._last_thread)
+                if last is not None and not self._continued:
+                    self._commit(last)
+                self._last_thread = thread_id
+            if compact:
+                self._continued = position in continued
+                position += 1
+            thread = self._thread(thread_id)
+            if type_ == accesslog.THUNK:
+                self._commit(thread)
+                thread.thunk_id = accesslog.thunk_id(payload)
+                thread.open = True
+                continue
+            if type_ == accesslog.FINISH:
+                self._commit(thread)
+                thread.finished = True
+                continue
+            if type_ != accesslog.WRITE and type_ != accesslog.READ:
+                continue
+            # accesses before the first thunk event belong to thunk 0
+            thread.open = True
+            thread.faults += 1
+            page = payload >> PAGE_SHIFT
+            if type_ == accesslog.WRITE:
+                thread.written.add(page)
+            last = pages.get(page)
+            if last is not None and last[1] != thread_id \
+                    and last[0] >= thread.sequence:
+                thread.conflicts.add(page)
+                thread.depends = max(thread.depends, last[2])
+
+    def finish(self):
+        # thunks, which did not end before the log ended
+        for thread_id in sorted(self.threads):
+            self._commit(self.threads[thread_id])
+        while self.holders:
+            self._add_blamed(self.holders.popleft())
+
+    # Returns the critical path, the chain of commits the last commit waited
+    # for, as aggregates per thread. A segment is a run of consecutive thunks
+    # of a thread, which did not wait for the token.
+    def critical_path(self):
+        if self.path is None:
+            return _Path().result()
+        return self.path.result()
+
+    # Returns the `top` thunks, which caused the most waiting, as list of
+    # (wait caused, thread_id, thunk_id, pages written)
+    def blamed(self):
+        return sorted(self._blamed, reverse=True)
+
+    # Returns the analysis as dict, which can be serialized as JSON
+    def result(self):
+        work = sum(t.compute + t.commit_time for t in self.threads.values())
+        return {
+            "time": self.time,
+            "ideal_time": self.ideal_time,
+            "work": work,
+            "parallelism": work / self.time if self.time else 0,
+            "wait": self.waits,
+            "commits": self.sequence,
+            "threads": {t: self.threads[t].result()
+                        for t in sorted(self.threads)},
+            "critical_path": self.critical_path(),
+            "blamed": [{"wait": wait,
+                        "thread_id": thread_id,
+                        "thunk_id": thunk_id,
+                        "pages": pages}
+                       for wait, thread_id, thunk_id, pages in self.blamed()],
+        }
+
+
+def analyze(log, batch_size=65536, **options):
+    serialization = Serialization(log._read_header(), **options)
+    for batch in log.iter_batches(batch_size):
+        serialization.add(batch)
+    serialization.finish()
+    return serialization
+
+
+# writes the serialization analysis of a log as JSON
+class SerializationWriter:
+    def __init__(self, log, top=20):
+        self.log = log
+        self.top = top
+
+    def write(self, f):
+        json.dump(analyze(self.log, top=self.top).result(), f, indent=2)
+        f.write("\n")
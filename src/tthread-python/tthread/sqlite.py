@@ -0,0 +1,202 @@
+import sqlite3
+import tthread
+from tthread import accesslog
+from tthread.analysis import PAGE_SHIFT
+from tthread.accesslog import names
+
+# Loads a log into an SQLite database for ad-hoc queries
+#
+# Tables:
+#   events: one row per event, `id` is its position in the log. `page` and
+#     `space` are set for reads and writes, `thunk` is the thunks.id of the
+#     thunk the event belongs to.
+#   thunks: one row per thunk with its first and last event and the number of
+#     reads and writes. Thunk 0 of a thread contains the accesses before its
+#     first thunk event and has no return_address.
+#   event_types, spaces: names of events.type and events.space
+#
+# Views:
+#   accesses: reads and writes attributed to their thunk, as the tsv2 format
+#   thunk_pages: pages accessed per thunk
+#
+# Rows are inserted with executemany() in transactions of `transaction_size`
+# events with journaling and syncing turned off, so a crash during the load
+# leaves a corrupt database. Indexes are built after the load.
+
+# events per transaction
+transaction_size = 1 << 20
+
+schema = """
+CREATE TABLE event_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE spaces (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE events (
+    id INTEGER PRIMARY KEY,
+    type INTEGER NOT NULL,
+    return_address INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL,
+    payload INTEGER NOT NULL,
+    page INTEGER,
+    space INTEGER,
+    thunk INTEGER NOT NULL
+);
+CREATE TABLE thunks (
+    id INTEGER PRIMARY KEY,
+    thread_id INTEGER NOT NULL,
+    thunk_id INTEGER NOT NULL,
+    return_address INTEGER,
+    first_event INTEGER NOT NULL,
+    last_event INTEGER NOT NULL,
+    reads INTEGER NOT NULL,
+    writes INTEGER NOT NULL
+);
+"""
+
+indexes = """
+CREATE INDEX events_thread_id ON events (thread_id);
+CREATE INDEX events_page ON events (page);
+CREATE INDEX events_return_address ON events (return_address);
+CREATE INDEX events_thunk ON events (thunk);
+CREATE INDEX thunks_thread_id ON thunks (thread_id, thunk_id);
+"""
+
+views = """
+CREATE VIEW accesses AS
+SELECT events.id AS id,
+       event_types.name AS access,
+       events.return_address AS return_address,
+       events.thread_id AS thread_id,
+       thunks.thunk_id AS thunk_id,
+       thunks.return_address AS thunk_return_address,
+       spaces.name AS space,
+       events.payload AS address,
+       events.page AS page
+FROM events
+JOIN thunks ON thunks.id = events.thunk
+JOIN event_types ON event_types.id = events.type
+JOIN spaces ON spaces.id = events.space
+WHERE events.page IS NOT NULL;
+
+CREATE VIEW thunk_pages AS
+SELECT thunks.thread_id AS thread_id,
+       thunks.thunk_id AS thunk_id,
+       events.page AS page,
+       SUM(events.type = %d) AS reads,
+       SUM(events.type = %d) AS writes
+FROM events
+JOIN thunks ON thunks.id = events.thunk
+WHERE events.page IS NOT NULL
+GROUP BY events.thunk, events.page;
+""" % (accesslog.READ, accesslog.WRITE)
+
+
+class Error(tthread.Error):
+    pass
+
+
+def _columns(n):
+    return ", ".join("?" * n)
+
+
+class _Loader:
+    def __init__(self, log, db):
+        self.header = log._read_header()
+        self.db = db
+        # thread_id -> [id, thread_id, thunk_id, return_address, first_event,
+        # last_event, reads, writes] of the current thunk
+        self.current = {}
+        # thunks, which ended and are not inserted yet
+        self.ended = []
+        self.thunks = 0
+        self.events = 0
+
+    def _start(self, thread_id, thunk_id, return_address, position):
+        thunk = [self.thunks, thread_id, thunk_id, return_address,
+                 position, position, 0, 0]
+        self.thunks += 1
+        self.current[thread_id] = thunk
+        return thunk
+
+    def _end(self, thread_id):
+        thunk = self.current.pop(thread_id, None)
+        if thunk is not None:
+            self.ended.append(thunk)
+
+    def _rows(self, batch):
+        current = self.current
+        position = batch.start
+        spaces = accesslog.classify_spaces(batch.payload, self.header)
+        rows = zip(batch.rows(), spaces)
+        for (type_, return_address, thread_id, payload), code in rows:
+            page = space = None
+            if type_ == accesslog.THUNK:
+                self._end(thread_id)
+                thunk = self._start(thread_id,
+                                    accesslog.thunk_id(payload),
+                                    return_address,
+                                    position)
+            else:
+                thunk = current.get(thread_id)
+                if thunk is None:
+                    thunk = self._start(thread_id, 0, None, position)
+                thunk[5] = position
+                if type_ == accesslog.WRITE or type_ == accesslog.READ:
+                    thunk[6 if type_ == accesslog.READ else 7] += 1
+                    page, space = payload >> PAGE_SHIFT, code
+                elif type_ == accesslog.FINISH:
+                    self._end(thread_id)
+            yield (position, type_, return_address, thread_id, payload,
+                   page, space, thunk[0])
+            position += 1
+
+    def _flush_thunks(self):
+        self.db.executemany("INSERT INTO thunks VALUES (%s)" % _columns(8),
+                            self.ended)
+        self.ended = []
+
+    def load(self, batches):
+        db = self.db
+        pending = 0
+        for batch in batches:
+            db.executemany("INSERT INTO events VALUES (%s)" % _columns(8),
+                           self._rows(batch))
+            self.events += len(batch)
+            pending += len(batch)
+            if pending >= transaction_size:
+                self._flush_thunks()
+                db.commit()
+                pending = 0
+        # thunks, which did not end before the log ended
+        self.ended.extend(sorted(self.current.values()))
+        self.current = {}
+        self._flush_thunks()
+        db.commit()
+
+
+# Loads `log` into a new SQLite database at `path`. Returns (number of events,
+# number of thunks).
+def load(log, path, batch_size=65536):
+    try:
+        db = sqlite3.connect(path)
+    except sqlite3.Error as e:
+        raise Error("failed to open database '%s': %s" % (path, e))
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        try:
+            db.executescript(schema)
+        except sqlite3.OperationalError as e:
+            raise Error("database '%s' is not empty: %s" % (path, e))
+        db.executemany("INSERT INTO event_types VALUES (?, ?)",
+                       sorted(names.items()))
+        db.executemany("INSERT INTO spaces VALUES (?, ?)",
+                       enumerate(accesslog.space_names))
+        loader = _Loader(log, db)
+        loader.load(log.iter_batches(batch_size))
+        db.executescript(indexes + views)
+        db.execute("ANALYZE")
+        db.commit()
+    except sqlite3.Error as e:
+        raise Error("failed to load log into '%s': %s" % (path, e))
+    finally:
+        db.close()
+    return loader.events, loader.thunks
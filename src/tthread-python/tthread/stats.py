@@ -0,0 +1,195 @@
+import json
+import math
+from collections import Counter
+from itertools import compress
+from tthread import accesslog
+from tthread.analysis import PAGE_SHIFT
+from tthread.accesslog import names
+
+# Statistics of a log in a single pass: event counts per type, thread and
+# memory space, distinct pages and the most frequent call sites (return
+# addresses of read and write events).
+#
+# Memory does not depend on the number of events: distinct pages are counted
+# per memory space in a DistinctCounter, call sites in a HeavyHitters summary,
+# both of fixed size.
+
+_mask = (1 << 64) - 1
+
+
+# splitmix64 finalizer, spreads page numbers over 64 bits
+def _mix(key):
+    z = (key + 0x9E3779B97F4A7C15) & _mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _mask
+    return z ^ (z >> 31)
+
+
+# HyperLogLog estimate of the number of distinct integers. Up to `exact`
+# keys are kept in a set and counted exactly, afterwards 2 ** precision
+# registers of one byte are used. The standard error of the estimate is
+# 1.04 / sqrt(2 ** precision), 0.8% by default.
+class DistinctCounter:
+    def __init__(self, precision=14, exact=4096):
+        self.precision = precision
+        self.exact = exact
+        self.keys = set()
+        self.registers = None
+
+    def update(self, keys):
+        if self.registers is None:
+            self.keys.update(keys)
+            if len(self.keys) <= self.exact:
+                return
+            keys, self.keys = self.keys, None
+            self.registers = bytearray(1 << self.precision)
+        registers = self.registers
+        shift = 64 - self.precision
+        low = (1 << shift) - 1
+        for key in keys:
+            h = _mix(key)
+            # position of the first set bit after the register index
+            rank = shift + 1 - (h & low).bit_length()
+            i = h >> shift
+            if registers[i] < rank:
+                registers[i] = rank
+
+    def count(self):
+        if self.registers is None:
+            return len(self.keys)
+        registers = self.registers
+        m = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in registers)
+        zeros = registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+# Misra-Gries summary of the most frequent keys with at most `capacity`
+# counters. The true count of a key is between its counter and the counter
+# plus `error`; keys with a true count above total / (capacity + 1) are never
+# missed.
+class HeavyHitters:
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.counters = Counter()
+        # upper bound of the count missing from any counter
+        self.error = 0
+        self.total = 0
+
+    # adds a Counter of keys
+    def update(self, counts):
+        self.total += sum(counts.values())
+        self.counters.update(counts)
+        if len(self.counters) <= self.capacity:
+            return
+        values = sorted(self.counters.values(), reverse=True)
+        threshold = values[self.capacity]
+        self.error += threshold
+        self.counters = Counter({k: c - threshold
+                                 for k, c in self.counters.items()
+                                 if c > threshold})
+
+    # returns the n most frequent (key, count) pairs
+    def top(self, n):
+        return self.counters.most_common(n)
+
+
+# per memory space: translation table selecting its addresses
+_space_tables = [bytes(i == code for i in range(256))
+                 for code in range(len(accesslog.space_names))]
+
+
+class Stats:
+    def __init__(self, header, call_sites=1024):
+        self.header = header
+        self.types = Counter()
+        # (thread_id, type) -> count
+        self.threads = Counter()
+        # (space, type) -> count
+        self.spaces = Counter()
+        # space -> DistinctCounter of pages
+        self.pages = {space: DistinctCounter()
+                      for space in accesslog.space_names}
+        self.call_sites = HeavyHitters(call_sites)
+
+    def add(self, batch):
+        header = self.header
+        self.types.update(batch.types)
+        self.threads.update(zip(batch.thread_id, batch.types))
+        for type_ in (accesslog.WRITE, accesslog.READ):
+            payload = batch.of_type(type_).payload
+            if not payload:
+                continue
+            codes = accesslog.classify_spaces(payload, header)
+            for code, space in enumerate(accesslog.space_names):
+                self.spaces[space, type_] += codes.count(code)
+                addresses = compress(payload,
+                                     codes.translate(_space_tables[code]))
+                self.pages[space].update({address >> PAGE_SHIFT
+                                          for address in addresses})
+        memory = batch.types.translate(accesslog._memory_table)
+        self.call_sites.update(Counter(compress(batch.return_address,
+                                                memory)))
+
+    # Returns the statistics as dict, which can be serialized as JSON.
+    # `symbols` maps return addresses to symbol names.
+    def result(self, top=20, symbols=None):
+        threads = {}
+        for (thread_id, type_), count in sorted(self.threads.items()):
+            counts = threads.setdefault(thread_id, {})
+            counts[names[type_]] = count
+        pages = {space: counter.count()
+                 for space, counter in self.pages.items()}
+        spaces = {}
+        for space in accesslog.space_names:
+            spaces[space] = {
+                "write": self.spaces[space, accesslog.WRITE],
+                "read": self.spaces[space, accesslog.READ],
+                "pages": pages[space],
+            }
+        call_sites = []
+        for address, count in self.call_sites.top(top):
+            site = {"return_address": address, "count": count}
+            if symbols is not None:
+                site["symbol"] = symbols.get(address)
+            call_sites.append(site)
+        return {
+            "events": sum(self.types.values()),
+            "types": {names[t]: c for t, c in sorted(self.types.items())},
+            "threads": threads,
+            "spaces": spaces,
+            "pages": sum(pages.values()),
+            "call_sites": {
+                "accesses": self.call_sites.total,
+                "max_error": self.call_sites.error,
+                "top": call_sites,
+            },
+        }
+
+
+def compute(log, batch_size=65536, call_sites=1024):
+    stats = Stats(log._read_header(), call_sites)
+    for batch in log.iter_batches(batch_size):
+        stats.add(batch)
+    return stats
+
+
+# writes the statistics of a log as JSON
+class StatsWriter:
+    def __init__(self, log, symbolizer=None, top=20):
+        self.log = log
+        self.symbolizer = symbolizer
+        self.top = top
+
+    def write(self, f):
+        stats = compute(self.log)
+        symbols = None
+        if self.symbolizer is not None:
+            addresses = [a for a, _ in stats.call_sites.top(self.top)]
+            symbols = self.symbolizer.resolve_many(addresses)
+        json.dump(stats.result(self.top, symbols), f, indent=2)
+        f.write("\n")
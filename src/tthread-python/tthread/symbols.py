@@ -0,0 +1,272 @@
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
+import tthread
+from tthread import arrayfile
+
+# a line of /proc/<pid>/maps
+Mapping = namedtuple("Mapping", ["start", "end", "perms", "offset", "path"])
+
+elf_header_fmt = "<16sHHIQQQIHHHHHH"
+section_header_fmt = "<IIQQQQIIQQ"
+program_header_fmt = "<IIQQQQQQ"
+symbol_fmt = "<IBBHQQ"
+note_header_fmt = "<III"
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+PT_LOAD = 1
+STT_FUNC = 2
+STT_GNU_IFUNC = 10
+NT_GNU_BUILD_ID = 3
+
+file_magic = b"TTSYMS\0\0"
+
+
+class Error(tthread.Error):
+    pass
+
+
+def parse_maps(text):
+    mappings = []
+    for line in text.splitlines():
+        fields = line.split(None, 5)
+        if len(fields) < 5:
+            continue
+        start, end = fields[0].split("-")
+        path = fields[5].strip() if len(fields) > 5 else ""
+        mappings.append(Mapping(int(start, 16),
+                                int(end, 16),
+                                fields[1],
+                                int(fields[2], 16),
+                                path))
+    mappings.sort()
+    return mappings
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+                                os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "tthread", "symbols")
+
+
+# Function symbols of an ELF file sorted by address
+#
+# Stored in the symbol cache as arrayfile: the segments as flat array of
+# (p_offset, p_filesz, p_vaddr), addresses, sizes and the NUL-separated
+# names.
+class SymbolTable:
+    version = 1
+
+    def __init__(self, build_id, segments, addresses, sizes, names):
+        self.build_id = build_id
+        # list of (p_offset, p_filesz, p_vaddr) of PT_LOAD segments
+        self.segments = segments
+        self.addresses = addresses
+        self.sizes = sizes
+        self.names = names
+
+    def vaddr(self, file_offset):
+        for offset, size, vaddr in self.segments:
+            if offset <= file_offset < offset + size:
+                return file_offset - offset + vaddr
+        return None
+
+    def lookup(self, vaddr):
+        i = bisect_right(self.addresses, vaddr) - 1
+        if i < 0:
+            return None
+        start = self.addresses[i]
+        size = self.sizes[i]
+        if size != 0 and vaddr >= start + size:
+            return None
+        return "%s+0x%x" % (self.names[i], vaddr - start)
+
+    def save(self, f):
+        names = "\0".join(self.names).encode("utf-8")
+        arrayfile.write(f, file_magic, self.version, [
+            array("Q", (v for segment in self.segments for v in segment)),
+            self.addresses,
+            self.sizes,
+            names,
+        ])
+
+    @classmethod
+    def load(cls, f, build_id):
+        segments, addresses, sizes, names = \
+            arrayfile.read(f, file_magic, cls.version, "QQQB")
+        names = names.tobytes().decode("utf-8").split("\0") \
+            if addresses else []
+        if len(segments) % 3 != 0 or len(sizes) != len(addresses) \
+                or len(names) != len(addresses):
+            raise arrayfile.Error("symbol table is corrupt")
+        segments = [tuple(segments[i:i + 3])
+                    for i in range(0, len(segments), 3)]
+        return cls(build_id, segments, addresses, sizes, names)
+
+
+class ElfFile:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = f.read()
+        ident = self.data[:16]
+        if ident[:4] != b"\x7fELF":
+            raise Error("'%s' is not an ELF file" % path)
+        # only 64-bit little endian is supported, as used by libtthread
+        if ident[4] != 2 or ident[5] != 1:
+            raise Error("'%s' is not a 64-bit little endian ELF" % path)
+        header = struct.unpack_from(elf_header_fmt, self.data)
+        phoff, shoff = header[5], header[6]
+        phentsize, phnum = header[9], header[10]
+        shentsize, shnum = header[11], header[12]
+        self.program_headers = [
+            struct.unpack_from(program_header_fmt,
+                               self.data,
+                               phoff + i * phentsize)
+            for i in range(phnum)]
+        self.sections = [
+            struct.unpack_from(section_header_fmt,
+                               self.data,
+                               shoff + i * shentsize)
+            for i in range(shnum)]
+
+    def _section_data(self, section):
+        offset, size = section[4], section[5]
+        return memoryview(self.data)[offset:offset + size]
+
+    def build_id(self):
+        for section in self.sections:
+            if section[1] != SHT_NOTE:
+                continue
+            data = self._section_data(section)
+            pos = 0
+            while pos + 12 <= len(data):
+                namesz, descsz, type_ = struct.unpack_from(note_header_fmt,
+                                                           data, pos)
+                pos += 12
+                name = bytes(data[pos:pos + namesz])
+                pos += (namesz + 3) & ~3
+                desc = bytes(data[pos:pos + descsz])
+                pos += (descsz + 3) & ~3
+                if type_ == NT_GNU_BUILD_ID and name == b"GNU\0":
+                    return desc.hex()
+        return None
+
+    def segments(self):
+        return [(p[2], p[5], p[3]) for p in self.program_headers
+                if p[0] == PT_LOAD]
+
+    def _name(self, strtab, offset):
+        start = strtab[4] + offset
+        end = self.data.index(b"\0", start)
+        return self.data[start:end].decode("utf-8", "replace")
+
+    def symbol_table(self, build_id=None):
+        symbols = {}
+        # .symtab entries override .dynsym entries of the same address
+        for wanted in (SHT_DYNSYM, SHT_SYMTAB):
+            for section in self.sections:
+                if section[1] != wanted:
+                    continue
+                strtab = self.sections[section[6]]
+                data = self._section_data(section)
+                data = data[:len(data) - len(data) % 24]
+                for sym in struct.iter_unpack(symbol_fmt, data):
+                    name, info, _, shndx, value, size = sym
+                    if (info & 0xF) not in (STT_FUNC, STT_GNU_IFUNC):
+                        continue
+                    if shndx == 0 or value == 0:
+                        continue
+                    symbols[value] = (size, self._name(strtab, name))
+        addresses = sorted(symbols)
+        return SymbolTable(build_id,
+                           self.segments(),
+                           array("Q", addresses),
+                           array("Q", [symbols[a][0] for a in addresses]),
+                           [symbols[a][1] for a in addresses])
+
+
+# Resolves return addresses of a traced process to function+offset.
+# Symbol tables are cached in memory and on disk (keyed by build-id),
+# resolved addresses in an LRU cache.
+class Symbolizer:
+    def __init__(self, mappings, cache_dir=None, cache_size=1 << 16):
+        self.mappings = [m for m in mappings if m.path.startswith("/")]
+        self.starts = [m.start for m in self.mappings]
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self._tables = {}
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _mapping(self, addr):
+        i = bisect_right(self.starts, addr) - 1
+        if i < 0:
+            return None
+        mapping = self.mappings[i]
+        if addr >= mapping.end:
+            return None
+        return mapping
+
+    def _cache_path(self, build_id):
+        return os.path.join(self.cache_dir, build_id + ".symbols")
+
+    def _load_cached(self, build_id):
+        try:
+            with open(self._cache_path(build_id), "rb") as f:
+                return SymbolTable.load(f, build_id)
+        except (OSError, UnicodeDecodeError, arrayfile.Error):
+            return None
+
+    def _save_cached(self, table):
+        path = self._cache_path(table.build_id)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = "%s.%d" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                table.save(f)
+            os.rename(tmp, path)
+        except OSError:
+            # the cache is optional
+            pass
+
+    def table(self, path):
+        if path in self._tables:
+            return self._tables[path]
+        table = None
+        try:
+            elf = ElfFile(path)
+            build_id = elf.build_id()
+            if build_id is not None:
+                table = self._load_cached(build_id)
+            if table is None:
+                table = elf.symbol_table(build_id)
+                if build_id is not None:
+                    self._save_cached(table)
+        except (OSError, Error, struct.error):
+            table = None
+        self._tables[path] = table
+        return table
+
+    def _resolve(self, addr):
+        mapping = self._mapping(addr)
+        if mapping is None:
+            return None
+        file_offset = addr - mapping.start + mapping.offset
+        table = self.table(mapping.path)
+        if table is not None:
+            vaddr = table.vaddr(file_offset)
+            if vaddr is not None:
+                symbol = table.lookup(vaddr)
+                if symbol is not None:
+                    return symbol
+        return "%s+0x%x" % (os.path.basename(mapping.path), file_offset)
+
+    # returns dict address -> symbol for all unique addresses
+    def resolve_many(self, addresses):
+        return {addr: self.resolve(addr) for addr in set(addresses)}
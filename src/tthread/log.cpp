@@ -9,6 +9,7 @@
 #include <string.h>
 #include <sys/mman.h>
 
+#include "tthread/logblock.h"
 #include "xglobals.h"
 #include "xlogger.h"
 
@@ -19,6 +20,8 @@ log::log() :
   _logOffset(0),
   _log(NULL)
 {
+  // include buffered events of this thread
+  tthread::logger->flush();
   openLog(tthread::logger->getLogFd());
 }
 
@@ -28,6 +31,7 @@ log::log(off_t offset) :
   _log(NULL)
 {
   ASSERT(offset > 0);
+  tthread::logger->flush();
   openLog(tthread::logger->getLogFd());
 }
 
@@ -137,6 +141,11 @@ void log::openLog(int logFd) {
   assert(logFile >= 0);
   _header = log::readHeader(logFd);
   assert(_header->checkFileMagick());
+
+  if (_header->getVersion() == logheader::COMPACT_VERSION) {
+    decodeLog(logFd);
+    return;
+  }
   _logSize = *_header->getEventCount() * xlogger::EVENT_SIZE;
 
   if (_logSize == 0) {
@@ -160,4 +169,94 @@ void log::openLog(int logFd) {
   }
   _log = (logevent *)(buf + diff);
 }
+
+// Version 2 logs are decoded into an anonymous mapping of _logSize bytes,
+// which holds the events after _logOffset.
+void log::decodeLog(int logFd) {
+  size_t dataSize = *_header->getDataSize();
+  unsigned long count = *_header->getEventCount();
+  unsigned long skip = _logOffset / sizeof(logevent);
+
+  _logSize = count * sizeof(logevent);
+
+  if ((count <= skip) || (dataSize == 0)) {
+    _logSize = _logOffset;
+    return;
+  }
+
+  char *data = (char *)WRAP(mmap)(NULL,
+                                  dataSize,
+                                  PROT_READ,
+                                  MAP_SHARED,
+                                  logFd,
+                                  xlogger::HEADER_SIZE);
+
+  if (data == MAP_FAILED) {
+    fprintf(stderr, "tthread::log: mmap error: %s\n", strerror(errno));
+    ::abort();
+  }
+
+  _log = (logevent *)WRAP(mmap)(NULL,
+                                _logSize,
+                                PROT_READ | PROT_WRITE,
+                                MAP_PRIVATE | MAP_ANONYMOUS,
+                                -1,
+                                0);
+
+  if (_log == MAP_FAILED) {
+    fprintf(stderr, "tthread::log: mmap error: %s\n", strerror(errno));
+    ::abort();
+  }
+
+  unsigned long i = 0;
+  size_t pos = 0;
+
+  while ((pos + sizeof(logblockheader) <= dataSize) && (i < count)) {
+    const logblockheader *block = (const logblockheader *)(data + pos);
+
+    if (block->size == 0) {
+      // not written yet
+      break;
+    }
+
+    const char *p = data + pos + sizeof(logblockheader);
+    uint64_t returnAddresses[RETURN_ADDRESS_SLOTS] = { 0 };
+    uint64_t lastAddress = 0;
+
+    uint32_t events = block->eventCount & ~LOG_BLOCK_CONTINUED;
+
+    for (uint32_t n = 0; n < events && i < count; n++, i++) {
+      logevent::Type type = (logevent::Type)(*p & 0x07);
+      uint64_t returnAddress;
+
+      if (*p++ & RETURN_ADDRESS_CACHED) {
+        returnAddress = returnAddresses[(unsigned char)*p++];
+      } else {
+        p = readVarint(p, &returnAddress);
+        returnAddresses[returnAddressSlot(returnAddress)] = returnAddress;
+      }
+
+      EventData eventData;
+      uint64_t value;
+      memset(&eventData, 0, sizeof(eventData));
+
+      if ((type == logevent::WRITE) || (type == logevent::READ)) {
+        p = readVarint(p, &value);
+        lastAddress += zigzagDecode(value);
+        eventData.memory.address = (const void *)lastAddress;
+      } else if (type == logevent::THUNK) {
+        p = readVarint(p, &value);
+        eventData.thunk.id = (int)zigzagDecode(value);
+      }
+
+      if (i >= skip) {
+        logevent e(type, (const void *)returnAddress, eventData);
+        e.setThreadId(block->threadId);
+        _log[i - skip] = e;
+      }
+    }
+    pos += block->size;
+  }
+  munmap(data, dataSize);
+}
 }
@@ -144,6 +144,9 @@ void finalize() {
   memory->closeProtection();
   initialized = false;
 
+  tthread::logger->flush();
+  tthread::logger->saveMemoryMaps();
+
   #ifdef DEBUG_ENABLED
   fprintf(stderr, "\nStatistics information:\n");
   PRINT_TIMER(serial);
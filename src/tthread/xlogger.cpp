@@ -1,9 +1,30 @@
+#include <errno.h>
 #include <stddef.h>
+#include <stdint.h>
 
+#include "tthread/logblock.h"
 #include "tthread/logevent.h"
 #include "xatomic.h"
 #include "xlogger.h"
 
+static void writeAll(int fd, const char *buf, size_t count, off_t offset) {
+  while (count > 0) {
+    ssize_t n = pwrite(fd, buf, count, offset);
+
+    if (n < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      fprintf(stderr, "tthread::log: failed to write log: %s\n",
+              strerror(errno));
+      ::abort();
+    }
+    buf += n;
+    count -= n;
+    offset += n;
+  }
+}
+
 void xlogger::add(tthread::logevent e) {
   if (!global_data->enable_logging) {
     return;
@@ -15,15 +36,105 @@ void xlogger::add(tthread::logevent e) {
     e.setThreadId(_thread->getId());
   }
 
+  if (_version == tthread::logheader::COMPACT_VERSION) {
+    addCompact(e);
+    return;
+  }
+
   unsigned long next = xatomic::increment_and_return(_next, 1);
-  unsigned long required_size =
-    ((next + 1) * EVENT_SIZE) - _mmapOffset;
+  off_t offset = next * EVENT_SIZE;
+
+  if ((offset < _mmapOffset)
+      || (offset + EVENT_SIZE > _mmapOffset + (off_t)_mmapSize)) {
+    growLog(offset);
+  }
+
+  // substract file offset of the mapping
+  char *byte_offset = ((char *)_log) + (offset - _mmapOffset);
+
+  // the type is written last, so a reader of the running log, which sees
+  // the type of an event, sees all of its fields
+  memcpy(byte_offset + 1, ((char *)&e) + 1, EVENT_SIZE - 1);
+  __atomic_store_n(byte_offset, *(char *)&e, __ATOMIC_RELEASE);
+}
+
+void xlogger::addCompact(tthread::logevent& e) {
+  tthread::logevent::Type type = e.getType();
+
+  // a block contains the events of a single thunk, so blocks of different
+  // threads appear in the log in the order their thunks ended. A thunk,
+  // which does not fit in a block, continues in the next block.
+  if (_blockEvents > 0) {
+    if ((type == tthread::logevent::THUNK)
+        || (e.getThreadId() != _blockThreadId)) {
+      flush(false);
+    } else if (_blockUsed + tthread::MAX_RECORD_SIZE >
+               tthread::LOG_BLOCK_SIZE) {
+      flush(true);
+    }
+  }
+
+  _blockThreadId = e.getThreadId();
 
-  if (required_size > REQUEST_SIZE) {
-    growLog();
+  char *p = _block + _blockUsed;
+  uintptr_t returnAddress = (uintptr_t)e.getReturnAddress();
+  unsigned int slot = tthread::returnAddressSlot(returnAddress);
+
+  if (_returnAddresses[slot] == returnAddress) {
+    *p++ = (char)(type | tthread::RETURN_ADDRESS_CACHED);
+    *p++ = (char)slot;
+  } else {
+    *p++ = (char)type;
+    p = tthread::writeVarint(p, returnAddress);
+    _returnAddresses[slot] = returnAddress;
+  }
+
+  switch (type) {
+  case tthread::logevent::WRITE:
+  case tthread::logevent::READ: {
+    uintptr_t address = (uintptr_t)e.getData().memory.address;
+    p = tthread::writeVarint(p,
+                            tthread::zigzagEncode(address - _lastAddress));
+    _lastAddress = address;
+    break;
+  }
+
+  case tthread::logevent::THUNK:
+    p = tthread::writeVarint(p, tthread::zigzagEncode(e.getData().thunk.id));
+    break;
+
+  default:
+    break;
+  }
+
+  _blockUsed = p - _block;
+  _blockEvents++;
+
+  if (type == tthread::logevent::FINISH) {
+    flush(false);
+  }
+}
+
+void xlogger::flush(bool continued) {
+  if ((_version != tthread::logheader::COMPACT_VERSION)
+      || (_blockEvents == 0)) {
+    return;
   }
 
-  // substract file offset from _next
-  char *byte_offset = ((char *)(_log + next)) - _mmapOffset;
-  *((tthread::logevent *)byte_offset) = e;
+  tthread::logblockheader *header = (tthread::logblockheader *)_block;
+  header->size = 0;
+  header->threadId = _blockThreadId;
+  header->eventCount = _blockEvents
+                       | (continued ? tthread::LOG_BLOCK_CONTINUED : 0);
+
+  uint32_t size = _blockUsed;
+  off_t offset = HEADER_SIZE + xatomic::increment_and_return(_dataSize, size);
+
+  // the size is written last, so readers of a log, which is still written,
+  // can detect incomplete blocks
+  writeAll(_logFd, _block, size, offset);
+  writeAll(_logFd, (const char *)&size, sizeof(size), offset);
+
+  xatomic::increment_and_return(_next, _blockEvents);
+  resetBlock();
 }